@@ -0,0 +1,66 @@
+"""
+File Name: batched_fft.py
+Project Name: RIVeR-LAC
+Description: Benchmark one FFT correlation per pair against one batched FFT over several pairs.
+
+Run from the repository root:
+
+	python benchmarks/batched_fft.py [--windows 300] [--ia 64] [--pairs 8] [--threads 8]
+
+Small grids give each pair too few windows to keep the pyFFTW threads busy; stacking the windows of several pairs
+along the batch axis gives every FFT call more work.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pyfftw
+
+from river.core.piv_fftmulti import compute_convolution, compute_convolution_batch
+
+
+def best_of(function, repeat: int) -> float:
+	"""Return the shortest elapsed time of several calls, in seconds."""
+	elapsed = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		function()
+		elapsed.append(time.perf_counter() - start)
+	return min(elapsed)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--windows", type=int, default=300)
+	parser.add_argument("--ia", type=int, default=64)
+	parser.add_argument("--pairs", type=int, default=8)
+	parser.add_argument("--threads", type=int, default=pyfftw.config.NUM_THREADS)
+	parser.add_argument("--repeat", type=int, default=5)
+	args = parser.parse_args()
+
+	pyfftw.config.NUM_THREADS = args.threads
+
+	rng = np.random.default_rng(0)
+	# Strided windows, as extract_pass_windows returns them
+	shape = (args.windows, 1, args.ia, args.ia)
+	image1_cuts = [rng.random(shape, dtype=np.float32) for _ in range(args.pairs)]
+	image2_cuts = [rng.random(shape, dtype=np.float32) for _ in range(args.pairs)]
+
+	single = [compute_convolution(a, b) for a, b in zip(image1_cuts, image2_cuts)]
+	batched = compute_convolution_batch(image1_cuts, image2_cuts)
+	assert all(np.allclose(a, b, rtol=1e-4, atol=1e-3) for a, b in zip(single, batched)), "batched planes differ"
+
+	print(f"{args.pairs} pairs of {args.windows} windows, IA={args.ia}, {args.threads} FFTW threads")
+
+	single_time = best_of(
+		lambda: [compute_convolution(a, b) for a, b in zip(image1_cuts, image2_cuts)], args.repeat
+	)
+	batch_time = best_of(lambda: compute_convolution_batch(image1_cuts, image2_cuts), args.repeat)
+	print(f"one FFT per pair   {single_time * 1e3:8.1f} ms")
+	print(f"one batched FFT    {batch_time * 1e3:8.1f} ms")
+	print(f"speed-up: {single_time / batch_time:.2f}x")
+
+
+if __name__ == "__main__":
+	main()
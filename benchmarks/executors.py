@@ -0,0 +1,69 @@
+"""
+File Name: executors.py
+Project Name: RIVeR-LAC
+Description: Benchmark the process, thread and hybrid executors of run_analyze_all.
+
+Run from the repository root:
+
+	python benchmarks/executors.py [frames_dir] [--ia1 128] [--ia2 64] [--cores 8] [--repeat 2]
+
+By default the pisco example frames are used with the full frame as region of interest. Every mode splits the same
+core budget: process runs one single-threaded process per core, thread runs one thread per core in this process, and
+hybrid runs two threads in each of half as many processes. Each mode is checked against the process results.
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from river.core.concurrency import available_cores
+from river.core.piv_pipeline import run_analyze_all
+
+DEFAULT_FRAMES = Path(__file__).resolve().parents[1] / "examples" / "data" / "frames" / "pisco"
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("frames_dir", nargs="?", type=Path, default=DEFAULT_FRAMES)
+	parser.add_argument("--ia1", type=int, default=128)
+	parser.add_argument("--ia2", type=int, default=64)
+	parser.add_argument("--cores", type=int, default=available_cores())
+	parser.add_argument("--repeat", type=int, default=2)
+	args = parser.parse_args()
+
+	hybrid_threads = 2 if args.cores > 1 else 1
+	modes = {
+		"process": dict(executor="process", workers=args.cores, threads_per_worker=1),
+		"thread": dict(executor="thread", workers=args.cores, threads_per_worker=1),
+		"hybrid": dict(
+			executor="hybrid", workers=max(1, args.cores // hybrid_threads), threads_per_worker=hybrid_threads
+		),
+	}
+
+	reference = None
+	timings = {}
+	for name, options in modes.items():
+		elapsed = []
+		for _ in range(args.repeat):
+			start = time.perf_counter()
+			results = run_analyze_all(
+				args.frames_dir, interrogation_area_1=args.ia1, interrogation_area_2=args.ia2, **options
+			)
+			elapsed.append(time.perf_counter() - start)
+		timings[name] = min(elapsed)
+
+		u = np.asarray(results["u"], dtype=float)
+		if reference is None:
+			reference = u
+		assert np.array_equal(np.isnan(u), np.isnan(reference)), f"{name} results differ from process"
+		assert np.allclose(u, reference, equal_nan=True), f"{name} results differ from process"
+
+	print(f"{args.frames_dir.name}: {len(reference) + 1} frames, IA {args.ia1}/{args.ia2}, {args.cores} cores")
+	for name, elapsed in timings.items():
+		print(f"{name:8s} {elapsed:8.2f} s  ({timings['process'] / elapsed:.2f}x process)")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,70 @@
+"""
+File Name: inpaint.py
+Project Name: RIVeR-LAC
+Description: Compare the time and accuracy of the NaN inpainting engines of piv_fftmulti.
+
+Run from the repository root:
+
+	python benchmarks/inpaint.py [--sizes 20 40 80 120] [--missing 0.1] [--max-rbf 6000]
+
+Each grid holds a smooth synthetic velocity field. A fraction of the vectors is removed at random, plus a block
+that mimics a region rejected by the filters, and each engine fills them back. The error is measured on the removed
+vectors only. The dense RBF solve is skipped above --max-rbf valid vectors, where it needs gigabytes of memory.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from river.core.piv_fftmulti import INPAINT_METHODS, inpaint_table
+
+
+def synthetic_field(rows: int, cols: int) -> np.ndarray:
+	"""Return a smooth field with a cross-stream profile and a few meanders, in pixels per frame."""
+	y, x = np.mgrid[0:rows, 0:cols] / np.array([rows, cols])[:, None, None]
+	return 6 * np.sin(np.pi * y) + 0.8 * np.cos(3 * np.pi * x) * y + 0.3 * np.sin(7 * x + 5 * y)
+
+
+def remove_vectors(field: np.ndarray, missing: float, rng: np.random.Generator) -> np.ndarray:
+	"""Return a copy of the field with random vectors and one block set to NaN."""
+	rows, cols = field.shape
+	holed = field.copy()
+	holed[rng.random(field.shape) < missing] = np.nan
+	holed[rows // 3: rows // 3 + max(rows // 10, 1), cols // 2: cols // 2 + max(cols // 10, 1)] = np.nan
+	return holed
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", type=int, nargs="+", default=[20, 40, 80, 120, 200])
+	parser.add_argument("--missing", type=float, default=0.1)
+	parser.add_argument("--max-rbf", type=int, default=6000)
+	args = parser.parse_args()
+
+	rng = np.random.default_rng(0)
+	print("grid       vectors   missing       engine   time [ms]   rms error   max error")
+	for size in args.sizes:
+		rows, cols = size, int(size * 1.5)
+		field = synthetic_field(rows, cols)
+		holed = remove_vectors(field, args.missing, rng)
+		missing = np.isnan(holed)
+
+		for name in INPAINT_METHODS:
+			if name == "rbf" and (~missing).sum() > args.max_rbf:
+				print(f"{rows:4d}x{cols:<4d} {field.size:9d} {missing.sum():9d}   {name:>10}     skipped")
+				continue
+
+			start = time.perf_counter()
+			filled = inpaint_table(holed, name)
+			elapsed = time.perf_counter() - start
+
+			error = filled[missing] - field[missing]
+			print(
+				f"{rows:4d}x{cols:<4d} {field.size:9d} {missing.sum():9d}   {name:>10}  {elapsed * 1e3:10.1f}"
+				f"  {np.sqrt(np.mean(error**2)):10.4f}  {np.max(np.abs(error)):10.4f}"
+			)
+
+
+if __name__ == "__main__":
+	main()
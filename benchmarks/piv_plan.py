@@ -0,0 +1,81 @@
+"""
+File Name: piv_plan.py
+Project Name: RIVeR-LAC
+Description: Benchmark the per-pair time of piv_fftmulti with and without a precomputed PivPlan.
+
+Run from the repository root:
+
+	python benchmarks/piv_plan.py [frames_dir] [--ia1 128] [--ia2 64]
+
+By default the pisco example frames are used with the full frame as region of interest.
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+import river.core.image_preprocessing as impp
+from river.core.piv_fftmulti import create_piv_plan, piv_fftmulti
+
+DEFAULT_FRAMES = Path(__file__).resolve().parents[1] / "examples" / "data" / "frames" / "pisco"
+
+
+def load_frames(frames_dir: Path) -> list:
+	"""Load and preprocess every frame of the folder with the default piv-analyze filters."""
+	return [
+		impp.preprocess_image(str(path), True, True, 5, False, None) for path in sorted(frames_dir.glob("*.jpg"))
+	]
+
+
+def time_pairs(frames: list, bbox: list, ia1: int, ia2: int) -> tuple:
+	"""
+	Return the elapsed time of every consecutive pair without and with a plan.
+
+	Both variants run alternately on the same pair so that they see the same machine load.
+	"""
+	mask = np.ones(frames[0].shape, dtype=np.uint8)
+	plan = create_piv_plan(frames[0].shape, bbox, mask, ia1, ia2)
+	without_plan = []
+	with_plan = []
+	for image1, image2 in zip(frames[:-1], frames[1:]):
+		start = time.perf_counter()
+		piv_fftmulti(image1, image2, mask, bbox, ia1, ia2)
+		without_plan.append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		piv_fftmulti(image1, image2, plan=plan)
+		with_plan.append(time.perf_counter() - start)
+	return np.array(without_plan), np.array(with_plan)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("frames_dir", nargs="?", type=Path, default=DEFAULT_FRAMES)
+	parser.add_argument("--ia1", type=int, default=128)
+	parser.add_argument("--ia2", type=int, default=64)
+	args = parser.parse_args()
+
+	frames = load_frames(args.frames_dir)
+	height, width = frames[0].shape
+	bbox = [0, 0, width, height]
+	print(f"{len(frames) - 1} pairs of {width}x{height} px, IA1={args.ia1}, IA2={args.ia2}")
+
+	# Warm up the FFT plans so that both variants start from the same state
+	time_pairs(frames[:2], bbox, args.ia1, args.ia2)
+
+	start = time.perf_counter()
+	create_piv_plan(frames[0].shape, bbox, None, args.ia1, args.ia2)
+	print(f"plan construction: {(time.perf_counter() - start) * 1e3:.1f} ms (once per run)")
+
+	without_plan, with_plan = time_pairs(frames, bbox, args.ia1, args.ia2)
+
+	print(f"{'variant':<12}{'median [ms]':>14}{'mean [ms]':>12}")
+	for name, timings in (("per-pair", without_plan), ("PivPlan", with_plan)):
+		print(f"{name:<12}{np.median(timings) * 1e3:>14.1f}{np.mean(timings) * 1e3:>12.1f}")
+	print(f"speed-up: {np.median(without_plan) / np.median(with_plan):.2f}x")
+
+
+if __name__ == "__main__":
+	main()
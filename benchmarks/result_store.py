@@ -0,0 +1,67 @@
+"""
+File Name: result_store.py
+Project Name: RIVeR-LAC
+Description: Compare per-pair np.hstack accumulation with writing into a preallocated PivResultStore.
+
+Run from the repository root:
+
+	python benchmarks/result_store.py [--vectors 5000] [--pairs 500 1000 2000]
+
+Each pair produces the four per-pair fields of piv_loop. The hstack variant grows float64 matrices one column at a
+time as run_analyze_all used to; the store writes float32 columns in place and computes the medians by blocks.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from river.core.piv_results import RESULT_FIELDS, PivResultStore
+
+
+def accumulate_hstack(columns: list, num_vectors: int) -> dict:
+	"""Grow one matrix per field with np.hstack and compute the medians."""
+	cumul = {field: np.zeros((num_vectors, 0)) for field in RESULT_FIELDS}
+	for column in columns:
+		for field in RESULT_FIELDS:
+			cumul[field] = np.hstack((cumul[field], column))
+	np.nanmedian(cumul["u"], axis=1)
+	np.nanmedian(cumul["v"], axis=1)
+	return cumul
+
+
+def accumulate_store(columns: list, num_vectors: int) -> PivResultStore:
+	"""Write the columns into a store in reverse order and compute the medians."""
+	store = PivResultStore(num_vectors, len(columns))
+	for index in reversed(range(len(columns))):
+		store.write(index, {field: columns[index] for field in RESULT_FIELDS})
+	store.nanmedian("u")
+	store.nanmedian("v")
+	return store
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--vectors", type=int, default=5000)
+	parser.add_argument("--pairs", type=int, nargs="+", default=[500, 1000, 2000])
+	args = parser.parse_args()
+
+	rng = np.random.default_rng(0)
+	print("pairs   hstack [s]   store [s]   store memory [MB]")
+	for num_pairs in args.pairs:
+		columns = [rng.standard_normal((args.vectors, 1)) for _ in range(num_pairs)]
+
+		start = time.perf_counter()
+		accumulate_hstack(columns, args.vectors)
+		hstack_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		store = accumulate_store(columns, args.vectors)
+		store_time = time.perf_counter() - start
+
+		memory = sum(array.nbytes for array in store.arrays.values()) / 2**20
+		print(f"{num_pairs:5d}   {hstack_time:10.2f}   {store_time:9.2f}   {memory:17.0f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,91 @@
+"""
+File Name: video_extraction.py
+Project Name: RIVeR-LAC
+Description: Benchmark the stream and chunks extraction modes of video_to_frames.
+
+Run from the repository root:
+
+	python benchmarks/video_extraction.py [video] [--every 1] [--resize-factor 1.0] [--workers N] [--repeat 2]
+
+Without a video, a 600-frame clip with a keyframe every 12 frames is written from the pisco example frames. Every
+mode extracts into its own empty folder, and the saved JPEGs are checked to be identical to those of the chunks mode.
+"""
+
+import argparse
+import filecmp
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+
+from river.core.video_to_frames import EXTRACTION_MODES, video_to_frames
+
+DEFAULT_FRAMES = Path(__file__).resolve().parents[1] / "examples" / "data" / "frames" / "pisco"
+
+
+def write_clip(path: Path, frames: int = 600):
+	"""Write a clip cycling through the pisco frames, with the frame number drawn on each."""
+	images = [cv2.imread(str(image)) for image in sorted(DEFAULT_FRAMES.glob("*.jpg"))]
+	height, width = images[0].shape[:2]
+	writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), 30, (width, height))
+	for number in range(frames):
+		image = images[number % len(images)].copy()
+		cv2.putText(image, str(number), (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 5)
+		writer.write(image)
+	writer.release()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("video", nargs="?", type=Path, default=None)
+	parser.add_argument("--every", type=int, default=1)
+	parser.add_argument("--resize-factor", type=float, default=1.0)
+	parser.add_argument("--workers", type=int, default=None)
+	parser.add_argument("--repeat", type=int, default=2)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as workdir:
+		workdir = Path(workdir)
+		video = args.video
+		if video is None:
+			video = workdir.joinpath("clip.mp4")
+			write_clip(video)
+
+		timings = {}
+		outputs = {}
+		for mode in reversed(EXTRACTION_MODES):
+			elapsed = []
+			for repeat in range(args.repeat):
+				frames_dir = workdir.joinpath(f"{mode}-{repeat}")
+				frames_dir.mkdir()
+				start = time.perf_counter()
+				video_to_frames(
+					video,
+					frames_dir,
+					every=args.every,
+					resize_factor=args.resize_factor,
+					mode=mode,
+					workers=args.workers,
+				)
+				elapsed.append(time.perf_counter() - start)
+			timings[mode] = min(elapsed)
+			outputs[mode] = frames_dir
+
+		names = sorted(path.name for path in outputs["chunks"].iterdir())
+		for mode, frames_dir in outputs.items():
+			assert sorted(path.name for path in frames_dir.iterdir()) == names, f"{mode} saved other frames"
+			_, mismatch, errors = filecmp.cmpfiles(outputs["chunks"], frames_dir, names, shallow=False)
+			assert not mismatch and not errors, f"{mode} frames differ from chunks"
+
+		size = sum(path.stat().st_size for path in outputs["chunks"].iterdir()) / 1e6
+		print(f"{video.name}: {len(names)} frames saved, {size:.0f} MB of JPEG")
+		for mode, elapsed in timings.items():
+			print(
+				f"{mode:8s} {elapsed:8.2f} s  {len(names) / elapsed:7.1f} frames/s  "
+				f"({timings['chunks'] / elapsed:.2f}x chunks)"
+			)
+
+
+if __name__ == "__main__":
+	main()
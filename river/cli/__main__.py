@@ -4,7 +4,7 @@ import river.cli.commands.coordinate_transform as ct
 import river.cli.commands.define_roi_masks as rm
 from river.cli.commands import piv_pipeline
 from river.cli.commands.compute_section import update_xsection
-from river.cli.commands.video_to_frames import video_to_frames
+from river.cli.commands.video_to_frames import video_frame, video_to_frames
 
 from multiprocessing import freeze_support
 
@@ -17,6 +17,7 @@ def cli(ctx: click.Context, verbose: bool):
 
 
 cli.add_command(video_to_frames)
+cli.add_command(video_frame)
 cli.add_command(ct.get_uav_transformation_matrix)
 cli.add_command(ct.get_oblique_transformation_matrix)
 cli.add_command(ct.transform_pixel_to_real_world)
@@ -26,6 +27,7 @@ cli.add_command(rm.recommend_height_roi)
 cli.add_command(rm.create_mask_and_bbox)
 cli.add_command(piv_pipeline.piv_test)
 cli.add_command(piv_pipeline.piv_analyze)
+cli.add_command(piv_pipeline.stiv_analyze)
 cli.add_command(update_xsection)
 
 if __name__ == "__main__":
@@ -1,15 +1,21 @@
 import json
 from io import TextIOWrapper
+from pathlib import Path
 
 import click
 
 from river.cli.commands.utils import render_response
 from river.core.compute_section import update_current_x_section
+from river.core.piv_results import load_piv_results
 
 
 @click.command(help=("Update the current cross-section with the PIV results and other parameters."))
 @click.argument("xsections", envvar="XSECTIONS", type=click.File())
-@click.argument("piv-results", envvar="PIV_RESULTS", type=click.File())
+@click.argument(
+	"piv-results",
+	envvar="PIV_RESULTS",
+	type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True, path_type=Path),
+)
 @click.argument("transformation-matrix", envvar="TRANSFORMATION_MATRIX", type=click.File())
 @click.option("-s", "--step", type=int, required=True, help="Time step between frames.")
 @click.option("-f", "--fps", type=float, required=True, help="Frames per second of the video used in PIV processing.")
@@ -23,7 +29,7 @@ from river.core.compute_section import update_current_x_section
 @render_response
 def update_xsection(
 	xsections: TextIOWrapper,
-	piv_results: TextIOWrapper,
+	piv_results: Path,
 	transformation_matrix: TextIOWrapper,
 	step: int,
 	fps: float,
@@ -38,7 +44,7 @@ def update_xsection(
 
 	Args:
 	    xsections (TextIOWrapper): File stream to read the Cross-sections data.
-	    piv_results (TextIOWrapper): File stream to read the PIV results.
+	    piv_results (Path): piv_results.json file or binary piv_results folder.
 	    transformation_matrix (TextIOWrapper): File stream to read the transformation matrix.
 	    step (int): Time step between frames.
 	    fps (float): Frames per second of the video used in PIV processing.
@@ -52,7 +58,7 @@ def update_xsection(
 	"""
 
 	xsections = json.loads(xsections.read())
-	piv_results = json.loads(piv_results.read())
+	piv_results = load_piv_results(piv_results)
 	transformation_matrix = json.loads(transformation_matrix.read())
 
 	return update_current_x_section(
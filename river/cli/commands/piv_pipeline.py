@@ -7,11 +7,32 @@ import click
 import numpy as np
 
 from river.cli.commands.utils import render_response
-from river.core.piv_pipeline import run_analyze_all, run_test
+from river.core.background_models import BACKGROUND_METHODS, DEFAULT_PERCENTILE
+from river.core.frame_stack import is_frame_stack
+from river.core.piv_pipeline import run_analyze_all, run_analyze_ensemble, run_test
+from river.core.piv_results import save_piv_results
+from river.core.piv_stations import STATION_NEIGHBOURHOOD, section_stations
+from river.core.stiv import MIN_COHERENCE, run_stiv
+from river.core.video_stream import is_video
+
+
+def validate_cores(ctx: click.Context, param: click.Parameter, value: str) -> Optional[int]:
+	"""Parse the --cores option: a positive number of cores, or 'auto' (None) for all the available ones."""
+	if value is None or value == "auto":
+		return None
+	try:
+		cores = int(value)
+	except ValueError:
+		raise click.BadParameter("must be a positive integer or 'auto'.")
+	if cores < 1:
+		raise click.BadParameter("must be a positive integer or 'auto'.")
+	return cores
 
 
 @click.argument(
-	"image_2", type=click.Path(exists=True, file_okay=True, readable=True, resolve_path=True, path_type=Path)
+	"image_2",
+	type=click.Path(exists=True, file_okay=True, readable=True, resolve_path=True, path_type=Path),
+	required=False,
 )
 @click.argument(
 	"image_1", type=click.Path(exists=True, file_okay=True, readable=True, resolve_path=True, path_type=Path)
@@ -105,11 +126,57 @@ from river.core.piv_pipeline import run_analyze_all, run_test
 @click.option(
 	"-fs", "--filter-sub-background", type=bool, is_flag=True, default=False, help="Whether to subtract background."
 )
+@click.option(
+	"-pf",
+	"--peak-finder",
+	type=click.Choice(["argmax", "legacy"]),
+	default="argmax",
+	show_default=True,
+	help="Correlation peak search. 'legacy' uses the uint8 normalize-and-search step of previous versions.",
+)
+@click.option(
+	"-im",
+	"--inpaint-method",
+	type=click.Choice(["rbf", "biharmonic", "laplace"]),
+	default="rbf",
+	show_default=True,
+	help="How vectors rejected in the first pass are filled. 'biharmonic' and 'laplace' scale linearly with the grid size.",
+)
+@click.option(
+	"--background-method",
+	type=click.Choice(BACKGROUND_METHODS),
+	default="mean",
+	show_default=True,
+	help="Background subtracted with --filter-sub-background: the mean, approximate median, minimum or approximate "
+	"percentile of the frames, computed in one streaming pass.",
+)
+@click.option(
+	"--background-percentile",
+	type=click.FloatRange(0, 100),
+	default=DEFAULT_PERCENTILE,
+	show_default=True,
+	help="Percentile of --background-method percentile.",
+)
+@click.option(
+	"--background-every",
+	type=click.IntRange(1),
+	default=1,
+	show_default=True,
+	help="Compute the background from every N-th frame only.",
+)
+@click.option("--frame", type=click.IntRange(0), default=0, help="First frame of the pair, when IMAGE_1 is a video.")
+@click.option("--every", type=click.IntRange(1), default=1, help="Step to the second frame, when IMAGE_1 is a video.")
+@click.option(
+	"--resize-factor",
+	type=click.FloatRange(min=0.0, max=1.0, min_open=True),
+	default=1.0,
+	help="Factor to resize the frames, when IMAGE_1 is a video.",
+)
 @click.command
 @render_response
 def piv_test(
 	image_1: Path,
-	image_2: Path,
+	image_2: Optional[Path],
 	mask: Optional[TextIOWrapper],
 	bbox: Optional[TextIOWrapper],
 	interrogation_area_1: int,
@@ -126,7 +193,18 @@ def piv_test(
 	filter_clahe: bool,
 	clip_limit_clahe: int,
 	filter_sub_background: bool,
+	peak_finder: str,
+	inpaint_method: str,
+	background_method: str,
+	background_percentile: float,
+	background_every: int,
+	frame: int,
+	every: int,
+	resize_factor: float,
 ):
+	if image_2 is None and not is_video(image_1):
+		raise click.UsageError("IMAGE_2 is required unless IMAGE_1 is a video.")
+
 	if mask is not None:
 		mask = np.array(json.loads(mask.read()))
 
@@ -152,6 +230,14 @@ def piv_test(
 		filter_clahe,
 		clip_limit_clahe,
 		filter_sub_background,
+		peak_finder=peak_finder,
+		inpaint_method=inpaint_method,
+		frame=frame,
+		every=every,
+		resize_factor=resize_factor,
+		background_method=background_method,
+		background_percentile=background_percentile,
+		background_every=background_every,
 	)
 
 
@@ -247,9 +333,158 @@ def piv_test(
 @click.option(
 	"-fs", "--filter-sub-background", type=bool, is_flag=True, default=False, help="Whether to subtract background."
 )
+@click.option(
+	"-pf",
+	"--peak-finder",
+	type=click.Choice(["argmax", "legacy"]),
+	default="argmax",
+	show_default=True,
+	help="Correlation peak search. 'legacy' uses the uint8 normalize-and-search step of previous versions.",
+)
+@click.option(
+	"-im",
+	"--inpaint-method",
+	type=click.Choice(["rbf", "biharmonic", "laplace"]),
+	default="rbf",
+	show_default=True,
+	help="How vectors rejected in the first pass are filled. 'biharmonic' and 'laplace' scale linearly with the grid size.",
+)
 @click.option(
 	"-sb", "--save-background", type=bool, is_flag=True, default=False, help="Whether to save the background image."
 )
+@click.option(
+	"-en",
+	"--ensemble",
+	type=bool,
+	is_flag=True,
+	default=False,
+	help="Sum the correlation of all the pairs and compute a single time-averaged field.",
+)
+@click.option(
+	"-ep",
+	"--ensemble-passes",
+	type=click.IntRange(1, 2),
+	default=2,
+	show_default=True,
+	help="Number of ensemble passes. The second pass deforms every pair with the field of the first one.",
+)
+@click.option(
+	"-xs",
+	"--xsections",
+	type=click.File(),
+	default=None,
+	help="Cross-sections file. Only the windows around the sections are correlated, for discharge-only runs.",
+)
+@click.option(
+	"-tm",
+	"--transformation-matrix",
+	type=click.File(),
+	default=None,
+	help="Transformation matrix file, required with --xsections.",
+)
+@click.option(
+	"-sn",
+	"--station-neighbourhood",
+	type=click.IntRange(1),
+	default=STATION_NEIGHBOURHOOD,
+	show_default=True,
+	help="Number of grid steps kept around the sections with --xsections.",
+)
+@click.option(
+	"-pr",
+	"--predictor-refresh",
+	type=click.IntRange(0),
+	default=0,
+	show_default=True,
+	help="Seed each pair with the field of the previous one instead of a first pass, with a full first pass every "
+	"N pairs. 0 runs the first pass on every pair.",
+)
+@click.option(
+	"-bp",
+	"--batch-pairs",
+	type=click.IntRange(0),
+	default=None,
+	help="Number of consecutive pairs correlated in one batched FFT per pass. 0 sizes the batches to the FFT "
+	"memory budget. Defaults to 0 with --executor thread and several threads per worker, otherwise 1.",
+)
+@click.option(
+	"-ex",
+	"--executor",
+	type=click.Choice(["process", "thread", "hybrid"]),
+	default="process",
+	show_default=True,
+	help="Run the workers as processes, as threads sharing the inputs and results, or as threads inside processes.",
+)
+@click.option(
+	"-so",
+	"--statistics-only",
+	is_flag=True,
+	default=False,
+	help="Keep the median, mean, standard deviation and 5th and 95th percentiles of u and v of every vector instead "
+	"of the per-pair fields, in constant memory.",
+)
+@click.option(
+	"--background-method",
+	type=click.Choice(BACKGROUND_METHODS),
+	default="mean",
+	show_default=True,
+	help="Background subtracted with --filter-sub-background: the mean, approximate median, minimum or approximate "
+	"percentile of the frames, computed in one streaming pass.",
+)
+@click.option(
+	"--background-percentile",
+	type=click.FloatRange(0, 100),
+	default=DEFAULT_PERCENTILE,
+	show_default=True,
+	help="Percentile of --background-method percentile.",
+)
+@click.option(
+	"--background-every",
+	type=click.IntRange(1),
+	default=1,
+	show_default=True,
+	help="Compute the background from every N-th frame only.",
+)
+@click.option(
+	"--background-window",
+	type=click.IntRange(1),
+	default=None,
+	help="Compute a background for every window of N frames and subtract from each frame the one interpolated at "
+	"its position, to follow changes of lighting. Windowed backgrounds are not saved.",
+)
+@click.option("--start-frame", type=int, default=0, help="Frame number to start, when analyzing a video.")
+@click.option("--end-frame", type=int, default=None, help="Frame number to end, when analyzing a video.")
+@click.option("--every", type=click.IntRange(1), default=1, help="Step between the frames, when analyzing a video.")
+@click.option(
+	"--resize-factor",
+	type=click.FloatRange(min=0.0, max=1.0, min_open=True),
+	default=1.0,
+	help="Factor to resize the frames, when analyzing a video.",
+)
+@click.option("-nw", "--workers", type=click.IntRange(1), default=None, help="Number of worker processes.")
+@click.option(
+	"-tw",
+	"--threads-per-worker",
+	type=click.IntRange(1),
+	default=None,
+	help="Number of FFT, OpenCV and BLAS threads in each worker.",
+)
+@click.option(
+	"-co",
+	"--cores",
+	default="auto",
+	show_default=True,
+	callback=validate_cores,
+	help="Total number of cores split between the workers and their threads, or 'auto' for all available cores.",
+)
+@click.option(
+	"-rf",
+	"--results-format",
+	type=click.Choice(["json", "npy"]),
+	default="json",
+	show_default=True,
+	help="Write piv_results.json, or a piv_results folder of memory-mappable float32 .npy arrays.",
+)
 @click.option(
 	"-w",
 	"--workdir",
@@ -279,7 +514,30 @@ def piv_analyze(
 	clip_limit_clahe: int,
 	filter_sub_background: bool,
 	save_background: bool,
+	ensemble: bool,
+	ensemble_passes: int,
+	xsections: Optional[TextIOWrapper],
+	transformation_matrix: Optional[TextIOWrapper],
+	station_neighbourhood: int,
+	predictor_refresh: int,
+	batch_pairs: Optional[int],
+	executor: str,
+	statistics_only: bool,
+	background_method: str,
+	background_percentile: float,
+	background_every: int,
+	background_window: Optional[int],
+	start_frame: int,
+	end_frame: Optional[int],
+	every: int,
+	resize_factor: float,
+	workers: Optional[int],
+	threads_per_worker: Optional[int],
+	cores: Optional[int],
+	results_format: str,
 	workdir: Path,
+	peak_finder: str,
+	inpaint_method: str,
 ):
 	if mask is not None:
 		mask = np.array(json.loads(mask.read()))
@@ -287,7 +545,54 @@ def piv_analyze(
 	if bbox is not None:
 		bbox = json.loads(bbox.read())
 
-	results = run_analyze_all(
+	analyze = run_analyze_all
+	extra_options = {
+		"workers": workers,
+		"threads_per_worker": threads_per_worker,
+		"cores": cores,
+		"background_method": background_method,
+		"background_percentile": background_percentile,
+		"background_every": background_every,
+	}
+	if results_format == "npy":
+		results_path = workdir.joinpath("piv_results")
+	else:
+		results_path = workdir.joinpath("piv_results.json")
+
+	if xsections is not None:
+		if transformation_matrix is None:
+			raise click.UsageError("--xsections requires --transformation-matrix.")
+		if ensemble:
+			raise click.UsageError("--xsections cannot be used with --ensemble.")
+		extra_options["stations"] = section_stations(
+			json.loads(xsections.read()), np.array(json.loads(transformation_matrix.read()))
+		)
+		extra_options["station_neighbourhood"] = station_neighbourhood
+
+	if ensemble:
+		if predictor_refresh > 0:
+			raise click.UsageError("--predictor-refresh cannot be used with --ensemble.")
+		if statistics_only:
+			raise click.UsageError("--statistics-only cannot be used with --ensemble.")
+		if background_window is not None:
+			raise click.UsageError("--background-window cannot be used with --ensemble.")
+		if images_location.is_file() or is_frame_stack(images_location):
+			raise click.UsageError("--ensemble needs the JPEG frames of the video, extracted with video-to-frames.")
+		analyze = run_analyze_ensemble
+		extra_options["passes"] = ensemble_passes
+	else:
+		extra_options["predictor_refresh"] = predictor_refresh
+		extra_options["batch_pairs"] = batch_pairs
+		extra_options["executor"] = executor
+		extra_options["keep_frames"] = not statistics_only
+		extra_options["background_window"] = background_window
+		# Only used when images_location is a video, whose frames are streamed instead of extracted
+		extra_options.update(start_frame=start_frame, end_frame=end_frame, every=every, resize_factor=resize_factor)
+		if results_format == "npy":
+			# The per-pair results are written straight into the results folder
+			extra_options["store_path"] = results_path
+
+	results = analyze(
 		images_location,
 		mask,
 		bbox,
@@ -307,9 +612,98 @@ def piv_analyze(
 		filter_sub_background,
 		save_background,
 		workdir,
+		peak_finder=peak_finder,
+		inpaint_method=inpaint_method,
+		**extra_options,
+	)
+
+	if results_format == "npy":
+		if isinstance(results, dict):
+			save_piv_results(results_path, results)
+	else:
+		results_path.write_text(json.dumps(results))
+
+	return {"results_path": str(results_path)}
+
+
+@click.argument("transformation-matrix", envvar="TRANSFORMATION_MATRIX", type=click.File())
+@click.argument("xsections", envvar="XSECTIONS", type=click.File())
+@click.argument(
+	"images-location", type=click.Path(exists=True, dir_okay=True, readable=True, resolve_path=True, path_type=Path)
+)
+@click.option(
+	"-i", "--id-section", type=int, default=0, show_default=True, help="Index of the cross-section to measure."
+)
+@click.option("-ns", "--num-stations", type=int, default=None, help="Number of stations. Defaults to the section's.")
+@click.option(
+	"-ll",
+	"--line-length",
+	type=float,
+	default=None,
+	help="Length of the search lines in real-world units. Defaults to twice the distance between stations.",
+)
+@click.option(
+	"-tw",
+	"--time-window",
+	type=click.IntRange(2),
+	default=None,
+	help="Frames per velocity estimate. Defaults to one estimate over all the frames.",
+)
+@click.option(
+	"-mc",
+	"--min-coherence",
+	type=click.FloatRange(0, 1),
+	default=MIN_COHERENCE,
+	show_default=True,
+	help="Estimates with a lower structure tensor coherence are discarded.",
+)
+@click.option(
+	"-rf",
+	"--results-format",
+	type=click.Choice(["json", "npy"]),
+	default="json",
+	show_default=True,
+	help="Write piv_results.json, or a piv_results folder of memory-mappable float32 .npy arrays.",
+)
+@click.option(
+	"-w",
+	"--workdir",
+	envvar="WORKDIR",
+	required=True,
+	help="Directory to save the result.",
+	type=click.Path(exists=True, dir_okay=True, writable=True, resolve_path=True, path_type=Path),
+)
+@click.command(help="Measure the velocity along the stations of a cross-section with space-time images (STIV).")
+@render_response
+def stiv_analyze(
+	images_location: Path,
+	xsections: TextIOWrapper,
+	transformation_matrix: TextIOWrapper,
+	id_section: int,
+	num_stations: Optional[int],
+	line_length: Optional[float],
+	time_window: Optional[int],
+	min_coherence: float,
+	results_format: str,
+	workdir: Path,
+):
+	results = run_stiv(
+		images_location,
+		json.loads(xsections.read()),
+		np.array(json.loads(transformation_matrix.read())),
+		id_section,
+		num_stations,
+		line_length,
+		time_window,
+		min_coherence,
 	)
 
-	results_path = workdir.joinpath("piv_results.json")
-	results_path.write_text(json.dumps(results))
+	# Displacements are between consecutive frames, so update-xsection is run with --step 1
+	if results_format == "npy":
+		results_path = workdir.joinpath("piv_results")
+		save_piv_results(results_path, results)
+	else:
+		results_path = workdir.joinpath("piv_results.json")
+		results_path.write_text(json.dumps(results))
 
 	return {"results_path": str(results_path)}
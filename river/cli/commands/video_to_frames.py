@@ -1,9 +1,15 @@
+import json
+from io import TextIOWrapper
 from pathlib import Path
+from typing import Optional
 
 import click
+import cv2
 
 from river.cli.commands.utils import render_response
-from river.core.video_to_frames import video_to_frames as vtf
+from river.core.video_index import VideoFrameReader
+from river.core.video_stream import frame_name
+from river.core.video_to_frames import EXTRACTION_MODES, video_to_frames as vtf
 
 
 @click.command(help="Transforms the given video to frames and return the initial frame path.")
@@ -16,6 +22,23 @@ from river.core.video_to_frames import video_to_frames as vtf
 @click.option(
 	"--resize-factor", type=click.FloatRange(min=0.0, max=1.0), default=1.0, help="Factor to resize the frames."
 )
+@click.option(
+	"--mode",
+	type=click.Choice(EXTRACTION_MODES),
+	default="stream",
+	show_default=True,
+	help="'stream' decodes the video once and encodes the frames in parallel, 'chunks' decodes chunks in parallel, "
+	"'stack' writes a single lossless frame stack of grayscale frames cropped to --bbox, read by piv-analyze.",
+)
+@click.option("--workers", type=click.IntRange(1), default=None, help="Number of JPEG writers of the 'stream' mode.")
+@click.option(
+	"-bb",
+	"--bbox",
+	envvar="BBOX_PATH",
+	type=click.File(),
+	default=None,
+	help="The bounding box kept by the 'stack' mode, in pixels of the resized frames.",
+)
 @click.pass_context
 @render_response
 def video_to_frames(
@@ -27,6 +50,9 @@ def video_to_frames(
 	every: int,
 	overwrite: bool,
 	resize_factor: float,
+	mode: str,
+	workers: Optional[int],
+	bbox: Optional[TextIOWrapper],
 ) -> dict:
 	"""Command to process the given video into frames.
 
@@ -39,6 +65,9 @@ def video_to_frames(
 		every (int): Step to extract frames.
 		overwrite (bool): Overwrite frames if exists.
 		resize_factor (float, optional): Factor to resize the frames (<=1.0). Defaults to 1.0.
+		mode (str): "stream" or "chunks" extraction.
+		workers (Optional[int]): Number of JPEG writers of the "stream" mode.
+		bbox (Optional[TextIOWrapper]): JSON bounding box kept by the "stack" mode.
 	"""
 
 	if ctx.obj["verbose"]:
@@ -57,5 +86,47 @@ def video_to_frames(
 		every=every,
 		overwrite=overwrite,
 		resize_factor=resize_factor,
+		mode=mode,
+		workers=workers,
+		bbox=None if bbox is None else json.loads(bbox.read()),
 	)
+	if mode == "stack":
+		return {"frame_stack": str(initial_frame)}
 	return {"initial_frame": str(initial_frame)}
+
+
+@click.command(help="Writes a single frame of the given video, without extracting the others, and return its path.")
+@click.argument("video-path", type=click.Path(exists=True))
+@click.argument("frame", type=click.IntRange(0))
+@click.argument("frames-dir", type=click.Path(dir_okay=True, writable=True))
+@click.option(
+	"--resize-factor", type=click.FloatRange(min=0.0, max=1.0), default=1.0, help="Factor to resize the frame."
+)
+@click.pass_context
+@render_response
+def video_frame(ctx: click.Context, video_path: Path, frame: int, frames_dir: Path, resize_factor: float) -> dict:
+	"""Command to preview a frame of the given video.
+
+	The frame is read through the keyframe index of the video, built on the first call and saved next to it.
+
+	Args:
+		ctx (click.Context): Click context.
+		video_path (Path): Path of the video.
+		frame (int): Number of the frame.
+		frames_dir (Path): Path of the directory to store the frame, named as video-to-frames names it.
+		resize_factor (float, optional): Factor to resize the frame (<=1.0). Defaults to 1.0.
+	"""
+
+	if ctx.obj["verbose"]:
+		click.echo(f"Reading frame {frame} of '{video_path}' ...")
+
+	frames_dir = Path(frames_dir)
+	frames_dir.mkdir(parents=True, exist_ok=True)
+
+	with VideoFrameReader(Path(video_path), resize_factor, grayscale=False) as reader:
+		image = reader.read(frame)
+		frame_count = len(reader)
+
+	frame_path = frames_dir.joinpath(frame_name(frame))
+	cv2.imwrite(str(frame_path), image, [int(cv2.IMWRITE_JPEG_QUALITY), 95])
+	return {"frame_path": str(frame_path), "frame_count": frame_count}
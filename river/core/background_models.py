@@ -0,0 +1,285 @@
+"""
+File Name: background_models.py
+Project Name: RIVeR-LAC
+Description: Streaming background models for the background subtraction of the PIV frames.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+The background subtracted from every frame used to be the mean of all the frames, computed after loading them all
+in memory. A BackgroundModel is updated frame by frame and keeps a single frame of state, whatever the length of the
+video:
+	mean            running sum of the frames
+	median          approximate median: the estimate moves by a fixed step towards every new frame, as in the
+	                approximate median filter of McFarlane and Schofield, which is insensitive to glare and passing
+	                debris, unlike the mean
+	min             running minimum, the darkest value of every pixel
+	percentile      approximate percentile, with asymmetric steps that balance when the given fraction of the
+	                frames lies below the estimate; a low percentile is a noise-tolerant minimum
+The quantile estimates start from the exact quantile of the first BOOTSTRAP_FRAMES frames.
+
+Frames can be subsampled, and with a window the frames are summarized in consecutive windows. A
+WindowedBackground then gives every frame a background interpolated between the windows around it, which follows
+the changing light of long fixed-station videos.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+import cv2
+import numpy as np
+
+from river.core.shared_arrays import SharedArray
+from river.core.video_stream import VideoFrameStream, selected_frames
+
+BACKGROUND_METHODS = ("mean", "median", "min", "percentile")
+
+# Percentile of the "percentile" method
+DEFAULT_PERCENTILE = 10.0
+
+# Number of frames whose exact quantile starts the approximate ones
+BOOTSTRAP_FRAMES = 9
+
+# Largest change of a quantile estimate per frame, in grey levels
+QUANTILE_STEP = 1.0
+
+# Number of images decoded ahead when reading a folder
+PREFETCH_FRAMES = 16
+
+
+@dataclass(frozen=True)
+class BackgroundOptions:
+	"""How the background of an analysis is computed."""
+
+	method: str = "mean"
+	percentile: float = DEFAULT_PERCENTILE
+	every: int = 1
+	window: Optional[int] = None
+
+	def __post_init__(self):
+		if self.method not in BACKGROUND_METHODS:
+			raise ValueError(f"Unknown background method: {self.method}")
+		if not 0 <= self.percentile <= 100:
+			raise ValueError("The background percentile must be between 0 and 100.")
+		if self.every < 1 or (self.window is not None and self.window < 1):
+			raise ValueError("The background subsampling and window must be at least 1.")
+
+	@property
+	def file_name(self) -> str:
+		"""Name of the cached background image. The mean keeps the background.jpg of previous versions."""
+		if self.method == "mean":
+			return "background.jpg"
+		if self.method == "percentile":
+			return f"background_p{self.percentile:g}.jpg"
+		return f"background_{self.method}.jpg"
+
+
+class BackgroundModel:
+	"""
+	Per-pixel background of a sequence of grayscale frames, updated one frame at a time in constant memory.
+	"""
+
+	def __init__(self, method: str = "mean", percentile: float = DEFAULT_PERCENTILE, step: float = QUANTILE_STEP):
+		"""
+		Parameters:
+		method : str, optional
+			One of BACKGROUND_METHODS. Default is "mean".
+		percentile : float, optional
+			Percentile of the "percentile" method, between 0 and 100. Default is DEFAULT_PERCENTILE.
+		step : float, optional
+			Largest change of the median and percentile estimates per frame, in grey levels. Default is
+			QUANTILE_STEP.
+		"""
+		if method not in BACKGROUND_METHODS:
+			raise ValueError(f"Unknown background method: {method}")
+		self.method = method
+		self.quantile = 0.5 if method == "median" else percentile / 100
+		self.step = step
+		self.count = 0
+		self.state = None
+		self._bootstrap = []
+
+	def update(self, frame: np.ndarray):
+		"""
+		Add a frame.
+
+		Parameters:
+		frame : np.ndarray
+			A grayscale frame, of the same shape as the previous ones.
+		"""
+		frame = np.asarray(frame)
+		self.count += 1
+
+		if self.method == "mean":
+			if self.state is None:
+				self.state = np.zeros(frame.shape, dtype=np.float64)
+			self.state += frame
+		elif self.method == "min":
+			self.state = frame.copy() if self.state is None else np.minimum(self.state, frame)
+		elif self.state is None:
+			self._bootstrap.append(frame.copy())
+			if len(self._bootstrap) == BOOTSTRAP_FRAMES:
+				self.state = self._bootstrap_quantile().astype(np.float32)
+				self._bootstrap = []
+		else:
+			# Equilibrium where a fraction quantile of the frames is below the estimate
+			above = frame > self.state
+			below = frame < self.state
+			self.state += np.float32(2 * self.step * self.quantile) * above
+			self.state -= np.float32(2 * self.step * (1 - self.quantile)) * below
+
+	def _bootstrap_quantile(self) -> np.ndarray:
+		return np.percentile(np.stack(self._bootstrap), self.quantile * 100, axis=0)
+
+	def background(self) -> Optional[np.ndarray]:
+		"""
+		Return the current background.
+
+		Returns:
+		np.ndarray or None
+			The background as uint8, None before the first frame.
+		"""
+		if self.count == 0:
+			return None
+		if self.method == "mean":
+			# Truncated, as the mean of calculate_average always was
+			return np.uint8(self.state / self.count)
+		if self.method == "min":
+			return self.state.astype(np.uint8)
+		state = self.state if self.state is not None else self._bootstrap_quantile()
+		return np.uint8(np.clip(np.rint(state), 0, 255))
+
+
+@dataclass
+class WindowedBackground:
+	"""
+	Backgrounds of consecutive windows of frames, interpolated at the position of every frame.
+
+	backgrounds is a (windows, height, width) uint8 array, or its SharedArray reference while it is passed to worker
+	processes, see run_analyze_all.
+	"""
+
+	backgrounds: Union[np.ndarray, SharedArray]
+	window: int
+
+	def at(self, position: int) -> np.ndarray:
+		"""
+		Background of a frame, interpolated between the backgrounds of the windows whose centres surround it.
+
+		Parameters:
+		position : int
+			Position of the frame in the analysis.
+
+		Returns:
+		np.ndarray
+			The background as uint8.
+		"""
+		last = len(self.backgrounds) - 1
+		centre = (position - (self.window - 1) / 2) / self.window
+		if centre <= 0 or last == 0:
+			return self.backgrounds[0]
+		if centre >= last:
+			return self.backgrounds[last]
+
+		index = int(centre)
+		weight = centre - index
+		return cv2.addWeighted(self.backgrounds[index], 1 - weight, self.backgrounds[index + 1], weight, 0)
+
+
+def compute_background(
+	frames: Iterable,
+	method: str = "mean",
+	percentile: float = DEFAULT_PERCENTILE,
+	window: Optional[int] = None,
+) -> Union[np.ndarray, WindowedBackground, None]:
+	"""
+	Compute a background in one pass over the frames.
+
+	Parameters:
+	frames : Iterable
+		The (position, frame) of the grayscale frames, in order of position, possibly subsampled.
+	method : str, optional
+		One of BACKGROUND_METHODS. Default is "mean".
+	percentile : float, optional
+		Percentile of the "percentile" method. Default is DEFAULT_PERCENTILE.
+	window : int, optional
+		Number of positions per window. Defaults to a single background for all the frames.
+
+	Returns:
+	np.ndarray, WindowedBackground or None
+		The background as uint8, or the backgrounds of the windows with a window. None without frames.
+	"""
+	models = {}
+	for position, frame in frames:
+		key = 0 if window is None else position // window
+		if key not in models:
+			models[key] = BackgroundModel(method, percentile)
+		models[key].update(frame)
+
+	if len(models) == 0:
+		return None
+	if window is None:
+		return models[0].background()
+
+	# Windows without frames, e.g. with a subsampling longer than the window, take the previous background
+	backgrounds = []
+	for key in range(max(models) + 1):
+		backgrounds.append(models[key].background() if key in models else backgrounds[-1])
+	return WindowedBackground(np.stack(backgrounds), window)
+
+
+def read_frames(paths: list, load: Callable, every: int = 1, prefetch: int = PREFETCH_FRAMES) -> Iterator:
+	"""
+	Decode every every-th image of a list, a few at a time on a thread pool.
+
+	Parameters:
+	paths : list
+		The image paths, in order.
+	load : Callable
+		Reads an image path as a grayscale frame.
+	every : int, optional
+		Subsampling of the images. Default is 1.
+	prefetch : int, optional
+		Number of images decoded at once. Default is PREFETCH_FRAMES.
+
+	Yields:
+	tuple
+		The position of each image in paths and its frame.
+	"""
+	positions = range(0, len(paths), every)
+	with ThreadPoolExecutor() as executor:
+		for start in range(0, len(positions), prefetch):
+			chunk = positions[start: start + prefetch]
+			yield from zip(chunk, executor.map(load, [paths[position] for position in chunk]))
+
+
+def stream_frames(
+	video_path,
+	start: int = 0,
+	end: Optional[int] = None,
+	every: int = 1,
+	resize_factor: float = 1.0,
+	subsample: int = 1,
+) -> Iterator:
+	"""
+	Stream every subsample-th frame of the selection of a video, as grayscale frames.
+
+	Parameters:
+	video_path : Path
+		Path of the video.
+	start, end, every, resize_factor :
+		Selection and resizing of the frames of the analysis, see VideoFrameStream.
+	subsample : int, optional
+		Subsampling of the selected frames. Default is 1.
+
+	Yields:
+	tuple
+		The position of each frame in the selection and the frame.
+	"""
+	first = selected_frames(video_path, start, end, every).start
+	with VideoFrameStream(video_path, first, end, every * subsample, resize_factor) as stream:
+		for number, frame in stream:
+			yield (number - first) // every, frame
@@ -4,10 +4,12 @@ from typing import Optional, Tuple
 
 import numpy as np
 from numba import jit
-from scipy.interpolate import griddata
+from scipy.sparse import csr_matrix
+from scipy.spatial import Delaunay, cKDTree
 from tablib import Dataset
 
 import river.core.coordinate_transform as ct
+import river.core.homography as hg
 from river.core.exceptions import NotSupportedFormatError
 
 CSV_FORMAT = "csv"
@@ -18,39 +20,55 @@ XLSX_FORMAT = "xlsx"
 BINARY_FORMATS = [ODS_FORMAT, XLS_FORMAT, XLSX_FORMAT]
 FILE_FORMATS = [CSV_FORMAT] + BINARY_FORMATS
 
+# Number of frames converted and interpolated at once in add_statistics
+STATISTICS_BLOCK_SIZE = 256
 
-@jit(nopython=True)
-def _interpolate_gradient_numba(
-    points: np.ndarray, values: np.ndarray, coords: np.ndarray
-) -> np.ndarray:
+
+def get_cs_nearest_nodes(coord_x, coord_y, X, Y) -> np.ndarray:
     """
-    Numba-optimized nearest neighbor interpolation for gradients.
+    Find the nearest grid node of every station.
+
+    The nodes are indexed with a KD-tree, which works for any layout of the grid, e.g. a PIV grid mapped to
+    real-world coordinates by a homography. The grid does not change between frames, so the returned indices
+    sample every frame with a plain gather.
+
+    Parameters:
+        coord_x, coord_y (1D np.ndarray): Station coordinates.
+        X, Y (2D np.ndarray): Coordinate grid (either pixel or real-world).
+
+    Returns:
+        np.ndarray: Index of the nearest node of each station in the flattened grid.
     """
-    result = np.zeros(len(coords))
+    points = np.column_stack((X.flatten(), Y.flatten()))
+    coords = np.column_stack((np.ravel(coord_x), np.ravel(coord_y)))
 
-    for i in range(len(coords)):
-        # Calculate distances to all points
-        distances = (points[:, 0] - coords[i, 0]) ** 2 + (
-            points[:, 1] - coords[i, 1]
-        ) ** 2
-        # Find nearest point
-        min_idx = np.argmin(distances)
-        result[i] = values[min_idx]
+    _, nodes = cKDTree(points).query(coords)
 
-    return result
+    return nodes
 
 
-def get_cs_gradient_optimized(coord_x, coord_y, X, Y, gradient_values):
+def get_cs_gradient_optimized(coord_x, coord_y, X, Y, gradient_values, nodes=None):
     """
-    Optimized version of get_cs_gradient using Numba.
+    Nearest-neighbour version of get_cs_gradient.
+
+    Parameters:
+        coord_x, coord_y (1D np.ndarray): Station coordinates.
+        X, Y (2D np.ndarray): Coordinate grid (either pixel or real-world).
+        gradient_values (np.ndarray): Gradient values with the shape of X, or a stack of them with the frames
+            along the first axis.
+        nodes (np.ndarray, optional): Nearest nodes returned by get_cs_nearest_nodes for these stations and grid.
+            Computed if not given.
+
+    Returns:
+        np.ndarray: Gradient values of the nearest node of each station, one row per frame for a stack.
     """
-    # Prepare points for interpolation
-    points = np.column_stack((X.flatten(), Y.flatten()))
-    gradient_values_flat = gradient_values.flatten()
-    coords = np.column_stack((coord_x, coord_y))
+    if nodes is None:
+        nodes = get_cs_nearest_nodes(coord_x, coord_y, X, Y)
+
+    gradient_values = np.asarray(gradient_values)
+    frames_shape = gradient_values.shape[: gradient_values.ndim - np.ndim(X)]
 
-    # Use Numba-optimized interpolation
-    return _interpolate_gradient_numba(points, gradient_values_flat, coords)
+    return gradient_values.reshape(frames_shape + (-1,))[..., nodes]
 
 
 @jit(nopython=True)
@@ -115,71 +133,6 @@ def get_artificial_seeded_profile_optimized(
     return mean_profile
 
 
-@jit(nopython=True)
-def transform_pixel_to_real_world_numba(
-    x_pix: float, y_pix: float, transformation_matrix: np.ndarray
-) -> np.ndarray:
-    """
-    Numba version of transform_pixel_to_real_world that exactly matches the original in coordinate_transform.py.
-    """
-    # Create pixel coordinate vector
-    pixel_vector = np.array([x_pix, y_pix, 1.0])
-
-    # Calculate real-world coordinates
-    real_world_vector = np.zeros(3)
-    for i in range(3):
-        for j in range(3):
-            real_world_vector[i] += transformation_matrix[i, j] * pixel_vector[j]
-
-    # Normalize by dividing by homogeneous component
-    if real_world_vector[2] != 0:
-        real_world_vector = real_world_vector / real_world_vector[2]
-
-    # Return only x and y coordinates
-    return real_world_vector[:2]
-
-
-@jit(nopython=True)
-def convert_displacement_field_numba(
-    X: np.ndarray[np.float64],
-    Y: np.ndarray[np.float64],
-    U: np.ndarray[np.float64],
-    V: np.ndarray[np.float64],
-    transformation_matrix: np.ndarray[np.float64],
-) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
-    """
-    Numba version of convert_displacement_field from coordinate_transform.py.
-    """
-    rows, cols = X.shape
-
-    # Initialize output arrays
-    EAST = np.zeros((rows, cols))
-    NORTH = np.zeros((rows, cols))
-    Displacement_EAST = np.zeros((rows, cols))
-    Displacement_NORTH = np.zeros((rows, cols))
-
-    # Process each point
-    for i in range(rows):
-        for j in range(cols):
-            # Convert original coordinates
-            coords = transform_pixel_to_real_world_numba(
-                X[i, j], Y[i, j], transformation_matrix
-            )
-            EAST[i, j] = coords[0]
-            NORTH[i, j] = coords[1]
-
-            # Convert displaced coordinates
-            displaced_coords = transform_pixel_to_real_world_numba(
-                X[i, j] + U[i, j], Y[i, j] + V[i, j], transformation_matrix
-            )
-
-            # Calculate displacements
-            Displacement_EAST[i, j] = displaced_coords[0] - EAST[i, j]
-            Displacement_NORTH[i, j] = displaced_coords[1] - NORTH[i, j]
-
-    return EAST, NORTH, Displacement_EAST, Displacement_NORTH
-
-
 def calculate_station_coordinates(
     east_l: float,
     north_l: float,
@@ -370,22 +323,54 @@ def add_pixel_coordinates(results: dict, transformation_matrix: np.ndarray):
     Returns:
         dict: Updated station dictionary with pixel coordinates as NumPy arrays.
     """
-    # Pre-allocate arrays for pixel coordinates
-    num_stations = len(results["east"])
-    results["x"] = np.zeros(num_stations)
-    results["y"] = np.zeros(num_stations)
-
-    # Iterate through the stations and calculate pixel coordinates
-    for i, (east, north) in enumerate(zip(results["east"], results["north"])):
-        pixel_coords = ct.transform_real_world_to_pixel(
-            east, north, transformation_matrix
-        )
-        results["x"][i] = pixel_coords[0]
-        results["y"][i] = pixel_coords[1]
+    # Calculate the pixel coordinates of all the stations at once
+    results["x"], results["y"] = hg.real_world_to_pixel(
+        results["east"], results["north"], transformation_matrix
+    )
 
     return results
 
 
+def get_cs_interpolation_weights(coord_x, coord_y, X, Y) -> csr_matrix:
+    """
+    Compute the linear interpolation weights of a set of station coordinates over a coordinate grid.
+
+    The grid is triangulated once and every station gets the barycentric weights of the triangle that contains
+    it, which gives the same values as griddata(..., method="linear") for any values defined on the grid.
+
+    Parameters:
+        coord_x, coord_y (1D np.ndarray): Station coordinates.
+        X, Y (2D np.ndarray): Coordinate grid (either pixel or real-world).
+
+    Returns:
+        csr_matrix: Sparse (stations, grid points) matrix, so that weights @ values.flatten() interpolates the
+        values at the stations. Stations outside the grid get a NaN weight, so their interpolated values are NaN.
+    """
+    points = np.column_stack((X.flatten(), Y.flatten()))
+    coords = np.column_stack((np.ravel(coord_x), np.ravel(coord_y))).astype(np.float64)
+
+    triangulation = Delaunay(points)
+    simplex = triangulation.find_simplex(coords)
+    inside = np.flatnonzero(simplex >= 0)
+    outside = np.flatnonzero(simplex < 0)
+
+    # Barycentric coordinates of the stations inside the grid
+    transform = triangulation.transform[simplex[inside]]
+    barycentric = np.einsum(
+        "ijk,ik->ij", transform[:, :2], coords[inside] - transform[:, 2]
+    )
+    weights = np.column_stack((barycentric, 1 - barycentric.sum(axis=1)))
+
+    # Zero weights are kept so that NaN values propagate as they do with griddata
+    rows = np.concatenate((np.repeat(inside, 3), outside))
+    cols = np.concatenate(
+        (triangulation.simplices[simplex[inside]].ravel(), np.zeros(len(outside), dtype=int))
+    )
+    data = np.concatenate((weights.ravel(), np.full(len(outside), np.nan)))
+
+    return csr_matrix((data, (rows, cols)), shape=(len(coords), len(points)))
+
+
 def get_cs_displacements(coord_x, coord_y, X, Y, displacement_X, displacement_Y):
     """
     Compute interpolated displacement values for a set of station coordinates.
@@ -399,17 +384,10 @@ def get_cs_displacements(coord_x, coord_y, X, Y, displacement_X, displacement_Y)
     Returns:
         np.ndarray, np.ndarray: Interpolated displacements in the x/east and y/north directions.
     """
-    # Flatten the grids and displacements into 1D arrays for griddata
-    points = np.column_stack((X.flatten(), Y.flatten()))
-    dist_x_values = displacement_X.flatten()
-    dist_y_values = displacement_Y.flatten()
+    weights = get_cs_interpolation_weights(coord_x, coord_y, X, Y)
 
-    interpolated_displacements_x = griddata(
-        points, dist_x_values, (coord_x, coord_y), method="linear"
-    )
-    interpolated_displacements_y = griddata(
-        points, dist_y_values, (coord_x, coord_y), method="linear"
-    )
+    interpolated_displacements_x = weights @ displacement_X.flatten()
+    interpolated_displacements_y = weights @ displacement_Y.flatten()
 
     return interpolated_displacements_x, interpolated_displacements_y
 
@@ -624,22 +602,16 @@ def get_pix_displacement(
         displacement_x (np.ndarray): Streamwise pixel displacement component in the x direction.
         displacement_y (np.ndarray): Streamwise pixel displacement component in the y direction.
     """
-    # Initialize arrays to hold the pixel displacement components
-    displacement_x = np.zeros_like(displacement_east)
-    displacement_y = np.zeros_like(displacement_north)
-
-    # Iterate over each displacement component
-    for i in range(len(displacement_east)):
-        # Convert real-world streamwise displacements to pixel coordinates
-        pixel_streamwise = ct.transform_real_world_to_pixel(
-            table_results["east"][i] + displacement_east[i],
-            table_results["north"][i] + displacement_north[i],
-            transformation_matrix,
-        )
+    # Convert real-world streamwise displacements to pixel coordinates
+    pixel_x, pixel_y = hg.real_world_to_pixel(
+        table_results["east"] + displacement_east,
+        table_results["north"] + displacement_north,
+        transformation_matrix,
+    )
 
-        # Calculate streamwise pixel displacement components
-        displacement_x[i] = pixel_streamwise[0] - table_results["x"][i]
-        displacement_y[i] = pixel_streamwise[1] - table_results["y"][i]
+    # Calculate streamwise pixel displacement components
+    displacement_x = pixel_x - table_results["x"]
+    displacement_y = pixel_y - table_results["y"]
 
     return displacement_x, displacement_y
 
@@ -1045,16 +1017,10 @@ def get_cs_gradient(coord_x, coord_y, X, Y, gradient_values):
             interpolated_gradient_values : np.ndarray
                     Interpolated gradient values at the specified coordinates.
     """
-    # Stack X and Y coordinates into points for interpolation
-    points = np.column_stack((X.flatten(), Y.flatten()))
-
-    # Flatten gradient values to align with flattened coordinate points
-    gradient_values_flat = gradient_values.flatten()
+    weights = get_cs_interpolation_weights(coord_x, coord_y, X, Y)
 
     # Interpolate gradient values at the specified coordinates
-    interpolated_gradient_values = griddata(
-        points, gradient_values_flat, (coord_x, coord_y), method="linear"
-    )
+    interpolated_gradient_values = weights @ gradient_values.flatten()
 
     return interpolated_gradient_values
 
@@ -1114,74 +1080,139 @@ def get_general_statistics(x_sections: dict) -> dict:
     return x_sections
 
 
-def add_statistics(
+def add_node_statistics(
     results: dict,
     table_results: dict,
     transformation_matrix: np.ndarray,
     time_between_frames: float,
     rw_to_xsection: np.ndarray,
 ) -> dict:
-    """ """
-    # Convert inputs to proper numpy arrays
-    xtable = np.asarray(results["x"], dtype=np.float64).reshape(results["shape"])
-    ytable = np.asarray(results["y"], dtype=np.float64).reshape(results["shape"])
+    """
+    Estimate the statistics of add_statistics from results that only hold per-vector statistics, see
+    piv_statistics.
 
-    u_all = np.asarray(results["u"], dtype=np.float64).reshape(
-        (len(results["u"]),) + tuple(results["shape"])
+    The direction of the flow at each vector is taken as steady, so the percentiles of u and v occur in the same
+    pairs and map to the percentiles of the streamwise velocity, and the standard deviation of the speed lies along
+    the mean direction. The seeded profile needs the per-pair gradients and is NaN.
+
+    Parameters:
+        results (dict): PIV results with the per-vector statistics of u and v.
+        table_results (dict): Stations of the cross-section, with their median velocities.
+        transformation_matrix (np.ndarray): Transformation matrix from pixel to real-world coordinates.
+        time_between_frames (float): Time interval between frames in the PIV analysis.
+        rw_to_xsection (np.ndarray): Transformation matrix from real-world to cross-section coordinates.
+
+    Returns:
+        dict: The updated table_results.
+    """
+    xtable = np.asarray(results["x"], dtype=np.float64).reshape(1, -1)
+    ytable = np.asarray(results["y"], dtype=np.float64).reshape(1, -1)
+
+    EAST, NORTH = hg.pixel_to_real_world(xtable, ytable, transformation_matrix)
+    weights = get_cs_interpolation_weights(
+        table_results["east"], table_results["north"], EAST, NORTH
     )
-    v_all = np.asarray(results["v"], dtype=np.float64).reshape(
-        (len(results["v"]),) + tuple(results["shape"])
+
+    def streamwise_velocity(U, V):
+        _, _, displacement_east, displacement_north = hg.convert_displacements(
+            xtable, ytable, U.reshape(1, -1), V.reshape(1, -1), transformation_matrix
+        )
+        _, streamwise = get_streamwise_crosswise(
+            weights @ displacement_east.ravel(), weights @ displacement_north.ravel(), rw_to_xsection
+        )
+        return streamwise / time_between_frames
+
+    def field(name):
+        return np.asarray(results[name], dtype=np.float64).reshape(-1)
+
+    # Speed deviation along the mean direction of each vector
+    u_mean, v_mean = field("u_mean"), field("v_mean")
+    speed = np.hypot(u_mean, v_mean)
+    speed_std = np.hypot(field("u_std"), field("v_std"))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        u_deviation = np.where(speed > 0, speed_std * u_mean / speed, np.nan)
+        v_deviation = np.where(speed > 0, speed_std * v_mean / speed, np.nan)
+    streamwise_vel_magnitude_std = np.abs(
+        streamwise_velocity(u_mean + u_deviation, v_mean + v_deviation) - streamwise_velocity(u_mean, v_mean)
     )
-    grad_all = np.asarray(results["gradient"], dtype=np.float64).reshape(
-        (len(results["gradient"]),) + tuple(results["shape"])
+
+    low = streamwise_velocity(field("u_5th_percentile"), field("v_5th_percentile"))
+    high = streamwise_velocity(field("u_95th_percentile"), field("v_95th_percentile"))
+
+    table_results["minus_std"] = (
+        table_results["streamwise_velocity_magnitude"] - streamwise_vel_magnitude_std
     )
+    table_results["plus_std"] = (
+        table_results["streamwise_velocity_magnitude"] + streamwise_vel_magnitude_std
+    )
+    # A flow towards the negative streamwise direction swaps the percentiles
+    table_results["5th_percentile"] = np.fmin(low, high)
+    table_results["95th_percentile"] = np.fmax(low, high)
+    table_results["seeded_vel_profile"] = np.full(weights.shape[0], np.nan)
+
+    return table_results
+
+
+def add_statistics(
+    results: dict,
+    table_results: dict,
+    transformation_matrix: np.ndarray,
+    time_between_frames: float,
+    rw_to_xsection: np.ndarray,
+) -> dict:
+    """ """
+    if "u" not in results:
+        # Results computed without keeping the per-pair fields
+        return add_node_statistics(
+            results, table_results, transformation_matrix, time_between_frames, rw_to_xsection
+        )
+
+    # Convert inputs to proper numpy arrays
+    xtable = np.asarray(results["x"], dtype=np.float64).reshape(1, -1)
+    ytable = np.asarray(results["y"], dtype=np.float64).reshape(1, -1)
 
     transformation_matrix = np.asarray(transformation_matrix, dtype=np.float64)
     rw_to_xsection = np.asarray(rw_to_xsection, dtype=np.float64)
 
+    # The PIV grid is the same for every frame, so the stations are located on it only once
+    EAST, NORTH = hg.pixel_to_real_world(xtable, ytable, transformation_matrix)
+    weights = get_cs_interpolation_weights(
+        table_results["east"], table_results["north"], EAST, NORTH
+    )
+
     # Pre-allocate arrays for results
-    n_frames = len(u_all)
-    streamwise_vel_magnitude_list = []
-    gradient_list = []
-
-    # Process frames
-    for num in range(n_frames):
-        U = u_all[num]
-        V = v_all[num]
-        GRAD = grad_all[num]
-
-        # Convert displacement field using Numba-optimized function
-        EAST, NORTH, displacement_east, displacement_north = (
-            convert_displacement_field_numba(
-                xtable, ytable, U, V, transformation_matrix
-            )
+    n_frames = len(results["u"])
+    n_stations = weights.shape[0]
+    streamwise_vel_magnitude_array = np.empty((n_frames, n_stations))
+    gradient_array = np.empty((n_frames, n_stations))
+
+    # Process frames by blocks, one row per frame
+    for start in range(0, n_frames, STATISTICS_BLOCK_SIZE):
+        end = min(start + STATISTICS_BLOCK_SIZE, n_frames)
+        U = np.asarray(results["u"][start:end], dtype=np.float64).reshape(end - start, -1)
+        V = np.asarray(results["v"][start:end], dtype=np.float64).reshape(end - start, -1)
+        GRAD = np.asarray(results["gradient"][start:end], dtype=np.float64).reshape(
+            end - start, -1
         )
 
-        # Use original functions for the rest to maintain exact results
-        disp_east, disp_north = get_cs_displacements(
-            table_results["east"],
-            table_results["north"],
-            EAST,
-            NORTH,
-            displacement_east,
-            displacement_north,
+        # Convert the displacement fields of the whole block at once
+        _, _, displacement_east, displacement_north = hg.convert_displacements(
+            xtable, ytable, U, V, transformation_matrix
         )
 
+        # Interpolate every frame of the block at the stations, one column per frame
+        disp_east = (weights @ displacement_east.T).T
+        disp_north = (weights @ displacement_north.T).T
+
         crosswise, streamwise = get_streamwise_crosswise(
-            disp_east, disp_north, rw_to_xsection
+            disp_east.ravel(), disp_north.ravel(), rw_to_xsection
         )
 
         # Store results
-        streamwise_vel_magnitude_list.append(streamwise / time_between_frames)
-        gradient_list.append(
-            get_cs_gradient(
-                table_results["east"], table_results["north"], EAST, NORTH, GRAD
-            )
+        streamwise_vel_magnitude_array[start:end] = (
+            streamwise.reshape(end - start, n_stations) / time_between_frames
         )
-
-    # Convert lists to arrays
-    streamwise_vel_magnitude_array = np.array(streamwise_vel_magnitude_list)
-    gradient_array = np.array(gradient_list)
+        gradient_array[start:end] = (weights @ GRAD.T).T
 
     # Calculate statistics
     streamwise_vel_magnitude_std = np.std(streamwise_vel_magnitude_array, axis=0)
@@ -0,0 +1,163 @@
+"""
+File Name: concurrency.py
+Project Name: RIVeR-LAC
+Description: Split a core budget between worker processes and the thread pools of the libraries they call.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+Each PIV worker calls pyFFTW, OpenCV and NumPy/SciPy (BLAS), and each of them starts its own thread pool sized to
+the whole machine by default. With several workers this oversubscribes the cores many times over. A
+ConcurrencyBudget gives every worker a fixed number of threads, applied to all these pools when the worker starts.
+"""
+
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import cv2
+import pyfftw
+
+from river.core.fftw_wisdom import import_fftw_wisdom
+
+try:
+	from threadpoolctl import threadpool_limits
+except ImportError:  # Optional: without it, BLAS pools are only limited in processes started afterwards
+	threadpool_limits = None
+
+# Upper bound on the number of worker processes picked automatically
+MAX_WORKERS = 8
+
+# Environment variables read by the BLAS and OpenMP runtimes when they load
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+
+
+@dataclass
+class ConcurrencyBudget:
+	"""Number of worker processes and of library threads inside each of them."""
+
+	workers: int
+	threads_per_worker: int
+
+	@property
+	def cores(self) -> int:
+		return self.workers * self.threads_per_worker
+
+
+def available_cores() -> int:
+	"""Number of cores this process may run on, honouring CPU affinity when the platform reports it."""
+	if hasattr(os, "sched_getaffinity"):
+		return len(os.sched_getaffinity(0))
+	return os.cpu_count() or 1
+
+
+def resolve_budget(
+		workers: Optional[int] = None,
+		threads_per_worker: Optional[int] = None,
+		cores: Union[int, str, None] = None,
+		max_workers: int = MAX_WORKERS,
+) -> ConcurrencyBudget:
+	"""
+	Split a core budget between processes and threads.
+
+	Without any setting, there is one single-threaded worker per core, up to max_workers, and the cores left over
+	are given to the threads of the workers. Explicit values are kept as they are.
+
+	Parameters:
+	workers : int, optional
+		Number of worker processes.
+	threads_per_worker : int, optional
+		Number of library threads in each worker.
+	cores : int or "auto", optional
+		Total number of cores to use. Defaults to the available cores.
+	max_workers : int, optional
+		Largest number of workers picked automatically. Default is MAX_WORKERS.
+
+	Returns:
+	ConcurrencyBudget
+		The resolved budget.
+	"""
+	if cores is None or cores == "auto":
+		cores = available_cores()
+	cores = max(1, int(cores))
+
+	if workers is None:
+		if threads_per_worker is None:
+			workers = min(max_workers, cores)
+		else:
+			workers = min(max_workers, max(1, cores // threads_per_worker))
+	if threads_per_worker is None:
+		threads_per_worker = max(1, cores // workers)
+
+	if workers < 1 or threads_per_worker < 1:
+		raise ValueError("The number of workers and of threads per worker must be at least 1.")
+
+	return ConcurrencyBudget(workers=int(workers), threads_per_worker=int(threads_per_worker))
+
+
+def apply_thread_limits(threads: int) -> Optional[object]:
+	"""
+	Size the thread pools of pyFFTW, OpenCV and BLAS of the current process.
+
+	The BLAS limit is applied through threadpoolctl when it is installed. The environment variables are set as well,
+	so that processes started afterwards load their BLAS and OpenMP runtimes with the same limit.
+
+	Parameters:
+	threads : int
+		Number of threads of every pool.
+
+	Returns:
+	object or None
+		The threadpoolctl limiter, whose restore_original_limits undoes the BLAS limit, or None without threadpoolctl.
+	"""
+	pyfftw.config.NUM_THREADS = threads
+	cv2.setNumThreads(threads)
+	for variable in THREAD_VARIABLES:
+		os.environ[variable] = str(threads)
+	if threadpool_limits is not None:
+		return threadpool_limits(threads)
+	return None
+
+
+@contextmanager
+def thread_limits(threads: int):
+	"""
+	Apply apply_thread_limits within a block and restore the previous pyFFTW and OpenCV settings afterwards, so that
+	an embedding application keeps its own configuration.
+
+	Parameters:
+	threads : int
+		Number of threads of every pool.
+	"""
+	fftw_threads = pyfftw.config.NUM_THREADS
+	cv2_threads = cv2.getNumThreads()
+	environment = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+
+	blas_limits = apply_thread_limits(threads)
+	try:
+		yield
+	finally:
+		pyfftw.config.NUM_THREADS = fftw_threads
+		cv2.setNumThreads(cv2_threads)
+		for variable, value in environment.items():
+			if value is None:
+				os.environ.pop(variable, None)
+			else:
+				os.environ[variable] = value
+		if blas_limits is not None:
+			blas_limits.restore_original_limits()
+
+
+def initialize_worker(threads: int):
+	"""
+	Initializer of the PIV worker processes: size their thread pools and load the cached FFTW wisdom.
+
+	Parameters:
+	threads : int
+		Number of threads of every pool of the worker.
+	"""
+	apply_thread_limits(threads)
+	import_fftw_wisdom()
@@ -7,6 +7,7 @@ import numpy as np
 from scipy.optimize import minimize
 import math
 
+import river.core.homography as hg
 from river.core.exceptions import OptimalCameraMatrixError
 
 
@@ -181,9 +182,7 @@ def orthorectify_image_with_size_limit(
 	# Convert ROI corners to real-world coordinates to determine extent
 	corners = [(x_min, y_min), (x_max, y_min), (x_min, y_max), (x_max, y_max)]
 
-	real_world_corners = [transform_pixel_to_real_world(x, y, transformation_matrix) for x, y in corners]
-	rw_x_coords = [corner[0] for corner in real_world_corners]
-	rw_y_coords = [corner[1] for corner in real_world_corners]
+	rw_x_coords, rw_y_coords = hg.pixel_to_real_world(*np.transpose(corners), transformation_matrix)
 
 	# Determine real-world extent
 	x_min_rw, x_max_rw = min(rw_x_coords), max(rw_x_coords)
@@ -231,15 +230,10 @@ def orthorectify_image_with_size_limit(
 
 	RW_X, RW_Y = np.meshgrid(rw_x_coords, rw_y_coords)
 
-	# Transform each real-world coordinate to pixel coordinate
-	map_x = np.zeros((y_size, x_size), dtype=np.float32)
-	map_y = np.zeros((y_size, x_size), dtype=np.float32)
-
-	for i in range(y_size):
-		for j in range(x_size):
-			pixel_coords = transform_real_world_to_pixel(RW_X[i, j], RW_Y[i, j], transformation_matrix)
-			map_x[i, j] = pixel_coords[0]
-			map_y[i, j] = pixel_coords[1]
+	# Transform every real-world coordinate to pixel coordinates
+	map_x, map_y = hg.real_world_to_pixel(RW_X, RW_Y, transformation_matrix)
+	map_x = map_x.astype(np.float32)
+	map_y = map_y.astype(np.float32)
 
 	# Create mask for valid coordinates
 	valid_coords = (map_x >= 0) & (map_x < w) & (map_y >= 0) & (map_y < h)
@@ -349,13 +343,8 @@ def project_points(P: np.ndarray, world_coords: Dict[str, np.ndarray]) -> np.nda
 	Returns:
 		np.ndarray: Array of projected 2D points with shape (n, 2)
 	"""
-	projected_points = []
-	for i in range(len(world_coords["X"])):
-		X = np.array([world_coords["X"][i], world_coords["Y"][i], world_coords["Z"][i], 1])
-		projection = np.dot(P, X)
-		projection = projection / projection[2]
-		projected_points.append([projection[0], projection[1]])
-	return np.array(projected_points)
+	x, y = hg.project_points(P, world_coords["X"], world_coords["Y"], world_coords["Z"])
+	return np.column_stack((x, y))
 
 
 def evaluate_combination(
@@ -939,23 +928,14 @@ def transform_pixel_to_real_world(x_pix: float, y_pix: float, transformation_mat
 	Transform pixel coordinates to 2 components real-world coordinates.
 
 	Parameters:
-		x_pix (float): X coordinate in pixels.
-		y_pix (float): Y coordinate in pixels.
+		x_pix (float or np.ndarray): X coordinate in pixels.
+		y_pix (float or np.ndarray): Y coordinate in pixels.
 		transformation_matrix (np.ndarray): The transformation matrix.
 
 	Returns:
-		np.ndarray: An array containing the real-world coordinates [x, y].
+		np.ndarray: An array containing the real-world coordinates [x, y], stacked along the first axis for arrays.
 	"""
-	# Create the pixel coordinate vector in homogeneous coordinates
-	pixel_vector = np.array([x_pix, y_pix, 1])
-
-	# Calculate the real-world coordinates in homogeneous coordinates
-	real_world_vector = np.dot(transformation_matrix, pixel_vector)
-
-	# Normalize the real-world coordinates
-	real_world_vector /= real_world_vector[2]  # Divide by the third (homogeneous) component
-
-	return real_world_vector[:2]  # Return the x and y real-world coordinates
+	return np.stack(hg.pixel_to_real_world(x_pix, y_pix, transformation_matrix))
 
 
 def transform_real_world_to_pixel(x_rw: float, y_rw: float, transformation_matrix: np.ndarray) -> np.ndarray:
@@ -963,26 +943,14 @@ def transform_real_world_to_pixel(x_rw: float, y_rw: float, transformation_matri
 	Transform 2 components real-world coordinates to pixel coordinates.
 
 	Parameters:
-		x_rw (float): X coordinate in real-world units.
-		y_rw (float): Y coordinate in real-world units.
+		x_rw (float or np.ndarray): X coordinate in real-world units.
+		y_rw (float or np.ndarray): Y coordinate in real-world units.
 		transformation_matrix (np.ndarray): The transformation matrix.
 
 	Returns:
-		np.ndarray: An array containing the pixel coordinates [x, y].
+		np.ndarray: An array containing the pixel coordinates [x, y], stacked along the first axis for arrays.
 	"""
-	# Invert the transformation matrix to map from pixel to real-world coordinates
-	inv_transformation_matrix = np.linalg.inv(transformation_matrix)
-
-	# Create the real-world coordinate vector in homogeneous coordinates
-	real_world_vector = np.array([x_rw, y_rw, 1])
-
-	# Calculate the pixel coordinates in homogeneous coordinates
-	pixel_vector = np.dot(inv_transformation_matrix, real_world_vector)
-
-	# Normalize the pixel coordinates
-	pixel_vector /= pixel_vector[2]  # Divide by the third (homogeneous) component
-
-	return pixel_vector[:2]
+	return np.stack(hg.real_world_to_pixel(x_rw, y_rw, transformation_matrix))
 
 
 def convert_displacement_field(
@@ -993,38 +961,14 @@ def convert_displacement_field(
 
 	Parameters:
 		X, Y (2D np.ndarray): Pixel coordinates.
-		U, V (2D np.ndarray): Pixel displacements.
+		U, V (np.ndarray): Pixel displacements, one 2D field or a (frames, rows, cols) stack of fields.
 		transformation_matrix (np.ndarray): Transformation matrix from pixel to real-world coordinates.
 
 	Returns:
-		EAST, NORTH, Displacement_EAST, Displacement_NORTH (all 2D np.ndarrays): Real-world coordinates and displacements.
+		EAST, NORTH (2D np.ndarrays): Real-world coordinates.
+		Displacement_EAST, Displacement_NORTH (np.ndarrays): Real-world displacements, with the shape of U and V.
 	"""
-	# Get the shape of the input matrices
-	rows, cols = X.shape
-
-	# Initialize the output matrices
-	EAST = np.zeros((rows, cols))
-	NORTH = np.zeros((rows, cols))
-	Displacement_EAST = np.zeros((rows, cols))
-	Displacement_NORTH = np.zeros((rows, cols))
-
-	# Iterate through each point in the matrices
-	for i in range(rows):
-		for j in range(cols):
-			# Convert pixel coordinates (X, Y) to real-world coordinates (EAST, NORTH)
-			east_north = transform_pixel_to_real_world(X[i, j], Y[i, j], transformation_matrix)
-			EAST[i, j], NORTH[i, j] = east_north
-
-			# Convert the displaced pixel coordinates (X + U, Y + V) to real-world coordinates
-			displaced_east_north = transform_pixel_to_real_world(
-				X[i, j] + U[i, j], Y[i, j] + V[i, j], transformation_matrix
-			)
-
-			# Calculate the real-world displacement
-			Displacement_EAST[i, j] = displaced_east_north[0] - east_north[0]
-			Displacement_NORTH[i, j] = displaced_east_north[1] - east_north[1]
-
-	return EAST, NORTH, Displacement_EAST, Displacement_NORTH
+	return hg.convert_displacements(X, Y, U, V, transformation_matrix)
 
 
 def optimize_coordinates(d12: float, d23: float, d34: float, d41: float, d13: float, d24: float):
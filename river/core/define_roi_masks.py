@@ -17,7 +17,7 @@ import cv2
 import numpy as np
 import scipy.optimize as opt
 
-import river.core.coordinate_transform as ct
+import river.core.homography as hg
 from river.core import exceptions
 
 logger = getLogger()
@@ -79,11 +79,9 @@ def rw_box_to_pixel(rw_box: np.ndarray, transformation_matrix: np.ndarray) -> np
 	Returns:
 	    np.ndarray: Coordinates of the rectangle corners in pixel units.
 	"""
-	pixel_box = np.zeros((rw_box.shape[0], 2))
-	for i, (x_rw, y_rw) in enumerate(rw_box):
-		pixel_box[i] = ct.transform_real_world_to_pixel(x_rw, y_rw, transformation_matrix)
+	x_pix, y_pix = hg.real_world_to_pixel(rw_box[:, 0], rw_box[:, 1], transformation_matrix)
 
-	return pixel_box
+	return np.column_stack((x_pix, y_pix))
 
 
 def create_mask(image: np.ndarray, pixel_box: np.ndarray) -> np.ndarray:
@@ -0,0 +1,121 @@
+"""
+File Name: fftw_wisdom.py
+Project Name: RIVeR-LAC
+Description: Persistent FFTW wisdom shared by the runs and the worker processes.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+FFTW plans every transform size the first time it is used. With a measuring planner effort, e.g.
+PYFFTW_PLANNER_EFFORT=FFTW_MEASURE, this costs far more than a correlation pass. The plans are kept as wisdom in a
+cache folder, one file per pyFFTW version and CPU, so that every worker process and every later run (e.g. the
+repeated piv-test previews of the GUI) plans the same sizes instantly. The folder defaults to ~/.cache/river/fftw
+and can be moved with the RIVER_CACHE_DIR environment variable.
+
+The default FFTW_ESTIMATE effort keeps the results reproducible: measured plans may pick other algorithms, whose
+rounding differences can move ambiguous correlation peaks.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import pyfftw
+
+CACHE_DIR_VARIABLE = "RIVER_CACHE_DIR"
+
+
+def cpu_signature() -> str:
+	"""Describe the CPU the wisdom was measured on: architecture, model and number of cores."""
+	model = platform.processor()
+	try:
+		with open("/proc/cpuinfo") as cpuinfo:
+			for line in cpuinfo:
+				if line.startswith("model name"):
+					model = line.split(":", 1)[1].strip()
+					break
+	except OSError:
+		pass
+
+	return f"{platform.machine()}|{model}|{os.cpu_count()}"
+
+
+def wisdom_file(directory: Optional[Path] = None) -> Path:
+	"""
+	Path of the wisdom file of this pyFFTW version and CPU.
+
+	Parameters:
+	directory : Path, optional
+		Cache folder. Defaults to $RIVER_CACHE_DIR/fftw, or ~/.cache/river/fftw.
+
+	Returns:
+	Path
+		The wisdom file, which may not exist yet.
+	"""
+	if directory is None:
+		cache_dir = os.environ.get(CACHE_DIR_VARIABLE)
+		directory = Path(cache_dir) if cache_dir else Path.home().joinpath(".cache", "river")
+		directory = directory.joinpath("fftw")
+
+	key = hashlib.sha1(f"{pyfftw.__version__}|{cpu_signature()}".encode()).hexdigest()[:12]
+	return Path(directory).joinpath(f"wisdom-{pyfftw.__version__}-{key}.json")
+
+
+def import_fftw_wisdom(directory: Optional[Path] = None) -> bool:
+	"""
+	Load the cached wisdom into FFTW. Missing or unreadable files are ignored, as the cache is only a speed-up.
+
+	Parameters:
+	directory : Path, optional
+		Cache folder, see wisdom_file.
+
+	Returns:
+	bool
+		Whether wisdom was imported.
+	"""
+	try:
+		wisdom = json.loads(wisdom_file(directory).read_text())
+		return any(pyfftw.import_wisdom(tuple(part.encode("ascii") for part in wisdom)))
+	except (OSError, ValueError, TypeError):
+		return False
+
+
+def export_fftw_wisdom(directory: Optional[Path] = None) -> Optional[Path]:
+	"""
+	Save the wisdom of this process, which includes any imported one, to the cache.
+
+	The file is replaced atomically, so concurrent runs never read a partial file. Write errors are ignored.
+
+	Parameters:
+	directory : Path, optional
+		Cache folder, see wisdom_file.
+
+	Returns:
+	Path or None
+		The wisdom file, or None when it could not be written.
+	"""
+	path = wisdom_file(directory)
+	# FFTW wisdom is plain text, one part per precision
+	wisdom = [part.decode("ascii") for part in pyfftw.export_wisdom()]
+
+	try:
+		path.parent.mkdir(parents=True, exist_ok=True)
+		handle, temporary = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+	except OSError:
+		return None
+
+	try:
+		with os.fdopen(handle, "w") as file:
+			json.dump(wisdom, file)
+		os.replace(temporary, path)
+	except OSError:
+		Path(temporary).unlink(missing_ok=True)
+		return None
+
+	return path
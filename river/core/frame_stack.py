@@ -0,0 +1,197 @@
+"""
+File Name: frame_stack.py
+Project Name: RIVeR-LAC
+Description: Lossless, grayscale, ROI-cropped and memory-mappable cache of the frames of a video.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+The PIV only reads the grayscale pixels inside the bbox, yet extracted frames are full-colour JPEGs: every pair
+decodes three times the data it needs, through a lossy codec whose block artefacts correlate between frames. A
+frame stack keeps only what the PIV reads, once, without compression. It is a folder with:
+	header.json     format, version, frame numbers, crop origin and size, and shape of the full frames
+	frames.npy      (frames, height, width) uint8 grayscale array of the cropped frames
+The array is memory-mapped, so a frame is a zero-copy view of the file and only the pages of the frames in use are
+read. A FrameStack pickles as its path, so every worker process maps the same file instead of receiving a copy.
+
+Coordinates in the stack are relative to the crop origin: full-frame masks, backgrounds and bboxes are cropped or
+shifted by it, and the PIV positions are shifted back, see run_analyze_all.
+"""
+
+import json
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from river.core.piv_fftmulti import roi_slices
+from river.core.video_stream import VideoFrameStream, frame_name, selected_frames
+
+STACK_HEADER = "header.json"
+STACK_FRAMES = "frames.npy"
+STACK_FORMAT = "river-frame-stack"
+STACK_VERSION = 1
+
+
+def is_frame_stack(path: Path) -> bool:
+	"""Whether a path is a frame stack folder."""
+	header = Path(path).joinpath(STACK_HEADER)
+	try:
+		return json.loads(header.read_text()).get("format") == STACK_FORMAT
+	except (OSError, ValueError, AttributeError):
+		return False
+
+
+def crop_slices(bbox: Optional[list], frame_shape: tuple) -> tuple:
+	"""
+	Row and column slices of the pixels of a bbox, as the PIV selects them, within the frame.
+
+	The crop starts at the pixel of the bbox corner rounded down: the bbox shifted to the crop then keeps a
+	non-negative corner, which the PIV rounds to the same pixels and positions as in the full frame.
+
+	Parameters:
+	bbox : list, optional
+		The bounding box [x, y, width, height]. Defaults to the whole frame.
+	frame_shape : tuple
+		Shape of the full frames.
+
+	Returns:
+	tuple
+		The row slice and the column slice.
+	"""
+	slice_y, slice_x = roi_slices(bbox or [], frame_shape)
+	height, width = frame_shape[:2]
+	x, y = (int(np.floor(bbox[0])), int(np.floor(bbox[1]))) if bbox else (0, 0)
+	return slice(max(y, 0), min(slice_y.stop, height)), slice(max(x, 0), min(slice_x.stop, width))
+
+
+def write_frame_stack(
+	video_path: Path,
+	path: Path,
+	bbox: Optional[list] = None,
+	start: int = 0,
+	end: Optional[int] = None,
+	every: int = 1,
+	resize_factor: float = 1.0,
+) -> int:
+	"""
+	Decode the selected frames of a video into a frame stack.
+
+	Parameters:
+	video_path : Path
+		Path of the video.
+	path : Path
+		The stack folder. It is created if needed and an existing stack is replaced.
+	bbox : list, optional
+		The bounding box [x, y, width, height] to keep, in pixels of the resized frames. Defaults to the whole frame.
+	start, end, every, resize_factor :
+		Selection and resizing of the frames, as in video_to_frames.
+
+	Returns:
+	int
+		Count of the saved frames.
+	"""
+	path = Path(path)
+	path.mkdir(parents=True, exist_ok=True)
+	# A stack without its header is never read, even if writing fails halfway
+	path.joinpath(STACK_HEADER).unlink(missing_ok=True)
+
+	capacity = len(selected_frames(video_path, start, end, every))
+	frames = None
+	frame_numbers = []
+	with VideoFrameStream(video_path, start, end, every, resize_factor) as stream:
+		for number, frame in stream:
+			if frames is None:
+				frame_shape = frame.shape
+				slice_y, slice_x = crop_slices(bbox, frame_shape)
+				frames = np.lib.format.open_memmap(
+					path.joinpath(STACK_FRAMES),
+					mode="w+",
+					dtype=np.uint8,
+					shape=(capacity, slice_y.stop - slice_y.start, slice_x.stop - slice_x.start),
+				)
+			frames[len(frame_numbers)] = frame[slice_y, slice_x]
+			frame_numbers.append(number)
+
+	if frames is None:
+		return 0
+	frames.flush()
+	del frames
+
+	header = {
+		"format": STACK_FORMAT,
+		"version": STACK_VERSION,
+		"video": Path(video_path).name,
+		"frames": frame_numbers,
+		"origin": [slice_x.start, slice_y.start],
+		"size": [slice_x.stop - slice_x.start, slice_y.stop - slice_y.start],
+		"frame_shape": [int(size) for size in frame_shape[:2]],
+		"resize_factor": resize_factor,
+	}
+	path.joinpath(STACK_HEADER).write_text(json.dumps(header))
+	return len(frame_numbers)
+
+
+class FrameStack:
+	"""
+	Read-only view of a frame stack. Indexing returns a frame as a view of the memory-mapped file.
+	"""
+
+	def __init__(self, path: Path):
+		"""
+		Parameters:
+		path : Path
+			The stack folder written by write_frame_stack.
+		"""
+		self.path = Path(path)
+		self.header = json.loads(self.path.joinpath(STACK_HEADER).read_text())
+		if self.header.get("format") != STACK_FORMAT:
+			raise ValueError(f"{self.path} does not contain a frame stack")
+		self.frame_numbers = list(self.header["frames"])
+		self.origin = tuple(self.header["origin"])
+		self.frame_shape = tuple(self.header["frame_shape"])
+		# The frame count of the video is approximate, so the file may have room for more frames
+		self.frames = np.load(self.path.joinpath(STACK_FRAMES), mmap_mode="r")[: len(self.frame_numbers)]
+
+	def __reduce__(self):
+		# Worker processes map the file themselves
+		return FrameStack, (self.path,)
+
+	def __len__(self) -> int:
+		return len(self.frame_numbers)
+
+	def __getitem__(self, index: int) -> np.ndarray:
+		return self.frames[index]
+
+	@property
+	def names(self) -> list:
+		"""Names of the JPEGs video_to_frames would write for the frames."""
+		return [frame_name(number) for number in self.frame_numbers]
+
+	def crop(self, array: np.ndarray) -> np.ndarray:
+		"""Crop a full-frame array, such as a mask or a background, to the pixels of the stack."""
+		x, y = self.origin
+		height, width = self.frames.shape[1:]
+		return array[y: y + height, x: x + width]
+
+	def shift_bbox(self, bbox: list) -> list:
+		"""
+		Express a full-frame bbox in the coordinates of the stack.
+
+		Parameters:
+		bbox : list
+			The bounding box [x, y, width, height] of the full frames.
+
+		Returns:
+		list
+			The bounding box relative to the crop origin.
+		"""
+		slice_y, slice_x = roi_slices(bbox, self.frame_shape)
+		x, y = self.origin
+		height, width = self.frames.shape[1:]
+		if bbox[0] < x or bbox[1] < y or slice_x.stop > x + width or slice_y.stop > y + height:
+			raise ValueError(f"The bbox {list(bbox)} is not inside the crop of the frame stack {self.path}")
+		return [bbox[0] - x, bbox[1] - y, bbox[2], bbox[3]]
+
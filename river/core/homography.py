@@ -0,0 +1,123 @@
+"""
+File Name: homography.py
+Project Name: RIVeR-LAC
+Description: Array-oriented application of homographies and camera matrices.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+Every function takes coordinates as arrays of any broadcastable shape (a point, a station line, a PIV grid or a
+(frames, ny, nx) stack of it) and maps all of them in one vectorized operation.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+
+def apply_homography(
+	homography: np.ndarray, x: np.ndarray, y: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Map 2D points through a 3x3 homography.
+
+	Parameters:
+		homography (np.ndarray): The 3x3 matrix.
+		x, y (np.ndarray): Coordinates of the points, of any broadcastable shapes.
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: The mapped x and y coordinates, with the broadcast shape of x and y.
+	"""
+	h = np.asarray(homography, dtype=np.float64)
+	x = np.asarray(x, dtype=np.float64)
+	y = np.asarray(y, dtype=np.float64)
+
+	w = h[2, 0] * x + h[2, 1] * y + h[2, 2]
+	x_out = (h[0, 0] * x + h[0, 1] * y + h[0, 2]) / w
+	y_out = (h[1, 0] * x + h[1, 1] * y + h[1, 2]) / w
+
+	return x_out, y_out
+
+
+def pixel_to_real_world(
+	x_pix: np.ndarray, y_pix: np.ndarray, transformation_matrix: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Transform pixel coordinates to 2 components real-world coordinates.
+
+	Parameters:
+		x_pix, y_pix (np.ndarray): Pixel coordinates.
+		transformation_matrix (np.ndarray): The pixel to real-world transformation matrix.
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: The real-world x and y coordinates.
+	"""
+	return apply_homography(transformation_matrix, x_pix, y_pix)
+
+
+def real_world_to_pixel(
+	x_rw: np.ndarray, y_rw: np.ndarray, transformation_matrix: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Transform 2 components real-world coordinates to pixel coordinates.
+
+	Parameters:
+		x_rw, y_rw (np.ndarray): Real-world coordinates.
+		transformation_matrix (np.ndarray): The pixel to real-world transformation matrix, which is inverted.
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: The pixel x and y coordinates.
+	"""
+	return apply_homography(np.linalg.inv(transformation_matrix), x_rw, y_rw)
+
+
+def convert_displacements(
+	X: np.ndarray, Y: np.ndarray, U: np.ndarray, V: np.ndarray, transformation_matrix: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+	"""
+	Convert a pixel displacement field to a real-world displacement field.
+
+	Parameters:
+		X, Y (np.ndarray): Pixel coordinates of the vectors, e.g. a (ny, nx) grid.
+		U, V (np.ndarray): Pixel displacements, e.g. one (ny, nx) field or a (frames, ny, nx) stack of fields.
+		transformation_matrix (np.ndarray): The pixel to real-world transformation matrix.
+
+	Returns:
+		EAST, NORTH (np.ndarray): Real-world coordinates of the vectors, with the shape of X and Y.
+		Displacement_EAST, Displacement_NORTH (np.ndarray): Real-world displacements, with the broadcast shape of
+		X and U.
+	"""
+	X = np.asarray(X, dtype=np.float64)
+	Y = np.asarray(Y, dtype=np.float64)
+
+	EAST, NORTH = apply_homography(transformation_matrix, X, Y)
+	displaced_east, displaced_north = apply_homography(transformation_matrix, X + U, Y + V)
+
+	return EAST, NORTH, displaced_east - EAST, displaced_north - NORTH
+
+
+def project_points(
+	camera_matrix: np.ndarray, X: np.ndarray, Y: np.ndarray, Z: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Project 3 components real-world points to pixel coordinates through a 3x4 camera matrix.
+
+	Parameters:
+		camera_matrix (np.ndarray): The 3x4 camera projection matrix.
+		X, Y, Z (np.ndarray): Real-world coordinates, of any broadcastable shapes.
+
+	Returns:
+		Tuple[np.ndarray, np.ndarray]: The pixel x and y coordinates.
+	"""
+	p = np.asarray(camera_matrix, dtype=np.float64)
+	X = np.asarray(X, dtype=np.float64)
+	Y = np.asarray(Y, dtype=np.float64)
+	Z = np.asarray(Z, dtype=np.float64)
+
+	w = p[2, 0] * X + p[2, 1] * Y + p[2, 2] * Z + p[2, 3]
+	x_out = (p[0, 0] * X + p[0, 1] * Y + p[0, 2] * Z + p[0, 3]) / w
+	y_out = (p[1, 0] * X + p[1, 1] * Y + p[1, 2] * Z + p[1, 3]) / w
+
+	return x_out, y_out
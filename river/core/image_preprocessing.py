@@ -11,15 +11,22 @@ Company: UNC / ORUS
 This script contains functions for processing and analyzing PIV images.
 """
 
-from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 import cv2
 import numpy as np
 
+from river.core.background_models import DEFAULT_PERCENTILE, compute_background, read_frames
+
 
 def preprocess_image(image: Path, filt_grayscale, filt_clahe, clip_limit_clahe, filt_sub_background, background):
-	image = cv2.imread(image, cv2.IMREAD_GRAYSCALE) if filt_grayscale else cv2.imread(image)
+	if isinstance(image, np.ndarray):
+		# A frame already decoded, e.g. from a video stream
+		if filt_grayscale and image.ndim == 3:
+			image = convert_to_grayscale(image)
+	else:
+		image = cv2.imread(image, cv2.IMREAD_GRAYSCALE) if filt_grayscale else cv2.imread(image)
 
 	if filt_sub_background and filt_grayscale:
 		image = subtract_background(image, background)
@@ -43,39 +50,37 @@ def load_and_process_image(image_path: Path):
 	return grayscale_image
 
 
-def calculate_average(image_folder: Path) -> np.ndarray:
+def calculate_average(
+	image_folder: Path,
+	method: str = "mean",
+	percentile: float = DEFAULT_PERCENTILE,
+	every: int = 1,
+	window: Optional[int] = None,
+) -> np.ndarray:
 	"""
-	Calculate the average of all grayscale images in a folder.
+	Calculate the background of the grayscale images in a folder, in one streaming pass that holds a few images at a
+	time.
 
 	Parameters:
 	image_folder : Path
 	    The path to the folder containing the images.
+	method : str, optional
+	    "mean", "median", "min" or "percentile", see background_models. Default is "mean", the average image.
+	percentile : float, optional
+	    Percentile of the "percentile" method. Default is DEFAULT_PERCENTILE.
+	every : int, optional
+	    Use every every-th image only. Default is 1.
+	window : int, optional
+	    Number of images per window of a WindowedBackground. Defaults to a single background.
 
 	Returns:
 	np.ndarray
-	    The average grayscale image.
+	    The background grayscale image, or a WindowedBackground with a window.
 	"""
-	# Get a list of all the image files in the directory
-	image_files = list(image_folder.glob("*.jpg"))
-
-	# Initialize a placeholder for the sum of all images
-	sum_image = None
-	num_images = len(image_files)
-
-	# Use ThreadPoolExecutor to process images in parallel
-	with ThreadPoolExecutor() as executor:
-		grayscale_images = list(executor.map(load_and_process_image, image_files))
-	# Sum all the grayscale images
-	for grayscale_image in grayscale_images:
-		if sum_image is None:
-			sum_image = np.zeros_like(grayscale_image, dtype=np.float64)
-		sum_image += grayscale_image
-
-	# Compute the average image
-	average_image = sum_image / num_images
-	average_image = np.uint8(average_image)
-
-	return average_image
+	# The images in order, for the windows
+	image_files = sorted(str(path) for path in image_folder.glob("*.jpg"))
+
+	return compute_background(read_frames(image_files, load_and_process_image, every), method, percentile, window)
 
 
 def subtract_background(grayscale_image, average_image):
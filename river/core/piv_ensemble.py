@@ -0,0 +1,164 @@
+"""
+File Name: piv_ensemble.py
+Project Name: RIVeR-LAC
+Description: Ensemble-correlation PIV, summing the correlation planes of all the image pairs of a video.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+Instead of finding peaks, filtering and smoothing every pair, the correlation planes of each interrogation window
+are added up over all the pairs and the peaks are found once on the sums. The second pass deforms every pair with
+the ensemble field of the first pass before correlating it again. The result is a single time-averaged field.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+from tqdm import tqdm
+
+from river.core.concurrency import ConcurrencyBudget, initialize_worker
+from river.core.piv_fftmulti import (
+	PivPlan,
+	calculate_gradient,
+	correlate_first_pass,
+	correlate_second_pass,
+	create_piv_plan,
+	process_roi,
+)
+from river.core.piv_loop import FrameRing
+
+
+def ensemble_plan(
+		image_shape: tuple,
+		bbox: list,
+		interrogation_area_1: int,
+		interrogation_area_2: Optional[int],
+		step: Optional[int],
+		multipass: bool,
+) -> PivPlan:
+	"""
+	Build the plan of an ensemble run, with the same unmasked PIV grid as piv_loop.
+
+	Parameters:
+	image_shape : tuple
+		Shape of the preprocessed frames.
+	bbox : list
+		The bounding box for the region of interest.
+	interrogation_area_1, interrogation_area_2, step, multipass :
+		See create_piv_plan.
+
+	Returns:
+	PivPlan
+		The plan shared by the workers and the ensemble peak search.
+	"""
+	mask_piv = np.ones(image_shape[:2], dtype=np.uint8)
+	return create_piv_plan(image_shape, bbox, mask_piv, interrogation_area_1, interrogation_area_2, step, multipass)
+
+
+def ensemble_loop(
+		path_images: list,
+		bbox: list,
+		interrogation_area_1: int,
+		interrogation_area_2: Optional[int],
+		multipass: bool,
+		step: Optional[int],
+		filter_grayscale: bool,
+		filter_clahe: bool,
+		clip_limit_clahe: int,
+		filter_sub_background: bool,
+		background: Optional[np.ndarray],
+		start: int,
+		end: int,
+		deformation: Optional[tuple] = None,
+) -> dict:
+	"""
+	Sum the correlation planes of the pairs (start, start + 1), ..., (end - 1, end).
+
+	Parameters:
+	path_images : list
+		Paths of all the frames.
+	bbox, interrogation_area_1, interrogation_area_2, multipass, step :
+		PIV settings, see piv_fftmulti.
+	filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background, background :
+		Preprocessing settings, see image_preprocessing.preprocess_image.
+	start, end : int
+		The frame range to process.
+	deformation : tuple, optional
+		The (X, Y, U, V) ensemble field returned by deformation_field. None sums the first pass correlation,
+		otherwise every second image is deformed with this field and the second pass correlation is summed.
+
+	Returns:
+	dict
+		"correlation": the summed planes (ia, ia, N) in float64, "gradient": the summed calculate_gradient tables
+		and "pairs": the number of pairs added.
+	"""
+	frames = FrameRing(
+		path_images, filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background, background
+	)
+	plan = ensemble_plan(frames[start].shape, bbox, interrogation_area_1, interrogation_area_2, step, multipass)
+	piv_pass = plan.first_pass if deformation is None else plan.second_pass
+	table = np.empty((piv_pass.numelementsy, piv_pass.numelementsx))
+
+	correlation = None
+	gradient = None
+	for fr in range(start, end):
+		image1_roi, image2_roi, _ = process_roi(plan.bbox, frames[fr], frames[fr + 1])
+
+		if deformation is None:
+			result_conv, image1_cut, image2_cut, image1_pad = correlate_first_pass(image1_roi, image2_roi, plan)
+		else:
+			result_conv, image1_cut, image2_cut, image1_pad = correlate_second_pass(
+				image1_roi, image2_roi, plan, *deformation
+			)
+		pair_gradient = calculate_gradient(image1_cut, image2_cut, image1_pad, table, piv_pass.grid[1])
+
+		if correlation is None:
+			correlation = result_conv.astype(np.float64)
+			gradient = pair_gradient.astype(np.float64)
+		else:
+			correlation += result_conv
+			gradient += pair_gradient
+
+	return {"correlation": correlation, "gradient": gradient, "pairs": end - start}
+
+
+def run_ensemble_loop(args):
+	return ensemble_loop(*args)
+
+
+def sum_ensemble(arg_list: list, budget: ConcurrencyBudget, description: str) -> dict:
+	"""
+	Run ensemble_loop over several frame ranges in parallel and add up their results.
+
+	Parameters:
+	arg_list : list
+		One tuple of ensemble_loop arguments per frame range.
+	budget : ConcurrencyBudget
+		Number of worker processes and of threads in each of them.
+	description : str
+		Label of the progress bar.
+
+	Returns:
+	dict
+		The summed "correlation", "gradient" and "pairs" of all the ranges.
+	"""
+	total_pairs = sum(args[12] - args[11] for args in arg_list)
+	total = None
+
+	with ProcessPoolExecutor(
+		max_workers=budget.workers, initializer=initialize_worker, initargs=(budget.threads_per_worker,)
+	) as executor:
+		with tqdm(total=total_pairs, desc=description) as pbar:
+			for partial in executor.map(run_ensemble_loop, arg_list):
+				if total is None:
+					total = partial
+				else:
+					total["correlation"] += partial["correlation"]
+					total["gradient"] += partial["gradient"]
+					total["pairs"] += partial["pairs"]
+				pbar.update(partial["pairs"])
+
+	return total
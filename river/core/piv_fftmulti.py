@@ -13,10 +13,13 @@ This script contains functions for processing and analyzing PIV images.
 
 import cv2
 import math
+from dataclasses import dataclass
 from typing import Optional, Tuple
 
 import numpy as np
-from scipy import interpolate
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import interpolate, sparse
+from scipy.sparse.linalg import spsolve
 from scipy.interpolate import NearestNDInterpolator, Rbf
 import scipy.fft as fft
 from functools import lru_cache
@@ -31,13 +34,244 @@ pyfftw.config.NUM_THREADS = os.cpu_count()
 # Replace SciPy's FFT backend with pyFFTW's implementation
 fft.set_global_backend(pyfftw.interfaces.scipy_fft)
 
+# Correlation peak finders accepted by piv_fftmulti; "legacy" keeps the uint8 normalize-and-search step
+PEAK_FINDERS = ("argmax", "legacy")
+
+# NaN inpainting engines of the first pass: the global RBF blend of inpaint_nans or a sparse solve over the NaN cells
+INPAINT_METHODS = ("rbf", "biharmonic", "laplace")
+
+# Memory in bytes that the windows, spectra and correlation planes of one batched FFT may use
+FFT_BATCH_MEMORY = 64 * 1024 ** 2
+
+
+@dataclass
+class PivPass:
+	"""
+	Geometry of one PIV pass.
+
+	Everything stored here only depends on the ROI shape, the mask, the interrogation area and the step, so it is
+	computed once per run and shared by every image pair. `active` optionally restricts the correlation to a
+	(numelementsy, numelementsx) boolean selection of windows, see piv_stations.
+	"""
+
+	interrogation_area: int
+	step: int
+	half_ia: int
+	subpixoffset: float
+	miniy: int
+	minix: int
+	maxiy: int
+	maxix: int
+	numelementsx: int
+	numelementsy: int
+	ss1: np.ndarray
+	mask_pad: np.ndarray
+	grid: tuple
+	peak_kernel: np.ndarray
+	window_origin: Optional[tuple] = None
+	active: Optional[np.ndarray] = None
+
+
+@dataclass
+class PivPlan:
+	"""
+	Precomputed grids, index tables and filter kernels for piv_fftmulti.
+
+	A plan is built once with create_piv_plan for a given image shape, bbox, mask, interrogation areas and step,
+	and passed to piv_fftmulti so that each image pair only pays for the work that depends on the data.
+	"""
+
+	image_shape: tuple
+	bbox: list
+	first_pass: PivPass
+	second_pass: PivPass
+	interpolation_grid: tuple
+	deform_grid: tuple
+	ss2: np.ndarray
+	deformed_origin: Optional[tuple] = None
+
+
+def create_piv_plan(
+		image_shape: tuple,
+		bbox: list,
+		mask: Optional[np.ndarray],
+		interrogation_area_1: int,
+		interrogation_area_2: Optional[int] = None,
+		step: Optional[int] = None,
+		multipass: bool = True,
+		strided: bool = True,
+) -> PivPlan:
+	"""
+	Build the reusable plan of a PIV run.
+
+	Parameters:
+	image_shape : tuple
+		Shape of the full images that will be analyzed.
+	bbox : list
+		The bounding box for the region of interest.
+	mask : np.ndarray, optional
+		The mask for the region of interest. Defaults to the whole image.
+	interrogation_area_1 : int
+		The size of the interrogation area.
+	interrogation_area_2 : int, optional
+		The size of the second interrogation area. Default is interrogation_area_1 / 2.
+	step : int, optional
+		The step size for grid calculations. Default is interrogation_area_1 / 2.
+	multipass : bool, optional
+		Whether to use multiple passes. Default is True.
+	strided : bool, optional
+		Whether to extract the interrogation windows as strided views instead of gathering them through the ss1
+		linear indices. Both give the same windows; passes whose grid cannot be expressed as a view always use
+		the linear indices. Default is True.
+
+	Returns:
+	PivPlan
+		The plan to pass to piv_fftmulti.
+	"""
+	if interrogation_area_2 is None:
+		interrogation_area_2 = interrogation_area_1 / 2
+	if step is None:
+		step = interrogation_area_1 / 2
+	if mask is None:
+		mask = np.ones(image_shape[:2], dtype=np.uint8)
+
+	slice_y, slice_x = roi_slices(bbox, image_shape)
+	mask_roi = mask[slice_y, slice_x]
+	roi_shape = mask_roi.shape
+
+	first_pass = create_piv_pass(roi_shape, mask_roi, interrogation_area_1, step, strided)
+	first_pass.peak_kernel = gaussian_peak_kernel()
+
+	# The second pass refines the grid when multipass is True, otherwise it repeats the first pass geometry
+	if multipass:
+		interrogation_area_1 = int(round(interrogation_area_2 / 2) * 2)
+		step = math.ceil(interrogation_area_1 / 2)
+
+	second_pass = create_piv_pass(roi_shape, mask_roi, interrogation_area_1, step, strided)
+	second_pass.peak_kernel = disk_peak_kernel(interrogation_area_1, second_pass.half_ia, second_pass.subpixoffset)
+
+	interp_grid = interpolation_grid(
+		second_pass.minix,
+		second_pass.maxix,
+		second_pass.miniy,
+		second_pass.maxiy,
+		second_pass.step,
+		second_pass.numelementsx,
+		second_pass.numelementsy,
+		second_pass.interrogation_area,
+		first_pass.grid[3],
+		first_pass.grid[4],
+	)
+	grid = deform_grid(interp_grid[6], interp_grid[7])
+
+	# Windows of the deformed image sit on a regular grid anchored at its first pixel
+	xb = np.array([1], dtype=np.int32)
+	yb = np.array([1], dtype=np.int32)
+	ss2 = generate_ssn(
+		second_pass.miniy,
+		second_pass.maxiy,
+		second_pass.minix,
+		second_pass.maxix,
+		second_pass.step,
+		second_pass.interrogation_area,
+		second_pass.numelementsy,
+		second_pass.numelementsx,
+		grid[0].shape[0],
+		xb,
+		yb,
+	)
+	deformed_origin = None
+	if strided:
+		deformed_origin = window_origin(
+			0,
+			0,
+			second_pass.step,
+			second_pass.interrogation_area,
+			second_pass.numelementsy,
+			second_pass.numelementsx,
+			grid[0].shape,
+		)
+
+	return PivPlan(
+		image_shape=tuple(image_shape),
+		bbox=bbox,
+		first_pass=first_pass,
+		second_pass=second_pass,
+		interpolation_grid=interp_grid,
+		deform_grid=grid,
+		ss2=ss2,
+		deformed_origin=deformed_origin,
+	)
+
+
+def create_piv_pass(
+		roi_shape: tuple, mask_roi: np.ndarray, interrogation_area: int, step: int, strided: bool = True
+) -> PivPass:
+	"""
+	Compute the geometry of a single pass over a ROI.
+
+	Parameters:
+	roi_shape : tuple
+		Shape of the region of interest.
+	mask_roi : np.ndarray
+		Mask cropped to the region of interest.
+	interrogation_area : int
+		The size of the interrogation area.
+	step : int
+		The step size for grid calculations.
+	strided : bool, optional
+		Whether to compute the origin used to extract the windows as strided views. Default is True.
+
+	Returns:
+	PivPass
+		The pass geometry, without peak kernel.
+	"""
+	half_ia = math.ceil(interrogation_area / 2)
+
+	miniy, minix, maxiy, maxix, numelementsx, numelementsy = calculate_bounds(roi_shape, interrogation_area, step)
+
+	# Padded mask, inverted so that masked-out pixels are 1
+	mask_pad = 1 - np.pad(mask_roi, pad_width=int(half_ia), mode="constant", constant_values=0)
+
+	subpixoffset = calculate_subpixoffset(interrogation_area)
+
+	ss1 = generate_ssn(
+		miniy, maxiy, minix, maxix, step, interrogation_area, numelementsy, numelementsx, mask_pad.shape[0]
+	)
+
+	grid = result_grid(mask_pad, ss1, interrogation_area, step, miniy, maxiy, minix, maxix)
+
+	origin = None
+	if strided:
+		origin = window_origin(
+			miniy - 1, minix - 1, step, interrogation_area, numelementsy, numelementsx, mask_pad.shape
+		)
+
+	return PivPass(
+		interrogation_area=interrogation_area,
+		step=step,
+		half_ia=half_ia,
+		subpixoffset=subpixoffset,
+		miniy=miniy,
+		minix=minix,
+		maxiy=maxiy,
+		maxix=maxix,
+		numelementsx=numelementsx,
+		numelementsy=numelementsy,
+		ss1=ss1,
+		mask_pad=mask_pad,
+		grid=grid,
+		peak_kernel=None,
+		window_origin=origin,
+	)
+
 
 def piv_fftmulti(
 		image1: np.ndarray,
 		image2: np.ndarray,
-		mask: np.ndarray,
-		bbox: tuple,
-		interrogation_area_1: int,
+		mask: Optional[np.ndarray] = None,
+		bbox: Optional[tuple] = None,
+		interrogation_area_1: Optional[int] = None,
 		interrogation_area_2: Optional[int] = None,
 		mask_auto: bool = True,
 		multipass: bool = True,
@@ -47,6 +281,10 @@ def piv_fftmulti(
 		epsilon: float = 0.02,
 		threshold: float = 2,
 		step: Optional[int] = None,
+		plan: Optional[PivPlan] = None,
+		peak_finder: str = "argmax",
+		inpaint_method: str = "rbf",
+		predictor: Optional[tuple] = None,
 ):
 	"""
 	Perform Particle Image Velocimetry (PIV) analysis using FFT and multiple passes.
@@ -80,61 +318,296 @@ def piv_fftmulti(
 		Whether to apply seeding filtering. Default is True.
 	step : int, optional
 		The step size for grid calculations. Default is interrogationarea / 2.
+	plan : PivPlan, optional
+		Precomputed plan from create_piv_plan. When given, mask, bbox, interrogation areas, step and multipass
+		are taken from the plan.
+	peak_finder : str, optional
+		"argmax" locates each correlation peak with one argmax per window on the float planes. "legacy" normalizes
+		the correlation to uint8 and searches for the 255 values, as in previous versions. Default is "argmax".
+	inpaint_method : str, optional
+		How the vectors rejected by the first pass filters are filled before the window deformation. "rbf" blends
+		global RBF fits (inpaint_nans). "biharmonic" and "laplace" solve a sparse system over the missing vectors
+		only (inpaint_nans_sparse), whose cost grows linearly with the grid size. Default is "rbf".
+	predictor : tuple, optional
+		Deformation field returned by predictor_field, usually built from the result of the previous pair. When
+		given, the first pass is skipped and the second image is deformed with this field. Requires a plan.
 
 	Returns:
 	tuple
 		Contains xtable, ytable, utable, vtable, typevector, gradient_sum_result representing the displacement vectors on the grid.
 	"""
-	if interrogation_area_2 is None:
-		interrogation_area_2 = interrogation_area_1 / 2
-	if step is None:
-		step = interrogation_area_1 / 2
-
+	if peak_finder not in PEAK_FINDERS:
+		raise ValueError(f"Unknown peak finder: {peak_finder}")
+	legacy_peaks = peak_finder == "legacy"
+	if inpaint_method not in INPAINT_METHODS:
+		raise ValueError(f"Unknown inpaint method: {inpaint_method}")
+
+	if plan is None:
+		plan = create_piv_plan(
+			image1.shape, bbox, mask, interrogation_area_1, interrogation_area_2, step, multipass
+		)
+	if legacy_peaks and plan.first_pass.active is not None:
+		raise ValueError("A plan restricted to some windows requires the argmax peak finder.")
 	# Crop the images to the region of interest defined by bbox
-	image1_roi, image2_roi, mask_roi = process_roi(bbox, image1, image2, mask)
-	gen_image1_roi = image1_roi.copy()
-	gen_image2_roi = image2_roi.copy()
+	image1_roi, image2_roi, _ = process_roi(plan.bbox, image1, image2)
+
+	if predictor is None:
+		# First pass on the undeformed images
+		result_conv, _, _, _ = correlate_first_pass(image1_roi, image2_roi, plan)
+		xtable, ytable, utable, vtable, typevector = first_pass_field(
+			result_conv,
+			plan,
+			mask_auto,
+			standard_filter,
+			standard_threshold,
+			median_test_filter,
+			epsilon,
+			threshold,
+			legacy_peaks,
+			inpaint_method,
+		)
 
-	# Calculate half the size of the interrogation area
-	half_ia = math.ceil(interrogation_area_1 / 2)
+		# Interpolate the first pass field on the second pass grid
+		X, Y, U, V, utable, vtable = deformation_field(plan, xtable, ytable, utable, vtable)
+	else:
+		# The predicted field is updated in place by the second pass, so the caller's copy is kept intact
+		X, Y, U, V, utable, vtable = predictor
+		utable = utable.copy()
+		vtable = vtable.copy()
+
+	# Second pass on the second image deformed by the first pass field
+	result_conv, image1_cut, image2_cut, image1_pad = correlate_second_pass(image1_roi, image2_roi, plan, X, Y, U, V)
+	xtable, ytable, utable, vtable, typevector, ii_bckup = second_pass_field(
+		result_conv,
+		plan,
+		utable,
+		vtable,
+		mask_auto,
+		standard_filter,
+		standard_threshold,
+		median_test_filter,
+		epsilon,
+		threshold,
+		legacy_peaks,
+	)
 
-	# Calculate bounds and number of elements for the grid
-	miniy, minix, maxiy, maxix, numelementsx, numelementsy = calculate_bounds(
-		image1_roi.shape, interrogation_area_1, step
+	gradient_sum_result = calculate_gradient(
+		image1_cut, image2_cut, image1_pad, utable, ii_bckup, plan.second_pass.active
 	)
 
-	# Pad the images and mask to handle border effects
-	image1_roi, image2_roi, mask_pad = pad_images(image1_roi, image2_roi, mask_roi, half_ia)
+	return xtable, ytable, utable, vtable, typevector, gradient_sum_result
 
-	# Calculate the sub-pixel offset for the interrogation window
-	subpixoffset = calculate_subpixoffset(interrogation_area_1)
 
-	# Generate a sequence of sub-regions (ssn) to be analyzed
-	image_roi_height = image1_roi.shape[0]
-	ss1 = generate_ssn(
-		miniy, maxiy, minix, maxix, step, interrogation_area_1, numelementsy, numelementsx, image_roi_height
+def piv_fftmulti_batch(
+		image_pairs: list,
+		plan: PivPlan,
+		mask_auto: bool = True,
+		standard_filter: bool = True,
+		standard_threshold: float = 4,
+		median_test_filter: bool = True,
+		epsilon: float = 0.02,
+		threshold: float = 2,
+		peak_finder: str = "argmax",
+		inpaint_method: str = "rbf",
+) -> list:
+	"""
+	Run piv_fftmulti on several image pairs, correlating each pass of all the pairs in one batched FFT.
+
+	The peak search, filters, inpainting and smoothing still run pair by pair, so every pair gets the result of
+	piv_fftmulti.
+
+	Parameters:
+	image_pairs : list
+		(image1, image2) tuples of full images.
+	plan : PivPlan
+		Precomputed plan from create_piv_plan, shared by every pair.
+	mask_auto, standard_filter, standard_threshold, median_test_filter, epsilon, threshold, peak_finder,
+	inpaint_method :
+		See piv_fftmulti.
+
+	Returns:
+	list
+		One (xtable, ytable, utable, vtable, typevector, gradient_sum_result) tuple per pair.
+	"""
+	if peak_finder not in PEAK_FINDERS:
+		raise ValueError(f"Unknown peak finder: {peak_finder}")
+	legacy_peaks = peak_finder == "legacy"
+	if inpaint_method not in INPAINT_METHODS:
+		raise ValueError(f"Unknown inpaint method: {inpaint_method}")
+	if legacy_peaks and plan.first_pass.active is not None:
+		raise ValueError("A plan restricted to some windows requires the argmax peak finder.")
+
+	rois = [process_roi(plan.bbox, image1, image2)[:2] for image1, image2 in image_pairs]
+
+	# First pass of every pair in one FFT
+	windows = [first_pass_windows(image1_roi, image2_roi, plan) for image1_roi, image2_roi in rois]
+	result_convs = compute_convolution_batch(
+		[window[0] for window in windows], [window[1] for window in windows], plan.first_pass.active
 	)
 
-	# Extract sub-regions from the images for FFT analysis
-	image1_cut = extract_image_subregions(image1_roi, ss1)
-	image2_cut = extract_image_subregions(image2_roi, ss1)
+	deformations = []
+	for result_conv in result_convs:
+		xtable, ytable, utable, vtable, _ = first_pass_field(
+			result_conv,
+			plan,
+			mask_auto,
+			standard_filter,
+			standard_threshold,
+			median_test_filter,
+			epsilon,
+			threshold,
+			legacy_peaks,
+			inpaint_method,
+		)
+		deformations.append(deformation_field(plan, xtable, ytable, utable, vtable))
+
+	# Second pass of every pair in one FFT
+	windows = [
+		second_pass_windows(image1_roi, image2_roi, plan, *deformation[:4])
+		for (image1_roi, image2_roi), deformation in zip(rois, deformations)
+	]
+	result_convs = compute_convolution_batch(
+		[window[0] for window in windows], [window[1] for window in windows], plan.second_pass.active
+	)
+
+	results = []
+	for result_conv, deformation, (image1_cut, image2_cut, image1_pad) in zip(result_convs, deformations, windows):
+		xtable, ytable, utable, vtable, typevector, ii_bckup = second_pass_field(
+			result_conv,
+			plan,
+			deformation[4],
+			deformation[5],
+			mask_auto,
+			standard_filter,
+			standard_threshold,
+			median_test_filter,
+			epsilon,
+			threshold,
+			legacy_peaks,
+		)
+		gradient_sum_result = calculate_gradient(
+			image1_cut, image2_cut, image1_pad, utable, ii_bckup, plan.second_pass.active
+		)
+		results.append((xtable, ytable, utable, vtable, typevector, gradient_sum_result))
+
+	return results
+
+
+def correlate_first_pass(image1_roi: np.ndarray, image2_roi: np.ndarray, plan: PivPlan) -> tuple:
+	"""
+	Compute the first pass cross-correlation of every interrogation window.
+
+	Parameters:
+	image1_roi, image2_roi : np.ndarray
+		The images cropped to the region of interest.
+	plan : PivPlan
+		The plan of the run.
+
+	Returns:
+	tuple
+		Correlation planes of shape (ia, ia, N), the windows of both images and the padded first image, as needed
+		by calculate_gradient.
+	"""
+	image1_cut, image2_cut, image1_pad = first_pass_windows(image1_roi, image2_roi, plan)
 
 	# Compute the convolution of the two sub-regions using FFT
-	result_conv = compute_convolution(image1_cut, image2_cut)
+	result_conv = compute_convolution(image1_cut, image2_cut, plan.first_pass.active)
+
+	return result_conv, image1_cut, image2_cut, image1_pad
+
+
+def first_pass_windows(image1_roi: np.ndarray, image2_roi: np.ndarray, plan: PivPlan) -> tuple:
+	"""
+	Extract the first pass interrogation windows of both images.
+
+	Parameters:
+	image1_roi, image2_roi : np.ndarray
+		The images cropped to the region of interest.
+	plan : PivPlan
+		The plan of the run.
+
+	Returns:
+	tuple
+		The windows of both images and the padded first image.
+	"""
+	first_pass = plan.first_pass
+
+	# Pad the images to handle border effects
+	image1_pad, image2_pad, _ = pad_images(image1_roi, image2_roi, None, first_pass.half_ia)
+
+	# Extract sub-regions from the images for FFT analysis
+	image1_cut = extract_pass_windows(image1_pad, first_pass)
+	image2_cut = extract_pass_windows(image2_pad, first_pass)
+
+	return image1_cut, image2_cut, image1_pad
+
+
+def first_pass_field(
+		result_conv: np.ndarray,
+		plan: PivPlan,
+		mask_auto: bool = True,
+		standard_filter: bool = True,
+		standard_threshold: float = 4,
+		median_test_filter: bool = True,
+		epsilon: float = 0.02,
+		threshold: float = 2,
+		legacy_peaks: bool = False,
+		inpaint_method: str = "rbf",
+) -> tuple:
+	"""
+	Turn the first pass correlation into a filtered, gap-free and smoothed displacement field.
+
+	Parameters:
+	result_conv : np.ndarray
+		Correlation planes from correlate_first_pass, or their sum over several pairs. It is modified in place.
+	plan : PivPlan
+		The plan of the run.
+	mask_auto, standard_filter, standard_threshold, median_test_filter, epsilon, threshold :
+		See piv_fftmulti.
+	legacy_peaks : bool, optional
+		Whether to use the uint8 normalize-and-search peak finder. Default is False.
+	inpaint_method : str, optional
+		One of INPAINT_METHODS. Default is "rbf".
+
+	Returns:
+	tuple
+		xtable, ytable, utable, vtable, typevector on the first pass grid, in padded ROI coordinates.
+	"""
+	first_pass = plan.first_pass
 
 	# Apply a Gaussian filter to limit the peak search area if mask_auto is True
 	if mask_auto:
-		result_conv = apply_gaussian_filter(result_conv, half_ia, subpixoffset)
+		result_conv = apply_gaussian_filter(
+			result_conv, first_pass.half_ia, first_pass.subpixoffset, first_pass.peak_kernel
+		)
 
-	# Normalize the convolution results to a range of [0, 255]
-	result_conv = normalize_to_uint8(result_conv)
+	# Normalize the convolution results to a range of [0, 255] for the legacy peak search
+	if legacy_peaks:
+		result_conv = normalize_to_uint8(result_conv)
 
 	# Process the convolution results to obtain displacement vectors
-	typevector = np.ones((numelementsy, numelementsx))
-	xtable, ytable, utable, vtable, typevector, ii_bckup = process_result_conv(
-		result_conv, 1 - mask_pad, ss1, interrogation_area_1, step, miniy, maxiy, minix, maxix, typevector, subpixoffset
+	typevector = np.ones((first_pass.numelementsy, first_pass.numelementsx))
+	xtable, ytable, utable, vtable, typevector, _ = process_result_conv(
+		result_conv,
+		first_pass.mask_pad,
+		first_pass.ss1,
+		first_pass.interrogation_area,
+		first_pass.step,
+		first_pass.miniy,
+		first_pass.maxiy,
+		first_pass.minix,
+		first_pass.maxix,
+		typevector,
+		first_pass.subpixoffset,
+		grid=first_pass.grid,
+		legacy_peaks=legacy_peaks,
 	)
 
+	# Windows that were not correlated are missing vectors, filled by the inpainting like rejected ones
+	if first_pass.active is not None:
+		utable[~first_pass.active] = np.nan
+		vtable[~first_pass.active] = np.nan
+
 	# Apply standard deviation filtering to remove outliers if standard_filter is True
 	if standard_filter:
 		utable, vtable = filter_std(utable, vtable, standard_threshold)
@@ -144,102 +617,240 @@ def piv_fftmulti(
 		utable, vtable = filter_fluctuations(utable, vtable, epsilon=epsilon, threshold=threshold)
 
 	# Replace NaN values in utable and vtable with interpolated values
-	utable = inpaint_nans(utable)
-	vtable = inpaint_nans(vtable)
+	utable = inpaint_table(utable, inpaint_method)
+	vtable = inpaint_table(vtable, inpaint_method)
 
 	# Apply smoothing to the displacement vectors
 	utable = smoothn(utable, s=0.0307)
 	vtable = smoothn(vtable, s=0.0307)
 
-	# Initialize gradient_sum_result to None
-	gradient_sum_result = None
+	return xtable, ytable, utable, vtable, typevector
 
-	# Perform a second pass if multipass is True
-	if multipass:
-		interrogation_area_1 = int(round(interrogation_area_2 / 2) * 2)
-		half_ia = math.ceil(interrogation_area_1 / 2)
-		step = half_ia
 
-	# Reset the region of interest images for the second pass
-	image1_roi = gen_image1_roi.copy()
-	image2_roi = gen_image2_roi.copy()
+def deformation_field(
+		plan: PivPlan, xtable: np.ndarray, ytable: np.ndarray, utable: np.ndarray, vtable: np.ndarray
+) -> tuple:
+	"""
+	Interpolate the first pass field on the second pass grid.
 
-	# Recalculate bounds and number of elements for the new grid
-	miniy, minix, maxiy, maxix, numelementsx, numelementsy = calculate_bounds(
-		image1_roi.shape, interrogation_area_1, step
-	)
-	# Pad the images and mask again
-	image1_roi, image2_roi, mask_pad = pad_images(image1_roi, image2_roi, mask_roi, half_ia)
-
-	# Recalculate the sub-pixel offset
-	subpixoffset = calculate_subpixoffset(interrogation_area_1)
-
-	# Backup the previous tables
-	xtable_old = xtable.copy()
-	ytable_old = ytable.copy()
-
-	# Interpolate the displacement tables to get a smoother vector field
-	X, Y, U, V, utable, vtable = interpolate_tables(
-		minix,
-		maxix,
-		miniy,
-		maxiy,
-		step,
-		numelementsx,
-		numelementsy,
-		interrogation_area_1,
-		xtable_old,
-		ytable_old,
+	Parameters:
+	plan : PivPlan
+		The plan of the run.
+	xtable, ytable, utable, vtable : np.ndarray
+		The first pass field returned by first_pass_field.
+
+	Returns:
+	tuple
+		X, Y, U, V used by deform_window, and utable, vtable on the second pass grid.
+	"""
+	second_pass = plan.second_pass
+	return interpolate_tables(
+		second_pass.minix,
+		second_pass.maxix,
+		second_pass.miniy,
+		second_pass.maxiy,
+		second_pass.step,
+		second_pass.numelementsx,
+		second_pass.numelementsy,
+		second_pass.interrogation_area,
+		xtable,
+		ytable,
 		utable,
 		vtable,
+		grid=plan.interpolation_grid,
 	)
 
-	# Deform the second image based on the interpolated displacement vectors
-	image2_roi_deform, xb, yb = deform_window(X, Y, U, V, image2_roi)
 
-	# Generate a new sequence of sub-regions for the deformed image
-	image1_roi_height = image1_roi.shape[0]
-	ss1 = generate_ssn(
-		miniy, maxiy, minix, maxix, step, interrogation_area_1, numelementsy, numelementsx, image1_roi_height
-	)
+def predictor_field(plan: PivPlan, utable: np.ndarray, vtable: np.ndarray) -> tuple:
+	"""
+	Turn a smoothed second pass field into the deformation field of the next pair.
 
-	image2_roi_height = image2_roi_deform.shape[0]
-	ss2 = generate_ssn(
-		miniy, maxiy, minix, maxix, step, interrogation_area_1, numelementsy, numelementsx, image2_roi_height, xb, yb
-	)
+	Consecutive pairs of a video have nearly the same displacement field, so the result of one pair can replace
+	the first pass of the next one. The field already lies on the second pass grid: it only needs its missing
+	vectors filled and the one-window edge padding of deformation_field.
 
-	# Extract sub-regions from the original and deformed images
-	image1_cut = extract_image_subregions(image1_roi, ss1)
-	image2_cut = extract_image_subregions(image2_roi_deform, ss2)
+	Parameters:
+	plan : PivPlan
+		The plan of the run.
+	utable, vtable : np.ndarray
+		The second pass field returned by piv_fftmulti, before any masking by the caller.
+
+	Returns:
+	tuple
+		X, Y, U, V, utable, vtable with the layout returned by deformation_field, or None when the field has no
+		valid vector.
+	"""
+	utable = np.array(utable, dtype=np.float64)
+	vtable = np.array(vtable, dtype=np.float64)
+
+	missing = np.isnan(utable) | np.isnan(vtable)
+	if missing.all():
+		return None
+	if missing.any():
+		# Windows outside of the stations are NaN, see piv_stations
+		utable[missing] = np.nan
+		vtable[missing] = np.nan
+		utable = nearest_inpaint(utable)
+		vtable = nearest_inpaint(vtable)
+
+	xtable_1, ytable_1 = plan.interpolation_grid[6], plan.interpolation_grid[7]
+	utable_1 = np.pad(utable, ((1, 1), (1, 1)), "edge")
+	vtable_1 = np.pad(vtable, ((1, 1), (1, 1)), "edge")
+
+	return xtable_1, ytable_1, utable_1, vtable_1, utable, vtable
+
+
+def correlate_second_pass(
+		image1_roi: np.ndarray,
+		image2_roi: np.ndarray,
+		plan: PivPlan,
+		X: np.ndarray,
+		Y: np.ndarray,
+		U: np.ndarray,
+		V: np.ndarray,
+) -> tuple:
+	"""
+	Compute the second pass cross-correlation between the first image and the deformed second image.
+
+	Parameters:
+	image1_roi, image2_roi : np.ndarray
+		The images cropped to the region of interest.
+	plan : PivPlan
+		The plan of the run.
+	X, Y, U, V : np.ndarray
+		The deformation field returned by deformation_field.
+
+	Returns:
+	tuple
+		Correlation planes of shape (ia, ia, N), the windows of both images and the padded first image, as needed
+		by calculate_gradient.
+	"""
+	image1_cut, image2_cut, image1_pad = second_pass_windows(image1_roi, image2_roi, plan, X, Y, U, V)
 
 	# Compute the convolution of the two sub-regions using FFT
-	result_conv = compute_convolution(image1_cut, image2_cut)
+	result_conv = compute_convolution(image1_cut, image2_cut, plan.second_pass.active)
+
+	return result_conv, image1_cut, image2_cut, image1_pad
+
+
+def second_pass_windows(
+		image1_roi: np.ndarray,
+		image2_roi: np.ndarray,
+		plan: PivPlan,
+		X: np.ndarray,
+		Y: np.ndarray,
+		U: np.ndarray,
+		V: np.ndarray,
+) -> tuple:
+	"""
+	Deform the second image and extract the second pass interrogation windows of both images.
+
+	Parameters:
+	image1_roi, image2_roi : np.ndarray
+		The images cropped to the region of interest.
+	plan : PivPlan
+		The plan of the run.
+	X, Y, U, V : np.ndarray
+		The deformation field returned by deformation_field.
+
+	Returns:
+	tuple
+		The windows of the first image and of the deformed second image, and the padded first image.
+	"""
+	second_pass = plan.second_pass
+
+	# Pad the region of interest images again for the second pass
+	image1_pad, image2_pad, _ = pad_images(image1_roi, image2_roi, None, second_pass.half_ia)
+
+	# Deform the second image based on the interpolated displacement vectors
+	image2_roi_deform, xb, yb = deform_window(X, Y, U, V, image2_pad, grid=plan.deform_grid)
+
+	# Extract sub-regions from the original and deformed images
+	image1_cut = extract_pass_windows(image1_pad, second_pass)
+	if plan.deformed_origin is not None:
+		image2_cut = extract_image_windows(
+			image2_roi_deform,
+			plan.deformed_origin,
+			second_pass.step,
+			second_pass.interrogation_area,
+			second_pass.numelementsy,
+			second_pass.numelementsx,
+		)
+	else:
+		image2_cut = extract_image_subregions(image2_roi_deform, plan.ss2)
+
+	return image1_cut, image2_cut, image1_pad
+
+
+def second_pass_field(
+		result_conv: np.ndarray,
+		plan: PivPlan,
+		utable: np.ndarray,
+		vtable: np.ndarray,
+		mask_auto: bool = True,
+		standard_filter: bool = True,
+		standard_threshold: float = 4,
+		median_test_filter: bool = True,
+		epsilon: float = 0.02,
+		threshold: float = 2,
+		legacy_peaks: bool = False,
+) -> tuple:
+	"""
+	Add the second pass correlation peaks to the predicted field and post-process the result.
+
+	Parameters:
+	result_conv : np.ndarray
+		Correlation planes from correlate_second_pass, or their sum over several pairs.
+	plan : PivPlan
+		The plan of the run.
+	utable, vtable : np.ndarray
+		The predicted field returned by deformation_field. They are updated in place.
+	mask_auto, standard_filter, standard_threshold, median_test_filter, epsilon, threshold :
+		See piv_fftmulti.
+	legacy_peaks : bool, optional
+		Whether to use the uint8 normalize-and-search peak finder. Default is False.
+
+	Returns:
+	tuple
+		xtable, ytable in image coordinates, utable, vtable, typevector and ii_bckup for calculate_gradient.
+	"""
+	second_pass = plan.second_pass
 
 	# Apply a Gaussian filter to limit the peak search area if mask_auto is True
 	if mask_auto:
-		result_conv = limit_peak_search_area(result_conv, half_ia, subpixoffset)
+		result_conv = limit_peak_search_area(
+			result_conv, second_pass.half_ia, second_pass.subpixoffset, second_pass.peak_kernel
+		)
 
-	# Normalize the convolution results to a range of [0, 255]
-	result_conv = normalize_to_uint8(result_conv)
+	# Normalize the convolution results to a range of [0, 255] for the legacy peak search
+	if legacy_peaks:
+		result_conv = normalize_to_uint8(result_conv)
 
 	# Process the convolution results to obtain displacement vectors
-	typevector = np.ones((numelementsy, numelementsx))
+	typevector = np.ones((second_pass.numelementsy, second_pass.numelementsx))
 	xtable, ytable, utable, vtable, typevector, ii_bckup = process_result_conv(
 		result_conv,
-		1 - mask_pad,
-		ss1,
-		interrogation_area_1,
-		step,
-		miniy,
-		maxiy,
-		minix,
-		maxix,
+		second_pass.mask_pad,
+		second_pass.ss1,
+		second_pass.interrogation_area,
+		second_pass.step,
+		second_pass.miniy,
+		second_pass.maxiy,
+		second_pass.minix,
+		second_pass.maxix,
 		typevector,
-		subpixoffset,
+		second_pass.subpixoffset,
 		utable,
 		vtable,
+		grid=second_pass.grid,
+		legacy_peaks=legacy_peaks,
 	)
 
+	# Windows that were not correlated are left out of the filters
+	if second_pass.active is not None:
+		utable[~second_pass.active] = np.nan
+		vtable[~second_pass.active] = np.nan
+
 	# Apply standard deviation filtering to remove outliers if standard_filter is True
 	if standard_filter:
 		utable, vtable = filter_std(utable, vtable, standard_threshold)
@@ -248,8 +859,6 @@ def piv_fftmulti(
 	if median_test_filter:
 		utable, vtable = filter_fluctuations(utable, vtable, epsilon=epsilon, threshold=threshold)
 
-	gradient_sum_result = calculate_gradient(image1_cut, image2_cut, image1_roi, utable, ii_bckup)
-
 	# # Optionally replace NaN values in utable and vtable with interpolated values
 	utable = nearest_inpaint(utable)
 	vtable = nearest_inpaint(vtable)
@@ -258,11 +867,16 @@ def piv_fftmulti(
 	utable = smoothn(utable, s=0.0307)
 	vtable = smoothn(vtable, s=0.0307)
 
+	# Only the correlated windows are returned, the others were filled for the smoothing
+	if second_pass.active is not None:
+		utable[~second_pass.active] = np.nan
+		vtable[~second_pass.active] = np.nan
+
 	# Adjust xtable and ytable to match the original image coordinates
-	xtable = xtable + bbox[0] - half_ia
-	ytable = ytable + bbox[1] - half_ia
+	xtable = xtable + plan.bbox[0] - second_pass.half_ia
+	ytable = ytable + plan.bbox[1] - second_pass.half_ia
 
-	return xtable, ytable, utable, vtable, typevector, gradient_sum_result
+	return xtable, ytable, utable, vtable, typevector, ii_bckup
 
 
 def rvr_round(x: int) -> int:
@@ -299,6 +913,27 @@ def rvr_round(x: int) -> int:
 		return math.floor(x)
 
 
+def roi_slices(roi_input: list, image_shape: tuple) -> tuple:
+	"""
+	Compute the row and column slices of the region of interest.
+
+	Parameters:
+	roi_input (list): List of ROI coordinates [x, y, width, height]. An empty list selects the whole image.
+	image_shape (tuple): Shape of the image.
+
+	Returns:
+	tuple: The row slice and the column slice of the ROI.
+	"""
+	if len(roi_input) > 0:
+		xroi = int(rvr_round(roi_input[0]))
+		yroi = int(rvr_round(roi_input[1]))
+		widthroi = int(np.ceil(roi_input[2]))
+		heightroi = int(np.ceil(roi_input[3]))
+		return slice(yroi, yroi + heightroi), slice(xroi, xroi + widthroi)
+
+	return slice(0, image_shape[0]), slice(0, image_shape[1])
+
+
 def process_roi(roi_input: list, image1: np.ndarray, image2: np.ndarray, mask: Optional[np.ndarray] = None) -> tuple:
 	"""
 	Process regions of interest (ROI) from two images and a mask based on the input coordinates.
@@ -316,14 +951,11 @@ def process_roi(roi_input: list, image1: np.ndarray, image2: np.ndarray, mask: O
 	tuple: A tuple containing the ROIs of image1, image2, and the cropped mask (if provided).
 	"""
 	if len(roi_input) > 0:
-		xroi = int(rvr_round(roi_input[0]))
-		yroi = int(rvr_round(roi_input[1]))
-		widthroi = int(np.ceil(roi_input[2]))
-		heightroi = int(np.ceil(roi_input[3]))
-		image1_roi = np.float32(image1[yroi: yroi + heightroi, xroi: xroi + widthroi])
-		image2_roi = np.float32(image2[yroi: yroi + heightroi, xroi: xroi + widthroi])
+		slice_y, slice_x = roi_slices(roi_input, image1.shape)
+		image1_roi = np.float32(image1[slice_y, slice_x])
+		image2_roi = np.float32(image2[slice_y, slice_x])
 		if mask is not None:
-			mask_roi = mask[yroi: yroi + heightroi, xroi: xroi + widthroi]
+			mask_roi = mask[slice_y, slice_x]
 		else:
 			mask_roi = None
 	else:
@@ -371,14 +1003,16 @@ def calculate_bounds(image_shape: tuple, interrogation_area: int, step: int) ->
 	return miniy, minix, maxiy, maxix, numelementsx, numelementsy
 
 
-def pad_images(image1_roi: np.ndarray, image2_roi: np.ndarray, mask_roi: np.ndarray, half_ia: int) -> tuple:
+def pad_images(
+		image1_roi: np.ndarray, image2_roi: np.ndarray, mask_roi: Optional[np.ndarray], half_ia: int
+) -> tuple:
 	"""
 	Pad images and mask with a constant value derived from image1_roi.
 
 	Parameters:
 	image1_roi (numpy.ndarray): First image region of interest.
 	image2_roi (numpy.ndarray): Second image region of interest.
-	mask_roi (numpy.ndarray): mask region of interest.
+	mask_roi (numpy.ndarray or None): mask region of interest. None skips the mask padding.
 	interrogationarea (int): Size of the interrogation area.
 
 	Returns:
@@ -393,7 +1027,8 @@ def pad_images(image1_roi: np.ndarray, image2_roi: np.ndarray, mask_roi: np.ndar
 	# Pad all arrays with the determined fill and constant_values=minimum for images, 0 for mask
 	image1_roi = np.pad(image1_roi, pad_width=fill, mode="constant", constant_values=minimum)
 	image2_roi = np.pad(image2_roi, pad_width=fill, mode="constant", constant_values=minimum)
-	mask_roi = np.pad(mask_roi, pad_width=fill, mode="constant", constant_values=0)
+	if mask_roi is not None:
+		mask_roi = np.pad(mask_roi, pad_width=fill, mode="constant", constant_values=0)
 
 	return image1_roi, image2_roi, mask_roi
 
@@ -520,7 +1155,117 @@ def extract_image_subregions(image: np.ndarray, ss1: np.ndarray) -> np.ndarray:
 	return out
 
 
-def compute_convolution(image1_cut: np.ndarray, image2_cut: np.ndarray) -> np.ndarray:
+def window_origin(
+		origin_y: int,
+		origin_x: int,
+		step: int,
+		interrogation_area: int,
+		num_elements_y: int,
+		num_elements_x: int,
+		image_shape: tuple,
+) -> Optional[tuple]:
+	"""
+	Check that a window grid can be extracted as a strided view and return its origin.
+
+	The ss1 linear indices wrap around to the next column when a window crosses the bottom of the image, and
+	non-integer steps are truncated, neither of which a view can reproduce. Those grids return None so that the
+	caller falls back to extract_image_subregions.
+
+	Parameters:
+	origin_y, origin_x : int
+		0-based position of the top-left pixel of the first window.
+	step : int
+		The step size between windows.
+	interrogation_area : int
+		The size of the interrogation area.
+	num_elements_y, num_elements_x : int
+		Number of windows in each direction.
+	image_shape : tuple
+		Shape of the image the windows are extracted from.
+
+	Returns:
+	tuple or None
+		The integer origin (origin_y, origin_x), or None if the grid is not a regular in-bounds grid.
+	"""
+	if float(step) != int(step) or float(origin_y) != int(origin_y) or float(origin_x) != int(origin_x):
+		return None
+	step = int(step)
+	origin_y = int(origin_y)
+	origin_x = int(origin_x)
+	if origin_y < 0 or origin_x < 0:
+		return None
+	if origin_y + (num_elements_y - 1) * step + interrogation_area > image_shape[0]:
+		return None
+	if origin_x + (num_elements_x - 1) * step + interrogation_area > image_shape[1]:
+		return None
+	return origin_y, origin_x
+
+
+def extract_image_windows(
+		image: np.ndarray,
+		origin: tuple,
+		step: int,
+		interrogation_area: int,
+		num_elements_y: int,
+		num_elements_x: int,
+) -> np.ndarray:
+	"""
+	Extract the interrogation windows of a regular grid as a strided view of the image.
+
+	No pixel is copied: the windows share the memory of `image`. Window (iy, ix) holds the same pixels as window
+	iy * num_elements_x + ix of extract_image_subregions.
+
+	Parameters:
+	image : np.ndarray
+		2D image from which interrogation windows are extracted.
+	origin : tuple
+		0-based (row, column) of the top-left pixel of the first window, as returned by window_origin.
+	step : int
+		The step size between windows.
+	interrogation_area : int
+		The size of the interrogation area.
+	num_elements_y, num_elements_x : int
+		Number of windows in each direction.
+
+	Returns:
+	np.ndarray
+		Read-only view of shape (num_elements_y, num_elements_x, ia, ia).
+	"""
+	step = int(step)
+	ia = int(interrogation_area)
+	windows = sliding_window_view(image, (ia, ia))
+	return windows[origin[0]::step, origin[1]::step][:num_elements_y, :num_elements_x]
+
+
+def extract_pass_windows(image: np.ndarray, piv_pass: PivPass) -> np.ndarray:
+	"""
+	Extract the interrogation windows of a pass, as strided views when the pass allows it.
+
+	Parameters:
+	image : np.ndarray
+		Padded 2D image.
+	piv_pass : PivPass
+		Geometry of the pass.
+
+	Returns:
+	np.ndarray
+		Windows of shape (ny, nx, ia, ia) when strided, otherwise (ia, ia, N).
+	"""
+	if piv_pass.window_origin is None:
+		return extract_image_subregions(image, piv_pass.ss1)
+	return extract_image_windows(
+		image,
+		piv_pass.window_origin,
+		piv_pass.step,
+		piv_pass.interrogation_area,
+		piv_pass.numelementsy,
+		piv_pass.numelementsx,
+	)
+
+
+def compute_convolution(
+		image1_cut: np.ndarray, image2_cut: np.ndarray, active: Optional[np.ndarray] = None
+) -> np.ndarray:
 	"""
 	Compute cross-correlation for each interrogation window using FFT.
 
@@ -530,19 +1275,43 @@ def compute_convolution(image1_cut: np.ndarray, image2_cut: np.ndarray) -> np.nd
 
 	Parameters:
 	image1_cut : np.ndarray
-		First stack of interrogation windows. Shape: (ia, ia, N).
+		First stack of interrogation windows. Shape: (ia, ia, N), or (ny, nx, ia, ia) as returned by
+		extract_image_windows.
 	image2_cut : np.ndarray
-		Second stack of interrogation windows. Shape: (ia, ia, N).
+		Second stack of interrogation windows, in the same layout as image1_cut.
+	active : np.ndarray, optional
+		Boolean (ny, nx) selection of the windows to correlate. The other windows get a zero correlation plane,
+		which the peak search reads as no displacement. Default is all the windows.
 
 	Returns:
 	np.ndarray
 		A 3D array of cross-correlation results. Shape: (ia, ia, N), dtype: float32.
 		Each slice along the third dimension corresponds to one interrogation window.
 	"""
+	if active is not None:
+		selected = active.reshape(-1)
+		if image1_cut.ndim == 4:
+			# Fancy indexing copies only the selected windows, as a (K, ia, ia) stack
+			image1_cut = np.moveaxis(image1_cut[active], 0, -1)
+			image2_cut = np.moveaxis(image2_cut[active], 0, -1)
+		else:
+			image1_cut = image1_cut[:, :, selected]
+			image2_cut = image2_cut[:, :, selected]
+
+		corr = compute_convolution(image1_cut, image2_cut)
+		result = np.zeros((selected.size,) + corr.shape[:2], dtype=np.float32)
+		result[selected] = np.moveaxis(corr, -1, 0)
+		return np.moveaxis(result, 0, -1)
 
-	# Move window index to axis 0 for batched FFT: shape becomes (N, ia, ia)
-	a = np.moveaxis(image1_cut, -1, 0).astype(np.float32, copy=False)
-	b = np.moveaxis(image2_cut, -1, 0).astype(np.float32, copy=False)
+
+	if image1_cut.ndim == 4:
+		# Strided windows are already indexed first; the float32 cast is the only copy
+		a = image1_cut.astype(np.float32)
+		b = image2_cut.astype(np.float32)
+	else:
+		# Move window index to axis 0 for batched FFT: shape becomes (N, ia, ia)
+		a = np.moveaxis(image1_cut, -1, 0).astype(np.float32, copy=False)
+		b = np.moveaxis(image2_cut, -1, 0).astype(np.float32, copy=False)
 
 	# Compute real-to-complex FFTs along the last two axes
 	Fa = fft.rfftn(a, axes=(-2, -1))
@@ -553,11 +1322,101 @@ def compute_convolution(image1_cut: np.ndarray, image2_cut: np.ndarray) -> np.nd
 
 	# Center the zero-lag peak and restore original layout (ia, ia, N)
 	corr = np.fft.fftshift(corr, axes=(-2, -1))
+	corr = corr.reshape((-1,) + corr.shape[-2:])
 	corr = np.moveaxis(corr, 0, -1)
 
 	return corr.astype(np.float32, copy=False)
 
 
+def compute_convolution_batch(
+		image1_cuts: list, image2_cuts: list, active: Optional[np.ndarray] = None
+) -> list:
+	"""
+	Compute the cross-correlation of the windows of several image pairs with a single batched FFT.
+
+	The windows of the K pairs are stacked along the window axis, so the FFT runs one batch of K times more
+	windows, which keeps the pyFFTW threads busy on small grids. The planes are then split back per pair.
+
+	Parameters:
+	image1_cuts, image2_cuts : list
+		Windows of each pair, all in the same layout and with the same shape, see compute_convolution.
+	active : np.ndarray, optional
+		Boolean (ny, nx) selection of the windows to correlate, shared by every pair. Default is all the windows.
+
+	Returns:
+	list
+		One (ia, ia, N) float32 array of correlation planes per pair.
+	"""
+	num_pairs = len(image1_cuts)
+	if image1_cuts[0].ndim == 4:
+		# (ny, nx, ia, ia) windows are stacked as (K * ny, nx, ia, ia), pair after pair in row-major order
+		image1_cut = np.concatenate(image1_cuts, axis=0)
+		image2_cut = np.concatenate(image2_cuts, axis=0)
+	else:
+		image1_cut = np.concatenate(image1_cuts, axis=-1)
+		image2_cut = np.concatenate(image2_cuts, axis=-1)
+
+	if active is not None:
+		active = np.tile(active, (num_pairs, 1))
+
+	corr = compute_convolution(image1_cut, image2_cut, active)
+	return np.split(corr, num_pairs, axis=-1)
+
+
+def warm_up_fft(plan: PivPlan, batch_pairs: int = 1):
+	"""
+	Plan the FFTs of a run before it starts, so that no pair pays for the planning.
+
+	The correlations are computed on blank windows with the exact shapes of both passes, including the active
+	windows of station plans and the batches of piv_fftmulti_batch, which fills the pyFFTW cache and the FFTW wisdom.
+
+	Parameters:
+	plan : PivPlan
+		The plan of the run.
+	batch_pairs : int, optional
+		Number of pairs per batched FFT. Default is 1.
+	"""
+	image = np.zeros(plan.image_shape[:2], dtype=np.float32)
+	image1_roi, image2_roi, _ = process_roi(plan.bbox, image, image)
+
+	image1_cut, image2_cut, _ = first_pass_windows(image1_roi, image2_roi, plan)
+	passes = [(image1_cut, image2_cut, plan.first_pass.active)]
+
+	xtable_1, ytable_1 = plan.interpolation_grid[6], plan.interpolation_grid[7]
+	zeros = np.zeros(xtable_1.shape)
+	image1_cut, image2_cut, _ = second_pass_windows(image1_roi, image2_roi, plan, xtable_1, ytable_1, zeros, zeros)
+	passes.append((image1_cut, image2_cut, plan.second_pass.active))
+
+	for image1_cut, image2_cut, active in passes:
+		compute_convolution(image1_cut, image2_cut, active)
+		if batch_pairs > 1:
+			compute_convolution_batch([image1_cut] * batch_pairs, [image2_cut] * batch_pairs, active)
+
+
+def fft_batch_size(plan: PivPlan, memory_budget: int = FFT_BATCH_MEMORY) -> int:
+	"""
+	Number of image pairs whose windows fit in one batched FFT within a memory budget.
+
+	Parameters:
+	plan : PivPlan
+		The plan of the run.
+	memory_budget : int, optional
+		Memory in bytes available to one batch. Default is FFT_BATCH_MEMORY.
+
+	Returns:
+	int
+		The number of pairs per batch, at least 1.
+	"""
+	batch_bytes = 0
+	for piv_pass in (plan.first_pass, plan.second_pass):
+		ia = piv_pass.interrogation_area
+		# Two float32 window stacks, three complex64 half spectra and the float32 planes with their shifted copy
+		window_bytes = ia * ia * 4 * 2 + ia * (ia // 2 + 1) * 8 * 3 + ia * ia * 4 * 2
+		batch_bytes = max(batch_bytes, window_bytes * piv_pass.numelementsy * piv_pass.numelementsx)
+
+	return max(1, int(memory_budget // batch_bytes))
+
+
 def fspecial_gauss(shape: tuple = (3, 3), sigma: float = 1.5) -> np.ndarray:
 	"""
 	Create a 2D Gaussian mask.
@@ -579,7 +1438,22 @@ def fspecial_gauss(shape: tuple = (3, 3), sigma: float = 1.5) -> np.ndarray:
 	return h
 
 
-def apply_gaussian_filter(result_conv: np.ndarray, half_ia: int, subpixoffset: float) -> np.ndarray:
+def gaussian_peak_kernel() -> np.ndarray:
+	"""
+	Create the 3x3 kernel that attenuates the zero-displacement peak in apply_gaussian_filter.
+
+	Returns:
+	numpy.ndarray: The 3x3 kernel.
+	"""
+	h = fspecial_gauss([3, 3], 1.5)
+	h = h / h[1, 1]
+	h = 1 - h
+	return h
+
+
+def apply_gaussian_filter(
+		result_conv: np.ndarray, half_ia: int, subpixoffset: float, kernel: Optional[np.ndarray] = None
+) -> np.ndarray:
 	"""
 	Apply a Gaussian filter to a sub-region of the result convolution matrix.
 
@@ -587,20 +1461,18 @@ def apply_gaussian_filter(result_conv: np.ndarray, half_ia: int, subpixoffset: f
 	result_conv (numpy.ndarray): The result of the convolution.
 	interrogationarea (int): The size of the interrogation area.
 	subpixoffset (float): The subpixel offset.
+	kernel (numpy.ndarray, optional): Precomputed kernel from gaussian_peak_kernel.
 
 	Returns:
 	numpy.ndarray: The updated result_conv after applying the Gaussian filter.
 	"""
-	h = fspecial_gauss([3, 3], 1.5)
-	h = h / h[1, 1]
-	h = 1 - h
-
-	h = np.repeat(h[:, :, np.newaxis], result_conv.shape[2], axis=2)
+	if kernel is None:
+		kernel = gaussian_peak_kernel()
 
 	start = int(half_ia + subpixoffset - 1) - 1
 	end = int(half_ia + subpixoffset + 1)
 
-	h = np.multiply(h, result_conv[start:end, start:end, :])
+	h = np.multiply(kernel[:, :, np.newaxis], result_conv[start:end, start:end, :])
 
 	result_conv[start:end, start:end, :] = h
 
@@ -643,35 +1515,55 @@ def fspecial_disk() -> np.ndarray:
 	)
 
 
-def limit_peak_search_area(result_conv: np.ndarray, half_ia: int, subpixoffset: float) -> np.ndarray:
+def disk_peak_kernel(interrogation_area: int, half_ia: int, subpixoffset: float) -> np.ndarray:
 	"""
-	Limit peak search area using a disk-shaped filter.
+	Create the 2D weights used by limit_peak_search_area for one interrogation window.
 
 	Parameters:
-	result_conv (numpy.ndarray): Convolution result.
-	interrogationarea (int): Size of the interrogation area.
+	interrogation_area (int): Size of the interrogation area.
+	half_ia (int): Half size of the interrogation area.
 	subpixoffset (float): Subpixel offset.
 
 	Returns:
-	numpy.ndarray: Convolution result after limiting peak search area.
+	numpy.ndarray: Weights of shape (interrogation_area, interrogation_area).
 	"""
-	# Create an empty matrix of zeros with the same shape as result_conv
-	emptymatrix = np.zeros((result_conv.shape[0], result_conv.shape[1], result_conv.shape[2]))
+	# Create an empty matrix of zeros with the shape of a correlation plane
+	emptymatrix = np.zeros((int(interrogation_area), int(interrogation_area)))
 
 	# Size of the disk filter
 	sizeones = 4
 
 	# Create a disk-shaped filter using fspecial_disk function (assumed to be imported)
 	h = fspecial_disk()  # Assuming it's equivalent to Matlab's fspecial('disk', 4)
-	h = np.repeat(h[:, :, np.newaxis], result_conv.shape[2], axis=2)
 
 	# Define the region in emptymatrix where the disk filter will be applied
 	start = int((half_ia) + subpixoffset - sizeones) - 1
 	end = int((half_ia) + subpixoffset + sizeones)
-	emptymatrix[start:end, start:end, :] = h
+	emptymatrix[start:end, start:end] = h
+
+	return emptymatrix
+
 
-	# Apply the disk filter to result_conv
-	result_conv = np.multiply(result_conv, emptymatrix)
+def limit_peak_search_area(
+		result_conv: np.ndarray, half_ia: int, subpixoffset: float, kernel: Optional[np.ndarray] = None
+) -> np.ndarray:
+	"""
+	Limit peak search area using a disk-shaped filter.
+
+	Parameters:
+	result_conv (numpy.ndarray): Convolution result.
+	interrogationarea (int): Size of the interrogation area.
+	subpixoffset (float): Subpixel offset.
+	kernel (numpy.ndarray, optional): Precomputed weights from disk_peak_kernel.
+
+	Returns:
+	numpy.ndarray: Convolution result after limiting peak search area.
+	"""
+	if kernel is None:
+		kernel = disk_peak_kernel(result_conv.shape[0], half_ia, subpixoffset)
+
+	# Apply the disk filter to every correlation plane of result_conv
+	result_conv = np.multiply(result_conv, kernel[:, :, np.newaxis])
 
 	return result_conv
 
@@ -766,22 +1658,66 @@ def subpixgauss(
 		peaky = y1[valid_mask] + (f1y - f2y) / (2 * f1y - 4 * f0 + 2 * f2y)
 		peakx = x1[valid_mask] + (f1x - f2x) / (2 * f1x - 4 * f0 + 2 * f2x)
 
-		# Initialize full size arrays with zeros
-		full_peakx = np.zeros(expected_size)
-		full_peaky = np.zeros(expected_size)
+		# Initialize full size arrays with zeros
+		full_peakx = np.zeros(expected_size)
+		full_peaky = np.zeros(expected_size)
+
+		# Assign calculated peaks to their proper positions
+		full_peakx[valid_indices] = peakx - half_ia - subpixoffset
+		full_peaky[valid_indices] = peaky - half_ia - subpixoffset
+
+		# Assign to output vector
+		vector[:, 0] = full_peakx
+		vector[:, 1] = full_peaky
+
+	except Exception:
+		raise
+
+	return vector
+
+
+def result_grid(
+		mask_pad: np.ndarray,
+		ss1: np.ndarray,
+		interrogation_area: int,
+		step: int,
+		miniy: int,
+		maxiy: int,
+		minix: int,
+		maxix: int,
+) -> tuple:
+	"""
+	Compute the masked windows and the vector grid used by process_result_conv.
+
+	Parameters:
+	mask_pad (numpy.ndarray): The mask array.
+	ss1 (numpy.ndarray): The ss1 array used for indexing.
+	interrogation_area (int): The size of the interrogation area.
+	step (int): The step size for grid calculations.
+	miniy, maxiy, minix, maxix (int): The grid bounds.
 
-		# Assign calculated peaks to their proper positions
-		full_peakx[valid_indices] = peakx - half_ia - subpixoffset
-		full_peaky[valid_indices] = peaky - half_ia - subpixoffset
+	Returns:
+	tuple: Contains ii, ii_bckup, jj, xtable, ytable.
+	"""
+	half_ia = math.ceil(interrogation_area / 2)
+	ii_temp = ss1[int(round(half_ia + 1)), int(round(half_ia + 1)), :]
+	ii = selective_indexing(mask_pad, ii_temp, mask_pad.shape)
+	ii_bckup = ii.copy()
+	ii = np.flatnonzero(ii)
 
-		# Assign to output vector
-		vector[:, 0] = full_peakx
-		vector[:, 1] = full_peaky
+	vect_ind1 = (np.arange(miniy, maxiy + 1, step) + round(half_ia) - 1).astype(np.intp)
+	vect_ind2 = (np.arange(minix, maxix + 1, step) + round(half_ia) - 1).astype(np.intp)
+	jj = np.nonzero(mask_pad[vect_ind1[:, np.newaxis], vect_ind2])
 
-	except Exception:
-		raise
+	arrx_aux = np.arange(minix, maxix + 1, step) + half_ia
+	arry_aux = np.arange(miniy, maxiy + 1, step)
+	xtable = np.tile(arrx_aux, (arry_aux.shape[0], 1))
+	arry_aux = arry_aux + half_ia
+	arry_aux = arry_aux[:, np.newaxis]
+	arrx_aux = arrx_aux - half_ia
+	ytable = np.tile(arry_aux, (1, arrx_aux.shape[0]))
 
-	return vector
+	return ii, ii_bckup, jj, xtable, ytable
 
 
 def process_result_conv(
@@ -798,6 +1734,8 @@ def process_result_conv(
 		sub_pix_offset: float,
 		utable: Optional[np.ndarray] = None,
 		vtable: Optional[np.ndarray] = None,
+		grid: Optional[tuple] = None,
+		legacy_peaks: bool = False,
 ):
 	"""
 	Process the result_conv matrix to create a vector matrix representing displacement vectors.
@@ -816,22 +1754,53 @@ def process_result_conv(
 	sub_pix_offset (float): The subpixel offset value.
 	utable (numpy.ndarray, optional): The u displacement vector table to update.
 	vtable (numpy.ndarray, optional): The v displacement vector table to update.
+	grid (tuple, optional): Precomputed output of result_grid for this pass.
+	legacy_peaks (bool, optional): Whether result_conv was normalized with normalize_to_uint8 and the peaks must be
+		searched as its 255 values. Otherwise find_correlation_peaks is used on the float planes. Default is False.
 
 
 	Returns:
 	tuple: Contains xtable, ytable, utable, vtable, typevector representing the displacement vectors on the grid.
 	"""
+	if grid is None:
+		grid = result_grid(mask_pad, ss1, interrogation_area, step, miniy, maxiy, minix, maxix)
+	ii, ii_bckup, jj, xtable, ytable = grid
 	half_ia = math.ceil(interrogation_area / 2)
-	ii_temp = ss1[int(round(half_ia + 1)), int(round(half_ia + 1)), :]
-	ii = selective_indexing(mask_pad, ii_temp, mask_pad.shape)
-	ii_bckup = ii.copy()
-	ii = np.flatnonzero(ii)
-
-	vect_ind1 = (np.arange(miniy, maxiy + 1, step) + round(half_ia) - 1).astype(np.intp)
-	vect_ind2 = (np.arange(minix, maxix + 1, step) + round(half_ia) - 1).astype(np.intp)
-	jj = np.nonzero(mask_pad[vect_ind1[:, np.newaxis], vect_ind2])
 
 	type_vector[jj[0], jj[1]] = 0
+
+	if legacy_peaks:
+		vector = find_legacy_peaks(result_conv, ii, half_ia, sub_pix_offset)
+	else:
+		vector = find_correlation_peaks(result_conv, ii, half_ia, sub_pix_offset)
+
+	xtable_aux = xtable.transpose()
+	vector = vector.reshape((xtable_aux.shape[0], xtable_aux.shape[1], 2), order="F")
+	vector = vector.transpose(1, 0, 2)
+
+	if utable is None:
+		utable = np.zeros((xtable.shape[0], xtable.shape[1]), dtype=float)
+		vtable = np.zeros((ytable.shape[0], ytable.shape[1]), dtype=float)
+
+	utable += vector[:, :, 0].astype(float)
+	vtable += vector[:, :, 1].astype(float)
+
+	return xtable, ytable, utable, vtable, type_vector, ii_bckup
+
+
+def find_legacy_peaks(result_conv: np.ndarray, ii: np.ndarray, half_ia: int, sub_pix_offset: float) -> np.ndarray:
+	"""
+	Locate the correlation peaks as the 255 values of a uint8-normalized correlation.
+
+	Parameters:
+	result_conv (numpy.ndarray): Correlation normalized by normalize_to_uint8, shape (ia, ia, N).
+	ii (numpy.ndarray): Indices of the masked windows.
+	half_ia (int): Half size of the interrogation area.
+	sub_pix_offset (float): The subpixel offset value.
+
+	Returns:
+	numpy.ndarray: Array of subpixel peak displacements (x, y), shape (N, 2).
+	"""
 	result_conv[:, :, ii] = 0
 
 	result_conv_flat = np.reshape(result_conv, -1, order="F")
@@ -850,27 +1819,71 @@ def process_result_conv(
 	y1 = y[zi[i0]]
 	z1 = z[zi[i0]]
 
-	arrx_aux = np.arange(minix, maxix + 1, step) + half_ia
-	arry_aux = np.arange(miniy, maxiy + 1, step)
-	xtable = np.tile(arrx_aux, (arry_aux.shape[0], 1))
-	arry_aux = arry_aux + half_ia
-	arry_aux = arry_aux[:, np.newaxis]
-	arrx_aux = arrx_aux - half_ia
-	ytable = np.tile(arry_aux, (1, arrx_aux.shape[0]))
+	return subpixgauss(result_conv, half_ia, x1, y1, z1, sub_pix_offset)
 
-	vector = subpixgauss(result_conv, half_ia, x1, y1, z1, sub_pix_offset)
-	xtable_aux = xtable.transpose()
-	vector = vector.reshape((xtable_aux.shape[0], xtable_aux.shape[1], 2), order="F")
-	vector = vector.transpose(1, 0, 2)
 
-	if utable is None:
-		utable = np.zeros((xtable.shape[0], xtable.shape[1]), dtype=float)
-		vtable = np.zeros((ytable.shape[0], ytable.shape[1]), dtype=float)
+def find_correlation_peaks(
+		result_conv: np.ndarray, ii: np.ndarray, half_ia: int, sub_pix_offset: float
+) -> np.ndarray:
+	"""
+	Locate the correlation peak of every window with one argmax and refine it with a 3-point Gaussian fit.
 
-	utable += vector[:, :, 0].astype(float)
-	vtable += vector[:, :, 1].astype(float)
+	The fit is the one of subpixgauss, evaluated on the float correlation shifted by its per-window minimum, which
+	is what normalize_to_uint8 does before quantizing. Windows that are masked or have a flat correlation plane get
+	a zero displacement. Peaks on the window border have no neighbour on one side and are not refined.
 
-	return xtable, ytable, utable, vtable, type_vector, ii_bckup
+	Parameters:
+	result_conv (numpy.ndarray): Correlation planes of shape (ia, ia, N).
+	ii (numpy.ndarray): Indices of the masked windows.
+	half_ia (int): Half size of the interrogation area.
+	sub_pix_offset (float): The subpixel offset value.
+
+	Returns:
+	numpy.ndarray: Array of subpixel peak displacements (x, y), shape (N, 2).
+	"""
+	# compute_convolution returns a view of (N, ia, ia) planes, so this reshape does not copy
+	planes = np.moveaxis(result_conv, -1, 0)
+	num_windows, height, width = planes.shape
+	flat = planes.reshape(num_windows, height * width)
+
+	peak = np.argmax(flat, axis=1)
+	windows = np.arange(num_windows)
+	minimum = np.min(flat, axis=1).astype(float)
+	peak_value = flat[windows, peak].astype(float)
+
+	y, x = np.divmod(peak, width)
+	valid = peak_value > minimum
+	valid[ii] = False
+
+	vector = np.zeros((num_windows, 2))
+	windows = windows[valid]
+	y = y[valid]
+	x = x[valid]
+	minimum = minimum[valid]
+
+	# Neighbours outside the window are replaced by the peak itself, which cancels the refinement
+	inner_y = (y > 0) & (y < height - 1)
+	inner_x = (x > 0) & (x < width - 1)
+	y_prev = np.where(inner_y, y - 1, y)
+	y_next = np.where(inner_y, y + 1, y)
+	x_prev = np.where(inner_x, x - 1, x)
+	x_next = np.where(inner_x, x + 1, x)
+
+	with np.errstate(divide="ignore", invalid="ignore"):
+		f0 = np.log(planes[windows, y, x] - minimum)
+		f1y = np.log(planes[windows, y_prev, x] - minimum)
+		f2y = np.log(planes[windows, y_next, x] - minimum)
+		f1x = np.log(planes[windows, y, x_prev] - minimum)
+		f2x = np.log(planes[windows, y, x_next] - minimum)
+
+		peaky = np.where(inner_y, (f1y - f2y) / (2 * f1y - 4 * f0 + 2 * f2y), 0.0)
+		peakx = np.where(inner_x, (f1x - f2x) / (2 * f1x - 4 * f0 + 2 * f2x), 0.0)
+
+	# Same 1-based peak coordinates as subpixgauss
+	vector[windows, 0] = x + 1 + peakx - half_ia - sub_pix_offset
+	vector[windows, 1] = y + 1 + peaky - half_ia - sub_pix_offset
+
+	return vector
 
 
 def filter_std(utable: np.ndarray, vtable: np.ndarray, standard_threshold: float = 4.0) -> tuple:
@@ -1000,6 +2013,91 @@ def inpaint_nans(img_float):
 		return img_float
 
 
+@lru_cache(maxsize=16)
+def grid_laplacian(shape: Tuple[int, int]) -> sparse.csc_matrix:
+	"""
+	Build the 5-point Laplacian of a grid, with the missing neighbours of border cells left out.
+
+	The matrix is cached per shape and shared between calls, so it must not be modified.
+
+	Parameters:
+	shape (tuple): Shape (rows, cols) of the grid.
+
+	Returns:
+	scipy.sparse.csc_matrix: Matrix of shape (rows * cols, rows * cols) acting on the C-order flattened grid.
+	"""
+	index = np.arange(shape[0] * shape[1]).reshape(shape)
+	pairs = ((index[1:, :], index[:-1, :]), (index[:, 1:], index[:, :-1]))
+	first = np.concatenate([np.concatenate((a.ravel(), b.ravel())) for a, b in pairs])
+	second = np.concatenate([np.concatenate((b.ravel(), a.ravel())) for a, b in pairs])
+
+	adjacency = sparse.csr_matrix((np.ones(first.size), (first, second)), shape=(index.size, index.size))
+	degree = np.asarray(adjacency.sum(axis=1)).ravel()
+
+	return (adjacency - sparse.diags(degree)).tocsc()
+
+
+def inpaint_nans_sparse(img_float: np.ndarray, biharmonic: bool = True) -> np.ndarray:
+	"""
+	Replace NaN values by a smooth surface through the valid values, solving a sparse system over the NaN cells.
+
+	With biharmonic=False every NaN cell is the mean of its 4-neighbours (Laplace equation), which never overshoots
+	the valid values. With biharmonic=True the squared Laplacian of the whole grid is minimized, which continues
+	gradients through the holes and is closer to the RBF blend of inpaint_nans. In both cases there is one unknown
+	per NaN cell, so the cost grows linearly with the grid size instead of cubically with the number of valid vectors.
+
+	Parameters:
+	img_float (numpy.ndarray): 2D array with NaN values to fill.
+	biharmonic (bool, optional): Whether to use the biharmonic instead of the Laplace smoothness. Default is True.
+
+	Returns:
+	numpy.ndarray: Copy of img_float with the NaN values filled, or img_float itself if there is nothing to fill
+		or no valid value to fill it from.
+	"""
+	nan_mask = np.isnan(img_float)
+	if not nan_mask.any() or nan_mask.all():
+		return img_float
+
+	unknown = np.flatnonzero(nan_mask)
+	known = np.flatnonzero(~nan_mask)
+
+	laplacian = grid_laplacian(img_float.shape)
+	laplacian_unknown = laplacian[:, unknown]
+	rhs = -(laplacian[:, known] @ img_float.ravel()[known])
+
+	if biharmonic:
+		# Least squares on the Laplacian rows that involve at least one unknown
+		rows = np.unique(laplacian_unknown.indices)
+		laplacian_unknown = laplacian_unknown[rows]
+		system = (laplacian_unknown.T @ laplacian_unknown).tocsc()
+		rhs = laplacian_unknown.T @ rhs[rows]
+	else:
+		system = laplacian_unknown[unknown].tocsc()
+		rhs = rhs[unknown]
+
+	# Every NaN region touches a valid cell, so the system is non-singular
+	out = img_float.copy()
+	out[nan_mask] = spsolve(system, rhs)
+
+	return out
+
+
+def inpaint_table(img_float: np.ndarray, method: str = "rbf") -> np.ndarray:
+	"""
+	Replace NaN values of a vector table with the selected engine.
+
+	Parameters:
+	img_float (numpy.ndarray): 2D array with NaN values to fill.
+	method (str, optional): One of INPAINT_METHODS. Default is "rbf".
+
+	Returns:
+	numpy.ndarray: The table with the NaN values filled.
+	"""
+	if method == "rbf":
+		return inpaint_nans(img_float)
+	return inpaint_nans_sparse(img_float, biharmonic=method == "biharmonic")
+
+
 def interpgrade(table):
 	if table.size > 3:
 		return 3
@@ -1007,7 +2105,7 @@ def interpgrade(table):
 		return table.size - 1
 
 
-def interpolate_tables(
+def interpolation_grid(
 		minix: int,
 		maxix: int,
 		miniy: int,
@@ -1018,11 +2116,9 @@ def interpolate_tables(
 		interrogation_area: float,
 		xtable_old: np.ndarray,
 		ytable_old: np.ndarray,
-		utable: np.ndarray,
-		vtable: np.ndarray,
 ) -> tuple:
 	"""
-	Interpolate tables for interpolation and padding.
+	Compute the grids and spline degrees used by interpolate_tables.
 
 	Parameters:
 	minix, maxix, miniy, maxiy : int
@@ -1035,17 +2131,10 @@ def interpolate_tables(
 		The interrogation area size.
 	xtable_old, ytable_old : np.ndarray
 		Old tables for x and y.
-	utable, vtable : np.ndarray
-		Tables to be interpolated.
 
 	Returns:
-	xtable_1, ytable_1 : np.ndarray
-		Padded tables for x and y after interpolation and padding.
-	utable_1, vtable_1 : np.ndarray
-		Interpolated and padded displacement vector tables.
-	utable, vtable : np.ndarray
-		Interpolated displacement vector tables.
-
+	tuple
+		Contains the old and new grid axes, the spline degrees KX and KY, and the padded xtable_1 and ytable_1.
 	"""
 	# Create the x and y tables
 	xtable = np.tile(np.arange(minix, maxix + 1, step), (numelementsy, 1)) + interrogation_area / 2
@@ -1061,6 +2150,74 @@ def interpolate_tables(
 	KX = interpgrade(ytable_old_param)
 	KY = interpgrade(xtable_old_param)
 
+	# Add a line around the image for border regions using linear extrapolation
+	firstlinex = xtable[0, :]
+	firstlinex_intp_func = interpolate.interp1d(
+		np.arange(1, firstlinex.shape[0] + 1, 1), firstlinex, kind="linear", fill_value="extrapolate"
+	)
+	firstlinex_intp = firstlinex_intp_func(np.arange(0, firstlinex.shape[0] + 2, 1))
+	xtable_1 = np.tile(firstlinex_intp, (xtable.shape[0] + 2, 1))
+
+	firstliney = ytable[:, 0]
+	firstliney_intp_func = interpolate.interp1d(
+		np.arange(1, firstliney.shape[0] + 1, 1), firstliney, kind="linear", fill_value="extrapolate"
+	)
+	firstliney_intp = firstliney_intp_func(np.arange(0, firstliney.shape[0] + 2, 1))
+	firstliney_intp = firstliney_intp[:, np.newaxis]
+	ytable_1 = np.tile(firstliney_intp, (1, ytable.shape[1] + 2))
+
+	return xtable_old_param, ytable_old_param, xtable_param, ytable_param, KX, KY, xtable_1, ytable_1
+
+
+def interpolate_tables(
+		minix: int,
+		maxix: int,
+		miniy: int,
+		maxiy: int,
+		step: int,
+		numelementsx: int,
+		numelementsy: int,
+		interrogation_area: float,
+		xtable_old: np.ndarray,
+		ytable_old: np.ndarray,
+		utable: np.ndarray,
+		vtable: np.ndarray,
+		grid: Optional[tuple] = None,
+) -> tuple:
+	"""
+	Interpolate tables for interpolation and padding.
+
+	Parameters:
+	minix, maxix, miniy, maxiy : int
+		The minimum and maximum values for the x and y ranges.
+	step : int
+		The step size for creating the ranges.
+	numelementsx, numelementsy : int
+		The number of elements in the x and y directions.
+	interrogation_area : float
+		The interrogation area size.
+	xtable_old, ytable_old : np.ndarray
+		Old tables for x and y.
+	utable, vtable : np.ndarray
+		Tables to be interpolated.
+	grid : tuple, optional
+		Precomputed output of interpolation_grid for these tables.
+
+	Returns:
+	xtable_1, ytable_1 : np.ndarray
+		Padded tables for x and y after interpolation and padding.
+	utable_1, vtable_1 : np.ndarray
+		Interpolated and padded displacement vector tables.
+	utable, vtable : np.ndarray
+		Interpolated displacement vector tables.
+
+	"""
+	if grid is None:
+		grid = interpolation_grid(
+			minix, maxix, miniy, maxiy, step, numelementsx, numelementsy, interrogation_area, xtable_old, ytable_old
+		)
+	xtable_old_param, ytable_old_param, xtable_param, ytable_param, KX, KY, xtable_1, ytable_1 = grid
+
 	# Interpolate utable
 	funct_interp = interpolate.RectBivariateSpline(
 		ytable_old_param,
@@ -1087,23 +2244,33 @@ def interpolate_tables(
 	utable_1 = np.pad(utable, ((1, 1), (1, 1)), "edge")
 	vtable_1 = np.pad(vtable, ((1, 1), (1, 1)), "edge")
 
-	# Add a line around the image for border regions using linear extrapolation
-	firstlinex = xtable[0, :]
-	firstlinex_intp_func = interpolate.interp1d(
-		np.arange(1, firstlinex.shape[0] + 1, 1), firstlinex, kind="linear", fill_value="extrapolate"
-	)
-	firstlinex_intp = firstlinex_intp_func(np.arange(0, firstlinex.shape[0] + 2, 1))
-	xtable_1 = np.tile(firstlinex_intp, (xtable.shape[0] + 2, 1))
+	return xtable_1, ytable_1, utable_1, vtable_1, utable, vtable
 
-	firstliney = ytable[:, 0]
-	firstliney_intp_func = interpolate.interp1d(
-		np.arange(1, firstliney.shape[0] + 1, 1), firstliney, kind="linear", fill_value="extrapolate"
-	)
-	firstliney_intp = firstliney_intp_func(np.arange(0, firstliney.shape[0] + 2, 1))
-	firstliney_intp = firstliney_intp[:, np.newaxis]
-	ytable_1 = np.tile(firstliney_intp, (1, ytable.shape[1] + 2))
 
-	return xtable_1, ytable_1, utable_1, vtable_1, utable, vtable
+def deform_grid(X: np.ndarray, Y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+	"""
+	Create the fine pixel grid used by deform_window to remap the second image.
+
+	Parameters:
+	X, Y : np.ndarray
+		Grid coordinates for the coarse displacement field (usually from meshgrid).
+
+	Returns:
+	tuple
+		Destination meshgrid (xx, yy), each of shape (H, W).
+	"""
+	x0 = int(round(X[0, 0]))
+	x1 = int(round(X[0, -1]))  # exclusive
+	y0 = int(round(Y[0, 0]))
+	y1 = int(round(Y[-1, 0]))  # exclusive
+
+	x1d = np.arange(x0, x1, dtype=np.float32)  # Width coordinates
+	y1d = np.arange(y0, y1, dtype=np.float32)  # Height coordinates
+
+	# Create meshgrid for destination coordinates
+	xx, yy = np.meshgrid(x1d, y1d, indexing='xy')  # shape (H, W)
+
+	return xx, yy
 
 
 def deform_window(
@@ -1111,7 +2278,8 @@ def deform_window(
 		Y: np.ndarray,
 		U: np.ndarray,
 		V: np.ndarray,
-		image2_roi: np.ndarray
+		image2_roi: np.ndarray,
+		grid: Optional[tuple] = None,
 ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
 	"""
 	Deform the second ROI image using interpolated displacement fields.
@@ -1127,6 +2295,8 @@ def deform_window(
 		Displacement fields (horizontal and vertical).
 	image2_roi : np.ndarray
 		The second ROI image to be deformed based on U and V.
+	grid : tuple, optional
+		Precomputed destination meshgrid (xx, yy) from deform_grid.
 
 	Returns:
 	tuple
@@ -1139,18 +2309,10 @@ def deform_window(
 	# -------------------------------------------------------------------------
 	# 1. Create the fine pixel grid for remapping
 	# -------------------------------------------------------------------------
-	x0 = int(round(X[0, 0]))
-	x1 = int(round(X[0, -1]))  # exclusive
-	y0 = int(round(Y[0, 0]))
-	y1 = int(round(Y[-1, 0]))  # exclusive
-
-	x1d = np.arange(x0, x1, dtype=np.float32)  # Width coordinates
-	y1d = np.arange(y0, y1, dtype=np.float32)  # Height coordinates
-	W = x1d.size
-	H = y1d.size
-
-	# Create meshgrid for destination coordinates
-	xx, yy = np.meshgrid(x1d, y1d, indexing='xy')  # shape (H, W)
+	if grid is None:
+		grid = deform_grid(X, Y)
+	xx, yy = grid
+	H, W = xx.shape
 
 	# -------------------------------------------------------------------------
 	# 2. Upsample displacement fields (bilinear interpolation)
@@ -1184,16 +2346,16 @@ def deform_window(
 
 def calculate_gradient(
 		image1_cut: np.ndarray, image2_cut: np.ndarray, image1_roi: np.ndarray, utable: np.ndarray,
-		ii_backup: int | list
+		ii_backup: int | list, active: Optional[np.ndarray] = None
 ) -> np.ndarray:
 	"""
 	Calculate the gradient of the combined images with respect to image1_roi.
 
 	Parameters:
 	image1_cut : np.ndarray
-		The sub-regions of the first image.
+		The sub-regions of the first image, shaped (ia, ia, N) or (ny, nx, ia, ia).
 	image2_cut : np.ndarray
-		The sub-regions of the second image.
+		The sub-regions of the second image, in the same layout as image1_cut.
 	image1_roi : np.ndarray
 		The region of interest from the first image.
 	utable : np.ndarray
@@ -1202,29 +2364,52 @@ def calculate_gradient(
 	ii_backup : list of int
 		The indices of the slices or regions where gradient values should be set to NaN. This is used to
 		exclude certain regions from the gradient calculation.
+	active : np.ndarray, optional
+		Boolean (ny, nx) selection of the windows to compute, as in compute_convolution. The others are NaN.
+		Default is all the windows.
 
 	Returns:
 	np.ndarray
 		The sum of gradients for each displacement vector, adjusted for NaN values where specified by ii_backup.
 		The output is reshaped to match the dimensions of utable and transposed to align with expected output format.
 	"""
+	if active is not None:
+		selected = active.reshape(-1)
+		if image1_cut.ndim == 4:
+			image1_cut = np.moveaxis(image1_cut[active], 0, -1)
+			image2_cut = np.moveaxis(image2_cut[active], 0, -1)
+		else:
+			image1_cut = image1_cut[:, :, selected]
+			image2_cut = image2_cut[:, :, selected]
+
 	# Combine images
 	combined_image = image1_cut.astype(np.float32) + image2_cut.astype(np.float32)
 
 	# Divide by the max of image1_roi along axes 0 and 1
 	combined_image /= np.max(image1_roi, axis=(0, 1))
 
+	# Window rows and columns are the first two axes of (ia, ia, N) stacks and the last two of strided windows
+	axis_y, axis_x = (0, 1) if combined_image.ndim == 3 else (-2, -1)
+	pad_x = [(0, 0)] * combined_image.ndim
+	pad_x[axis_x] = (0, 1)
+	pad_y = [(0, 0)] * combined_image.ndim
+	pad_y[axis_y] = (0, 1)
+
 	# Compute gradients gx and gy
-	gx = np.diff(combined_image, axis=1)
-	gx = np.pad(gx, ((0, 0), (0, 1), (0, 0)), mode="edge")
+	gx = np.diff(combined_image, axis=axis_x)
+	gx = np.pad(gx, pad_x, mode="edge")
 
-	gy = np.diff(combined_image, axis=0)
-	gy = np.pad(gy, ((0, 1), (0, 0), (0, 0)), mode="edge")
+	gy = np.diff(combined_image, axis=axis_y)
+	gy = np.pad(gy, pad_y, mode="edge")
 
 	gradient_sum = np.abs(gx) + np.abs(gy)
 
-	# Sum gradients
-	gradient_sum_result = np.sum(gradient_sum, axis=(0, 1))
+	# Sum gradients, one value per window in row-major grid order
+	gradient_sum_result = np.sum(gradient_sum, axis=(axis_y, axis_x)).reshape(-1)
+	if active is not None:
+		partial = gradient_sum_result
+		gradient_sum_result = np.full(selected.size, np.nan, dtype=partial.dtype)
+		gradient_sum_result[selected] = partial
 
 	# Set the ii_bckup-th slice to NaN
 	gradient_sum_result[ii_backup] = np.nan
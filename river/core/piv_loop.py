@@ -1,7 +1,97 @@
+from collections import OrderedDict
 from pathlib import Path
+from typing import Optional
 import numpy as np
 import river.core.image_preprocessing as impp
-from river.core.piv_fftmulti import piv_fftmulti
+from river.core.background_models import WindowedBackground
+from river.core.piv_fftmulti import (
+    PivPlan,
+    create_piv_plan,
+    fft_batch_size,
+    piv_fftmulti,
+    piv_fftmulti_batch,
+    predictor_field,
+    warm_up_fft,
+)
+from river.core.piv_results import PivResultStore
+from river.core.piv_stations import STATION_NEIGHBOURHOOD, create_station_plan
+
+
+class FrameRing:
+    """
+    Small ring buffer of preprocessed frames.
+
+    Each frame is decoded and filtered once and kept until it has been used as ``image2`` of one pair and
+    ``image1`` of the next, so a contiguous frame range costs one decode per frame.
+
+    A WindowedBackground is interpolated at the position of every frame in the analysis, its index plus
+    frame_offset.
+    """
+
+    def __init__(
+        self,
+        path_images: list,
+        filter_grayscale: bool,
+        filter_clahe: bool,
+        clip_limit_clahe: int,
+        filter_sub_background: bool,
+        background: np.ndarray,
+        size: int = 2,
+        frame_offset: int = 0,
+    ):
+        self.path_images = path_images
+        self.filter_grayscale = filter_grayscale
+        self.filter_clahe = filter_clahe
+        self.clip_limit_clahe = clip_limit_clahe
+        self.filter_sub_background = filter_sub_background
+        self.background = background
+        self.size = size
+        self.frame_offset = frame_offset
+        self.decoded = 0
+        self._frames = OrderedDict()
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index not in self._frames:
+            if len(self._frames) >= self.size:
+                self._frames.popitem(last=False)
+            background = self.background
+            if isinstance(background, WindowedBackground):
+                background = background.at(index + self.frame_offset)
+            self._frames[index] = impp.preprocess_image(
+                self.path_images[index],
+                self.filter_grayscale,
+                self.filter_clahe,
+                self.clip_limit_clahe,
+                self.filter_sub_background,
+                background,
+            )
+            self.decoded += 1
+        return self._frames[index]
+
+
+def loop_plan(
+    image_shape: tuple,
+    bbox: list,
+    interrogation_area_1: int,
+    interrogation_area_2: int,
+    step: int,
+    multipass: bool,
+    stations: Optional[np.ndarray] = None,
+    station_neighbourhood: int = STATION_NEIGHBOURHOOD,
+) -> PivPlan:
+    """
+    Build the plan used by piv_loop for frames of the given shape, restricted to the stations when given.
+    """
+    if stations is None:
+        mask_piv = np.ones(image_shape[:2], dtype=np.uint8)
+        return create_piv_plan(
+            image_shape, bbox, mask_piv, interrogation_area_1, interrogation_area_2, step, multipass
+        )
+    return create_station_plan(
+        image_shape, bbox, stations, interrogation_area_1, interrogation_area_2, step, multipass,
+        station_neighbourhood,
+    )
+
 
 def piv_loop(
     path_images: Path,
@@ -24,69 +114,143 @@ def piv_loop(
     background: np.ndarray,
     start: int,
     end: int,
+    peak_finder: str = "argmax",
+    inpaint_method: str = "rbf",
+    stations: Optional[np.ndarray] = None,
+    station_neighbourhood: int = STATION_NEIGHBOURHOOD,
+    predictor_refresh: int = 0,
+    batch_pairs: int = 1,
+    warm_up: bool = False,
+    plan: Optional[PivPlan] = None,
+    store: Optional[PivResultStore] = None,
+    store_start: int = 0,
+    statistics: Optional[dict] = None,
+    keep_frames: bool = True,
+    frame_offset: int = 0,
 ) -> dict:
     """
-    Perform PIV analysis over a range of frames.
+    Perform PIV analysis over a contiguous range of frames.
+
+    The pairs (start, start + 1), ..., (end - 1, end) are processed in order and every frame in the range is
+    decoded and preprocessed once through a FrameRing. Grids, index tables and filter kernels are computed once
+    in a PivPlan and shared by all the pairs. With stations, only the windows around them are correlated and the
+    other vectors are NaN, see piv_stations.
+
+    With predictor_refresh > 0, the smoothed field of each pair is the deformation predictor of the next one,
+    which skips its first pass. A full first pass still runs on the first pair of the range and then every
+    predictor_refresh pairs, so that drift and outliers do not propagate through the whole range.
+
+    With batch_pairs > 1, the windows of that many consecutive pairs are correlated in one batched FFT per pass,
+    see piv_fftmulti_batch; 0 picks the largest batch that fits in FFT_BATCH_MEMORY. Predicted pairs depend on
+    the previous one, so batching is not used with predictor_refresh.
+
+    With warm_up, the FFTs of full batches of both passes are planned before the first pair, see warm_up_fft.
+
+    A plan built by loop_plan and a store can be shared by several threads running disjoint ranges: the pair
+    (fr, fr + 1) is then written in column fr - store_start of the store. Without a store, the range gets its own.
+
+    With statistics, a dict of piv_statistics.StreamingStatistics keyed by result field, every pair also updates
+    them. Without keep_frames the pairs are not stored at all and only the statistics are returned.
+
+    background may be a WindowedBackground, see background_models. It is interpolated at the position of every
+    frame in the analysis: its index in path_images plus frame_offset, which is non-zero for a block of streamed
+    frames.
     """
     fr = start
     last_fr = end
 
-    dict_cumul = {"u": 0, "v": 0, "x": 0, "y": 0}
+    frames = FrameRing(
+        path_images, filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background, background,
+        frame_offset=frame_offset,
+    )
 
-    # Create mask_piv for PIV calculations
-    mask_piv = np.ones_like(mask, dtype=np.uint8)
+    if plan is None:
+        plan = loop_plan(
+            frames[fr].shape, bbox, interrogation_area_1, interrogation_area_2, step, multipass, stations,
+            station_neighbourhood,
+        )
 
-    # Preprocess the first frame only once
-    image1 = impp.preprocess_image(
-        path_images[fr], filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background, background
-    )
+    if store is None and keep_frames:
+        # One preallocated float32 column per pair of the range
+        store = PivResultStore(plan.second_pass.numelementsy * plan.second_pass.numelementsx, last_fr - fr)
+        store_start = start
+    xtable = ytable = None
+    predictor = None
+
+    if predictor_refresh > 0:
+        batch_pairs = 1
+    elif batch_pairs <= 0:
+        batch_pairs = fft_batch_size(plan)
+    # Every frame of a batch is kept until the batch is done
+    frames.size = max(frames.size, batch_pairs + 1)
+
+    if warm_up:
+        warm_up_fft(plan, batch_pairs)
 
     while fr < last_fr:
-        image2 = impp.preprocess_image(
-            path_images[fr + 1], filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background, background
-        )
+        count = min(batch_pairs, last_fr - fr)
 
-        xtable, ytable, utable, vtable, typevector, gradient = piv_fftmulti(
-            image1,
-            image2,
-            mask=mask_piv,
-            bbox=bbox,
-            interrogation_area_1=interrogation_area_1,
-            interrogation_area_2=interrogation_area_2,
-            mask_auto=mask_auto,
-            multipass=multipass,
-            standard_filter=standard_filter,
-            standard_threshold=standard_threshold,
-            median_test_filter=median_test_filter,
-            epsilon=epsilon,
-            threshold=threshold,
-            step=step,
-        )
+        if count > 1:
+            results = piv_fftmulti_batch(
+                [(frames[index], frames[index + 1]) for index in range(fr, fr + count)],
+                plan,
+                mask_auto=mask_auto,
+                standard_filter=standard_filter,
+                standard_threshold=standard_threshold,
+                median_test_filter=median_test_filter,
+                epsilon=epsilon,
+                threshold=threshold,
+                peak_finder=peak_finder,
+                inpaint_method=inpaint_method,
+            )
+        else:
+            if predictor_refresh <= 0 or (fr - start) % predictor_refresh == 0:
+                predictor = None
+
+            results = [
+                piv_fftmulti(
+                    frames[fr],
+                    frames[fr + 1],
+                    mask_auto=mask_auto,
+                    standard_filter=standard_filter,
+                    standard_threshold=standard_threshold,
+                    median_test_filter=median_test_filter,
+                    epsilon=epsilon,
+                    threshold=threshold,
+                    plan=plan,
+                    peak_finder=peak_finder,
+                    inpaint_method=inpaint_method,
+                    predictor=predictor,
+                )
+            ]
+
+            if predictor_refresh > 0:
+                predictor = predictor_field(plan, results[0][2], results[0][3])
+
+        for offset, (xtable, ytable, utable, vtable, typevector, gradient) in enumerate(results):
+            x_indices = np.clip(xtable.astype(int), 0, mask.shape[1] - 1)
+            y_indices = np.clip(ytable.astype(int), 0, mask.shape[0] - 1)
+            in_mask = mask[y_indices, x_indices] > 0
+
+            utable = utable.astype(float)
+            vtable = vtable.astype(float)
+            utable[~in_mask] = np.nan
+            vtable[~in_mask] = np.nan
+
+            values = {
+                "u": utable.reshape(-1, 1),
+                "v": vtable.reshape(-1, 1),
+                "typevector": typevector.reshape(-1, 1),
+                "gradient": gradient.reshape(-1, 1),
+            }
+            if keep_frames:
+                store.write(fr - store_start + offset, values)
+            if statistics is not None:
+                for field, accumulator in statistics.items():
+                    accumulator.update(values[field])
+
+        fr += count
 
-        x_indices = np.clip(xtable.astype(int), 0, mask.shape[1] - 1)
-        y_indices = np.clip(ytable.astype(int), 0, mask.shape[0] - 1)
-        in_mask = mask[y_indices, x_indices] > 0
-
-        utable = utable.astype(float)
-        vtable = vtable.astype(float)
-        utable[~in_mask] = np.nan
-        vtable[~in_mask] = np.nan
-
-        try:
-            dict_cumul["u"] = np.hstack((dict_cumul["u"], utable.reshape(-1, 1)))
-            dict_cumul["v"] = np.hstack((dict_cumul["v"], vtable.reshape(-1, 1)))
-            dict_cumul["typevector"] = np.hstack((dict_cumul["typevector"], typevector.reshape(-1, 1)))
-            dict_cumul["gradient"] = np.hstack((dict_cumul["gradient"], gradient.reshape(-1, 1)))
-
-        except ValueError:
-            dict_cumul["u"] = utable.reshape(-1, 1)
-            dict_cumul["v"] = vtable.reshape(-1, 1)
-            dict_cumul["typevector"] = typevector.reshape(-1, 1)
-            dict_cumul["gradient"] = gradient.reshape(-1, 1)
-            dict_cumul["x"] = xtable
-            dict_cumul["y"] = ytable
-
-        image1 = image2
-        fr += 1
-
-    return dict_cumul
+    if not keep_frames:
+        return {"x": xtable, "y": ytable, "statistics": statistics}
+    return {"x": xtable, "y": ytable, **store.arrays}
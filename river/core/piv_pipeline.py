@@ -1,25 +1,451 @@
-import multiprocessing
 import time
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from dataclasses import replace
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
 import cv2
 import numpy as np
 from tqdm import tqdm
 
 import river.core.image_preprocessing as impp
+from river.core.background_models import (
+    DEFAULT_PERCENTILE,
+    BackgroundOptions,
+    WindowedBackground,
+    compute_background,
+    read_frames,
+    stream_frames,
+)
+from river.core.concurrency import initialize_worker, resolve_budget, thread_limits
 from river.core.exceptions import ImageReadError
-from river.core.piv_fftmulti import piv_fftmulti
-from river.core.piv_loop import piv_loop
+from river.core.fftw_wisdom import export_fftw_wisdom, import_fftw_wisdom
+from river.core.frame_stack import FrameStack, is_frame_stack
+from river.core.piv_ensemble import ensemble_plan, sum_ensemble
+from river.core.piv_fftmulti import (
+    PEAK_FINDERS,
+    PivPlan,
+    deformation_field,
+    first_pass_field,
+    piv_fftmulti,
+    second_pass_field,
+)
+from river.core.piv_loop import loop_plan, piv_loop
+from river.core.piv_results import PivResults, PivResultStore, StoreHandle, save_piv_results, write_piv_header
+from river.core.piv_stations import STATION_NEIGHBOURHOOD, station_bbox
+from river.core.piv_statistics import STATISTICS_FIELDS, create_statistics, merge_statistics
+from river.core.shared_arrays import release_blocks, share_array
+from river.core.video_index import VideoFrameReader
+from river.core.video_stream import VideoFrameStream, frame_name, is_video
+
+# Number of contiguous frame ranges handed to each worker. More ranges balance the load better, while each
+# extra range boundary costs one frame that is decoded by both neighbouring ranges.
+CHUNKS_PER_WORKER = 4
+
+# How run_analyze_all runs the frame ranges: worker processes, threads of this process, or threads of worker processes
+EXECUTORS = ("process", "thread", "hybrid")
+
+# Number of pairs of each block of frames streamed from a video to the workers
+VIDEO_BLOCK_PAIRS = 16
+
+# Number of tasks of streamed frames queued per worker, which bounds the frames held in memory
+VIDEO_TASKS_PER_WORKER = 2
+
+
+# Inputs of a worker process, mapped once by initialize_shared_worker
+worker_inputs = {}
+
+
+def initialize_shared_worker(
+    threads: int, loop_options: dict, arrays: dict, store_handle: Optional[StoreHandle], plan: PivPlan
+):
+    """
+    Initializer of the PIV worker processes: size their thread pools and map the shared inputs and results.
+
+    Parameters:
+    threads : int
+        Number of library threads of the worker.
+    loop_options : dict
+        piv_loop keyword arguments shared by all the frame ranges.
+    arrays : dict
+        SharedArray references of the "mask" and "background" arguments of piv_loop, None for a missing one. A
+        WindowedBackground holds the reference of its backgrounds.
+    store_handle : StoreHandle, optional
+        The result store, written by pair index. Without it, only the statistics of every range are kept.
+    plan : PivPlan
+        The plan built by loop_plan.
+    """
+    initialize_worker(threads)
+
+    options = dict(loop_options)
+    blocks = []
+    for name, reference in arrays.items():
+        options[name] = None
+        if isinstance(reference, WindowedBackground):
+            block, backgrounds = reference.backgrounds.attach(writeable=False)
+            options[name] = replace(reference, backgrounds=backgrounds)
+            blocks.append(block)
+        elif reference is not None:
+            block, options[name] = reference.attach(writeable=False)
+            blocks.append(block)
+
+    # The blocks stay mapped for the life of the worker
+    store = None if store_handle is None else PivResultStore.attach(store_handle)
+    worker_inputs.update(options=options, plan=plan, store=store, blocks=blocks)
+
+
+def run_shared_ranges(frame_ranges: list, frames: Optional[list] = None) -> list:
+    """
+    Run consecutive frame ranges in a worker process, writing their pairs straight into the shared result store.
+
+    Several ranges run on threads of the worker, sharing its plan.
+
+    Parameters:
+    frame_ranges : list
+        The (start, end) pairs of each range.
+    frames : list, optional
+        The decoded frames of each range, e.g. streamed from a video. Defaults to the images of the analysis.
+
+    Returns:
+    list
+        The statistics of each range without a result store, see piv_statistics, otherwise None for each range.
+    """
+    options = worker_inputs["options"]
+    plan = worker_inputs["plan"]
+    store = worker_inputs["store"]
+    num_vectors = plan.second_pass.numelementsy * plan.second_pass.numelementsx
+
+    if frames is None:
+        frames = [None] * len(frame_ranges)
+
+    def run_range(frame_range, range_frames):
+        statistics = None if store is not None else create_statistics(num_vectors)
+        piv_loop(
+            plan=plan, store=store, statistics=statistics, keep_frames=store is not None,
+            **range_options(options, frame_range, range_frames)
+        )
+        return statistics
+
+    if len(frame_ranges) == 1:
+        return [run_range(frame_ranges[0], frames[0])]
+
+    with ThreadPoolExecutor(max_workers=len(frame_ranges)) as pool:
+        return list(pool.map(run_range, frame_ranges, frames))
+
+
+def range_options(loop_options: dict, frame_range: tuple, frames: Optional[list] = None) -> dict:
+    """
+    Complete the piv_loop arguments shared by every range with those of one range.
+
+    Parameters:
+    loop_options : dict
+        piv_loop keyword arguments shared by all the frame ranges.
+    frame_range : tuple
+        The (start, end) pairs of the range.
+    frames : list, optional
+        The decoded frames of the range, frame_range[1] - frame_range[0] + 1 of them. Their pair i is written as
+        the pair frame_range[0] + i of the store, and their frame i is the frame frame_range[0] + i of the analysis.
+
+    Returns:
+    dict
+        The piv_loop keyword arguments of the range.
+    """
+    if frames is None:
+        return dict(loop_options, start=frame_range[0], end=frame_range[1])
+    return dict(
+        loop_options, path_images=frames, start=0, end=len(frames) - 1, store_start=-frame_range[0],
+        frame_offset=frame_range[0],
+    )
+
+
+def stream_tasks(frames: Iterator, first_frames: list, group_size: int, block_pairs: int = VIDEO_BLOCK_PAIRS):
+    """
+    Cut a stream of frames into blocks of consecutive pairs, grouped into tasks.
+
+    Consecutive blocks share their boundary frame, so every pair of the stream belongs to exactly one block.
+
+    Parameters:
+    frames : Iterator
+        The (frame_number, frame) of a VideoFrameStream, after first_frames.
+    first_frames : list
+        The frames already read from the stream.
+    group_size : int
+        Number of blocks per task.
+    block_pairs : int, optional
+        Number of pairs per block. Default is VIDEO_BLOCK_PAIRS.
+
+    Yields:
+    tuple
+        The (start, end) pairs of each block of a task, and the frames of each block.
+    """
+    group, blocks = [], []
+    block = list(first_frames)
+    start = 0
+
+    for _, frame in frames:
+        block.append(frame)
+        if len(block) == block_pairs + 1:
+            group.append((start, start + block_pairs))
+            blocks.append(block)
+            start += block_pairs
+            block = [frame]
+            if len(group) == group_size:
+                yield group, blocks
+                group, blocks = [], []
+
+    if len(block) > 1:
+        group.append((start, start + len(block) - 1))
+        blocks.append(block)
+    if len(group) > 0:
+        yield group, blocks
+
+
+def split_frame_range(total_pairs: int, num_chunks: int) -> list:
+    """
+    Split the pairs (0, 1), ..., (total_pairs - 1, total_pairs) into contiguous frame ranges.
+
+    Parameters:
+    total_pairs : int
+        The number of consecutive image pairs to process.
+    num_chunks : int
+        The maximum number of ranges to create.
+
+    Returns:
+    list
+        List of (start, end) tuples, each covering the pairs start..end - 1 with no overlap between ranges.
+    """
+    num_chunks = max(1, min(num_chunks, total_pairs))
+    bounds = np.linspace(0, total_pairs, num_chunks + 1).round().astype(int)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def load_background(background_path: Path, options: BackgroundOptions, save_background: bool, frames: Iterator):
+    """
+    Read a background image, or compute the background in one pass over the frames and save it there.
+
+    Windowed backgrounds change along the video, so they are always computed and never saved.
+
+    Parameters:
+    background_path : Path
+        The cached background image.
+    options : BackgroundOptions
+        How the background is computed.
+    save_background : bool
+        Whether to save a computed background.
+    frames : Iterator
+        The lazy (position, frame) of the background frames, subsampled by options.every, see
+        background_models.compute_background. They are only read when the background is computed.
+
+    Returns:
+    np.ndarray, WindowedBackground or None
+        The background, None without frames.
+    """
+    if options.window is None and background_path.exists():
+        return cv2.imread(str(background_path), cv2.IMREAD_GRAYSCALE)
+
+    background = compute_background(frames, options.method, options.percentile, options.window)
+    if options.window is not None:
+        return background
+    if save_background and background is not None:
+        background_path.parent.mkdir(parents=True, exist_ok=True)
+        cv2.imwrite(str(background_path), background)
+    return background
+
+
+def load_analysis_inputs(
+    images_location: Path,
+    mask: Optional[np.ndarray],
+    bbox: Optional[list],
+    filter_sub_background: bool,
+    save_background: bool,
+    workdir: Optional[Path],
+    background_options: Optional[BackgroundOptions] = None,
+) -> tuple:
+    """
+    List the frames of an analysis and fill in the default mask, bbox and background.
+
+    Parameters:
+    images_location : Path
+        Folder with the JPG frames.
+    mask : np.ndarray, optional
+        The mask for the region of interest. Defaults to the whole frame.
+    bbox : list, optional
+        The bounding box for the region of interest. Defaults to the whole frame.
+    filter_sub_background : bool
+        Whether the background will be subtracted.
+    save_background : bool
+        Whether to save a computed background, as background.jpg for the mean, see BackgroundOptions.file_name.
+    workdir : Path, optional
+        Folder of the background image. Defaults to images_location.
+    background_options : BackgroundOptions, optional
+        How the background is computed. Defaults to the mean of all the frames.
+
+    Returns:
+    tuple
+        The sorted frame paths, the mask, the bbox and the background (None without background subtraction), a
+        WindowedBackground with a background window.
+    """
+    background = None
+    options = background_options or BackgroundOptions()
+    images = sorted([str(f) for f in images_location.glob("*.jpg")])
+
+    if len(images) == 0:
+        raise ImageReadError(f"No JPG images found in {images_location}")
+
+    first_image = cv2.imread(images[0], cv2.IMREAD_GRAYSCALE)
+    if first_image is None:
+        raise ImageReadError(f"Could not read first image: {images[0]}")
+
+    if mask is None:
+        mask = np.ones(first_image.shape, dtype=np.uint8)
+
+    if bbox is None:
+        height, width = first_image.shape[:2]
+        bbox = [0, 0, width, height]
+
+    if filter_sub_background:
+        background = load_background(
+            (workdir or images_location).joinpath(options.file_name),
+            options,
+            save_background,
+            read_frames(images, impp.load_and_process_image, options.every),
+        )
+
+    return images, mask, bbox, background
+
+
+def load_video_inputs(
+    video_path: Path,
+    mask: Optional[np.ndarray],
+    bbox: Optional[list],
+    filter_sub_background: bool,
+    save_background: bool,
+    workdir: Optional[Path],
+    start_frame: int = 0,
+    end_frame: Optional[int] = None,
+    every: int = 1,
+    resize_factor: float = 1.0,
+    background_options: Optional[BackgroundOptions] = None,
+) -> tuple:
+    """
+    Open the frame stream of a video analysis and fill in the default mask, bbox and background.
+
+    Parameters:
+    video_path : Path
+        The video.
+    mask, bbox, filter_sub_background, save_background :
+        See load_analysis_inputs.
+    workdir : Path, optional
+        Folder of the background image. Defaults to the folder of the video.
+    start_frame, end_frame, every, resize_factor :
+        Selection and resizing of the frames, as in video_to_frames.
+    background_options : BackgroundOptions, optional
+        See load_analysis_inputs. The background frames are decoded in a first pass over the video.
+
+    Returns:
+    tuple
+        The VideoFrameStream, not started yet, the mask, the bbox and the background (None without background
+        subtraction).
+    """
+    background = None
+    options = background_options or BackgroundOptions()
+    stream = VideoFrameStream(video_path, start_frame, end_frame, every, resize_factor)
+
+    if len(stream) < 2:
+        raise ImageReadError(f"At least two frames are needed in {video_path}")
+
+    # The first selected frame alone, for the default mask and bbox
+    with VideoFrameStream(
+        video_path, stream.frame_numbers[0], stream.frame_numbers[0] + 1, 1, resize_factor
+    ) as first_stream:
+        first_image = next(iter(first_stream), (None, None))[1]
+    if first_image is None:
+        raise ImageReadError(f"Could not read the first frame of {video_path}")
+
+    if mask is None:
+        mask = np.ones(first_image.shape, dtype=np.uint8)
+
+    if bbox is None:
+        height, width = first_image.shape[:2]
+        bbox = [0, 0, width, height]
+
+    if filter_sub_background:
+        background = load_background(
+            (workdir or video_path.parent).joinpath(options.file_name),
+            options,
+            save_background,
+            stream_frames(video_path, start_frame, end_frame, every, resize_factor, options.every),
+        )
+
+    return stream, mask, bbox, background
+
+
+def load_stack_inputs(
+    stack_path: Path,
+    mask: Optional[np.ndarray],
+    bbox: Optional[list],
+    filter_sub_background: bool,
+    save_background: bool,
+    workdir: Optional[Path],
+    background_options: Optional[BackgroundOptions] = None,
+) -> tuple:
+    """
+    Open a frame stack and express the mask, bbox and background in its cropped coordinates.
+
+    Parameters:
+    stack_path : Path
+        The frame stack folder written by video_to_frames.
+    mask, bbox :
+        See load_analysis_inputs, in pixels of the full frames. The bbox defaults to the crop of the stack and
+        must lie inside it.
+    filter_sub_background, save_background :
+        See load_analysis_inputs.
+    workdir : Path, optional
+        Folder of a full-frame background image. Without one, the background is computed from the stack and saved
+        inside it.
+    background_options : BackgroundOptions, optional
+        See load_analysis_inputs.
+
+    Returns:
+    tuple
+        The FrameStack, the mask, the bbox and the background (None without background subtraction).
+    """
+    background = None
+    options = background_options or BackgroundOptions()
+    stack = FrameStack(stack_path)
+
+    if len(stack) < 2:
+        raise ImageReadError(f"At least two frames are needed in {stack_path}")
+
+    if mask is None:
+        mask = np.ones(stack.frames.shape[1:], dtype=np.uint8)
+    else:
+        mask = np.ascontiguousarray(stack.crop(mask))
+
+    if bbox is None:
+        height, width = stack.frames.shape[1:]
+        bbox = [0, 0, width, height]
+    else:
+        bbox = stack.shift_bbox(bbox)
+
+    if filter_sub_background:
+        full_background = None if workdir is None else workdir.joinpath(options.file_name)
+        if options.window is None and full_background is not None and full_background.exists():
+            background = np.ascontiguousarray(stack.crop(cv2.imread(str(full_background), cv2.IMREAD_GRAYSCALE)))
+        else:
+            background = load_background(
+                stack.path.joinpath(options.file_name),
+                options,
+                save_background,
+                ((position, stack[position]) for position in range(0, len(stack), options.every)),
+            )
+
+    return stack, mask, bbox, background
 
-def run_single_pair(args):
-    from river.core.piv_loop import piv_loop
-    return piv_loop(*args)
 
 def run_test(
     image_1: Path,
-    image_2: Path,
+    image_2: Optional[Path],
     mask: np.ndarray = None,
     bbox: list = None,
     interrogation_area_1: int = 128,
@@ -38,21 +464,39 @@ def run_test(
     filter_sub_background: bool = False,
     save_background: bool = True,
     workdir: Path = None,
+    peak_finder: str = "argmax",
+    inpaint_method: str = "rbf",
+    frame: int = 0,
+    every: int = 1,
+    resize_factor: float = 1.0,
+    background_method: str = "mean",
+    background_percentile: float = DEFAULT_PERCENTILE,
+    background_every: int = 1,
 ):
+    """
+    Run the PIV on a single pair, for a preview of the settings. image_1 may be a video, in which case the pair is
+    read straight from it through its keyframe index, frames frame and frame + every, and image_2 is ignored.
+
+    The background is computed with background_method from every background_every-th frame, see background_models.
+    """
     background = None
+    video_path = image_1 if is_video(image_1) else None
 
     if filter_sub_background:
         filter_grayscale = True
-        background_path = (workdir or image_1.parent).joinpath("background.jpg")
-
-        if background_path.exists():
-            background = cv2.imread(str(background_path), cv2.IMREAD_GRAYSCALE)
+        options = BackgroundOptions(background_method, background_percentile, background_every)
+        if video_path is not None:
+            frames = stream_frames(video_path, every=every, resize_factor=resize_factor, subsample=options.every)
         else:
-            background = impp.calculate_average(image_1.parent)
-            if save_background and background is not None:
-                save_path = background_path
-                save_path.parent.mkdir(parents=True, exist_ok=True)
-                cv2.imwrite(str(save_path), background)
+            images = sorted(str(f) for f in image_1.parent.glob("*.jpg"))
+            frames = read_frames(images, impp.load_and_process_image, options.every)
+        background = load_background(
+            (workdir or image_1.parent).joinpath(options.file_name), options, save_background, frames
+        )
+
+    if video_path is not None:
+        with VideoFrameReader(video_path, resize_factor, grayscale=filter_grayscale) as reader:
+            image_1, image_2 = reader.read_pair(frame, every)
 
     image_1 = impp.preprocess_image(
         image_1, filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background, background
@@ -64,6 +508,9 @@ def run_test(
     if mask is None:
         mask = np.ones(image_1.shape, dtype=np.uint8)
 
+    # Previews are short, so reusing the measured FFT plans of previous runs matters
+    import_fftw_wisdom()
+
     mask_piv = np.ones(image_1.shape, dtype=np.uint8)
 
     if bbox is None:
@@ -85,7 +532,10 @@ def run_test(
         epsilon=epsilon,
         threshold=threshold,
         step=step,
+        peak_finder=peak_finder,
+        inpaint_method=inpaint_method,
     )
+    export_fftw_wisdom()
 
     x_indices = np.clip(xtable.astype(int), 0, mask.shape[1] - 1)
     y_indices = np.clip(ytable.astype(int), 0, mask.shape[0] - 1)
@@ -122,110 +572,436 @@ def run_analyze_all(
     filter_sub_background: bool = False,
     save_background: bool = True,
     workdir: Optional[Path] = None,
+    peak_finder: str = "argmax",
+    inpaint_method: str = "rbf",
+    store_path: Optional[Path] = None,
+    stations: Optional[np.ndarray] = None,
+    station_neighbourhood: int = STATION_NEIGHBOURHOOD,
+    predictor_refresh: int = 0,
+    batch_pairs: Optional[int] = None,
+    workers: Optional[int] = None,
+    threads_per_worker: Optional[int] = None,
+    cores: Optional[int] = None,
+    executor: str = "process",
+    keep_frames: bool = True,
+    start_frame: int = 0,
+    end_frame: Optional[int] = None,
+    every: int = 1,
+    resize_factor: float = 1.0,
+    background_method: str = "mean",
+    background_percentile: float = DEFAULT_PERCENTILE,
+    background_every: int = 1,
+    background_window: Optional[int] = None,
 ) -> dict:
-    background = None
-    images = sorted([str(f) for f in images_location.glob("*.jpg")])
-    total_frames = len(images)
-
-    if total_frames == 0:
-        raise ImageReadError(f"No JPG images found in {images_location}")
-
-    print(f"Processing {total_frames} frames...")
-
-    max_workers = min(8, multiprocessing.cpu_count())
-
-    first_image = cv2.imread(images[0], cv2.IMREAD_GRAYSCALE)
-    if first_image is None:
-        raise ImageReadError(f"Could not read first image: {images[0]}")
-
-    if mask is None:
-        mask = np.ones(first_image.shape, dtype=np.uint8)
-
-    if bbox is None:
-        height, width = first_image.shape[:2]
-        bbox = [0, 0, width, height]
+    """
+    Run PIV on every consecutive pair of frames of a folder, or of a video.
+
+    The per-pair results are written into a PivResultStore, in memory or memory-mapped under store_path, and
+    returned with their per-vector medians. With store_path, the folder is completed as binary results and a
+    PivResults reader on it is returned instead of a dict of lists.
+
+    With stations, the pixel coordinates returned by piv_stations.section_stations, the bbox is cropped around
+    them and only the windows within station_neighbourhood grid steps of a station are correlated. The other
+    vectors are NaN, which update_current_x_section handles like masked ones.
+
+    With predictor_refresh > 0, the pairs of each frame range are seeded with the field of the previous pair and
+    only every predictor_refresh-th pair runs the first pass, see piv_loop.
+
+    batch_pairs consecutive pairs are correlated in one batched FFT per pass, and 0 sizes the batches to
+    FFT_BATCH_MEMORY, see piv_loop. Defaults to 0 in thread mode with several library threads, otherwise 1.
+
+    workers, threads_per_worker and cores split the cores between the workers and the pyFFTW, OpenCV and BLAS
+    threads of each worker, see concurrency.resolve_budget. With executor="process" the workers are processes.
+    The mask and background are placed once in shared memory and every worker writes its pairs into the result
+    store by pair index, in shared memory or in the memory-mapped files under store_path, so each task only
+    carries its frame range. With "thread" the workers are threads of this process that share the same inputs
+    and store directly. With "hybrid" every process runs threads_per_worker threads, each with single-threaded
+    libraries.
+
+    Without keep_frames, the per-pair fields are not kept: every worker accumulates the streaming statistics of
+    its frame ranges, see piv_statistics, and they are merged in range order. The results then hold the median,
+    mean, standard deviation and 5th and 95th percentiles of u and v instead of u, v and gradient, so the memory
+    used does not grow with the length of the video.
+
+    When images_location is a video, its frames are not extracted: a single decoder thread streams the frames
+    selected by start_frame, end_frame and every, resized by resize_factor, as video_to_frames would extract them,
+    see video_stream. The frames are handed to the workers in blocks of VIDEO_BLOCK_PAIRS pairs, with at most
+    VIDEO_TASKS_PER_WORKER tasks queued per worker. The mask and bbox refer to the resized frames and the results
+    are those of the extracted frames, without the JPEG compression.
+
+    When images_location is a frame stack written by video_to_frames, the pairs are read as zero-copy slices of
+    its memory-mapped array, see frame_stack. The mask, bbox, background and stations refer to the full frames:
+    they are cropped or shifted to the stack, whose crop must contain the bbox, and the vector positions are
+    shifted back. CLAHE equalizes the cropped frames, so its tiles differ from those of the full frames.
+
+    With filter_sub_background, the background is computed in one streaming pass over every background_every-th
+    frame, as their mean, approximate median, minimum or approximate background_percentile-th percentile, see
+    background_models. With background_window, a background is computed for every window of that many frames and
+    each frame subtracts the one interpolated at its position, which follows changes of lighting. Windowed
+    backgrounds are shared with the worker processes like the mask and are never saved.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor: {executor}")
+    background_options = BackgroundOptions(
+        background_method, background_percentile, background_every, background_window
+    )
 
+    stream = None
+    # Offset of the PIV coordinates, for the cropped frames of a frame stack
+    origin = (0, 0)
+    if is_frame_stack(images_location):
+        images, mask, bbox, background = load_stack_inputs(
+            images_location, mask, bbox, filter_sub_background, save_background, workdir, background_options
+        )
+        origin = images.origin
+        frame_names = images.names
+        if stations is not None:
+            stations = np.asarray(stations, dtype=float) - origin
+    elif is_video(images_location):
+        stream, mask, bbox, background = load_video_inputs(
+            images_location, mask, bbox, filter_sub_background, save_background, workdir, start_frame, end_frame,
+            every, resize_factor, background_options,
+        )
+        # Names of the JPEGs video_to_frames would write
+        frame_names = [frame_name(number) for number in stream.frame_numbers]
+        images = None
+    else:
+        images, mask, bbox, background = load_analysis_inputs(
+            images_location, mask, bbox, filter_sub_background, save_background, workdir, background_options
+        )
+        frame_names = [Path(image).name for image in images]
     if filter_sub_background:
         filter_grayscale = True
-        background_path = (workdir or images_location).joinpath("background.jpg")
-        if background_path.exists():
-            background = cv2.imread(str(background_path), cv2.IMREAD_GRAYSCALE)
-        else:
-            background = impp.calculate_average(images_location)
-            if save_background and background is not None:
-                cv2.imwrite(str(background_path), background)
-
-    test_result = piv_loop(
-        images, mask, bbox, interrogation_area_1, interrogation_area_2,
-        mask_auto, multipass, standard_filter, standard_threshold, median_test_filter,
-        epsilon, threshold, step, filter_grayscale, filter_clahe, clip_limit_clahe,
-        filter_sub_background, background, 0, 1
+
+    if stations is not None:
+        if peak_finder != "argmax":
+            raise ValueError("The station-only mode requires the argmax peak finder.")
+        # Room for the first pass windows around the stations
+        first_step = interrogation_area_1 / 2 if step is None else step
+        margin = (station_neighbourhood + 1) * first_step + interrogation_area_1
+        bbox = station_bbox(np.asarray(stations, dtype=float), bbox, margin)
+
+    print(f"Processing {len(frame_names)} frames...")
+
+    budget = resolve_budget(workers, threads_per_worker, cores)
+    # In hybrid mode the threads of a worker run pairs, so the libraries they call get one thread each
+    library_threads = 1 if executor == "hybrid" else budget.threads_per_worker
+    if batch_pairs is None:
+        # Batched FFTs keep several library threads busy on the pairs of a single thread
+        batch_pairs = 0 if executor == "thread" and library_threads > 1 else 1
+
+    # The frames of the test pair, which a video stream yields first
+    if stream is None:
+        first_frames = images[:2]
+    else:
+        streamed_frames = iter(stream)
+        first_frames = [next(streamed_frames, (None, None))[1] for _ in range(2)]
+        if first_frames[1] is None:
+            stream.close()
+            raise ImageReadError(f"Could not read the first frames of {images_location}")
+
+    # Every worker shares a single plan, built from the shape of the preprocessed frames
+    first_frame = impp.preprocess_image(
+        first_frames[0], filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background,
+        background.at(0) if isinstance(background, WindowedBackground) else background,
+    )
+    plan = loop_plan(
+        first_frame.shape, bbox, interrogation_area_1, interrogation_area_2, step, multipass, stations,
+        station_neighbourhood,
     )
 
+    # piv_loop arguments of every range, except the frames and the large arrays
+    loop_options = dict(
+        path_images=images, bbox=bbox, interrogation_area_1=interrogation_area_1,
+        interrogation_area_2=interrogation_area_2, mask_auto=mask_auto, multipass=multipass,
+        standard_filter=standard_filter, standard_threshold=standard_threshold,
+        median_test_filter=median_test_filter, epsilon=epsilon, threshold=threshold, step=step,
+        filter_grayscale=filter_grayscale, filter_clahe=filter_clahe, clip_limit_clahe=clip_limit_clahe,
+        filter_sub_background=filter_sub_background, peak_finder=peak_finder, inpaint_method=inpaint_method,
+        stations=stations, station_neighbourhood=station_neighbourhood, predictor_refresh=predictor_refresh,
+        batch_pairs=batch_pairs,
+    )
+
+    # The test pair also plans every FFT of the run with the thread count of the workers, which import the
+    # resulting wisdom when they start
+    with thread_limits(library_threads):
+        import_fftw_wisdom()
+        test_result = piv_loop(
+            mask=mask, background=background, warm_up=True, plan=plan,
+            **range_options(loop_options, (0, 1), None if stream is None else first_frames)
+        )
+        export_fftw_wisdom()
+
     expected_size = len(test_result["u"])
-    xtable = np.array(test_result["x"])
-    ytable = np.array(test_result["y"])
+    xtable = np.array(test_result["x"]) + origin[0]
+    ytable = np.array(test_result["y"]) + origin[1]
     shape = xtable.shape
 
-    chunk_pairs = [(i, i + 1) for i in range(len(images) - 1)]
-    arg_list = [
-        (
-            images, mask, bbox, interrogation_area_1, interrogation_area_2,
-            mask_auto, multipass, standard_filter, standard_threshold, median_test_filter,
-            epsilon, threshold, step, filter_grayscale, filter_clahe, clip_limit_clahe,
-            filter_sub_background, background, i, j
+    # In hybrid mode every task is a group of threads_per_worker consecutive ranges
+    group_size = budget.threads_per_worker if executor == "hybrid" else 1
+    total_pairs = len(frame_names) - 1
+    if stream is None:
+        frame_ranges = split_frame_range(total_pairs, budget.workers * CHUNKS_PER_WORKER * group_size)
+        tasks = (
+            (frame_ranges[index: index + group_size], None) for index in range(0, len(frame_ranges), group_size)
         )
-        for i, j in chunk_pairs
-    ]
-
-    dict_cumul = {
-        "u": np.zeros((expected_size, 0)),
-        "v": np.zeros((expected_size, 0)),
-        "typevector": np.zeros((expected_size, 0)),
-        "gradient": np.zeros((expected_size, 0)),
-    }
-
+        max_tasks = None
+    else:
+        # The frame count of some containers is approximate: pairs beyond the stream are left unfilled
+        tasks = stream_tasks(streamed_frames, first_frames, group_size)
+        max_tasks = budget.workers * VIDEO_TASKS_PER_WORKER
+
+    store = None
+    if keep_frames:
+        store = PivResultStore(expected_size, total_pairs, path=store_path, shared=executor != "thread")
+    # Statistics of the completed ranges, merged in range order: (end, statistics) keyed by the start of the range
+    statistics = None
+    pending_statistics = {}
+    next_start = 0
+    blocks = []
     successful_pairs = []
     failed_pairs = []
-    pbar = tqdm(total=len(chunk_pairs), desc="Processing image pairs")
+    pbar = tqdm(total=total_pairs, desc="Processing image pairs")
     start_time = time.time()
+    done_pairs = 0
+
+    def complete(future, group):
+        nonlocal statistics, next_start, done_pairs
+
+        start, end = group[0][0], group[-1][1]
+        pairs = [(frame_names[i], frame_names[i + 1]) for i in range(start, end)]
+        try:
+            result = future.result()
+            failed = False
+        except Exception:
+            result = [None] * len(group)
+            failed = True
+
+        if not keep_frames:
+            partials = result if isinstance(result, list) else [result["statistics"]]
+            pending_statistics.update(
+                (frame_range[0], (frame_range[1], partial)) for frame_range, partial in zip(group, partials)
+            )
+            while next_start in pending_statistics:
+                next_start, partial = pending_statistics.pop(next_start)
+                statistics = merge_statistics([item for item in (statistics, partial) if item is not None])
+
+        if failed:
+            if store is not None:
+                store.filled[start:end] = False
+            failed_pairs.extend(pairs)
+            return
+
+        if store is not None:
+            store.filled[start:end] = True
+        successful_pairs.extend(pairs)
+        done_pairs += end - start
+        pbar.update(end - start)
+        elapsed = time.time() - start_time
+        eta = (elapsed / done_pairs) * (total_pairs - done_pairs)
+        pbar.set_postfix(ETA=f"{eta:.1f}s")
+
+    try:
+        if executor == "thread":
+            pool = ThreadPoolExecutor(max_workers=budget.workers)
+        else:
+            arrays = {}
+            for name, array in (("mask", mask), ("background", background)):
+                arrays[name] = None
+                if isinstance(array, WindowedBackground):
+                    block, reference = share_array(array.backgrounds)
+                    arrays[name] = replace(array, backgrounds=reference)
+                    blocks.append(block)
+                elif array is not None:
+                    block, arrays[name] = share_array(array)
+                    blocks.append(block)
+            pool = ProcessPoolExecutor(
+                max_workers=budget.workers,
+                initializer=initialize_shared_worker,
+                initargs=(library_threads, loop_options, arrays, store and store.handle(), plan),
+            )
+
+        with thread_limits(library_threads), pool:
+            futures = {}
+            for group, frames in tasks:
+                if executor == "thread":
+                    future = pool.submit(
+                        piv_loop, mask=mask, background=background, plan=plan, store=store, keep_frames=keep_frames,
+                        statistics=None if keep_frames else create_statistics(expected_size),
+                        **range_options(loop_options, group[0], None if frames is None else frames[0])
+                    )
+                else:
+                    future = pool.submit(run_shared_ranges, group, frames)
+                futures[future] = group
+
+                # Streamed frames wait in the queue of the decoder rather than in the tasks of the pool
+                while max_tasks is not None and len(futures) >= max_tasks:
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        complete(future, futures.pop(future))
+
+            # The workers write their pairs into the store as they go; a range counts once it has completed
+            for future in as_completed(futures):
+                complete(future, futures[future])
+
+        pbar.close()
+
+        if not keep_frames:
+            results = {"shape": shape, "x": xtable.flatten().tolist(), "y": ytable.flatten().tolist()}
+            if statistics is None:
+                # Every range failed
+                statistics = create_statistics(expected_size)
+            for field in STATISTICS_FIELDS:
+                results.update(
+                    (key, values.tolist()) for key, values in statistics[field].results(field).items()
+                )
+            if store_path is not None:
+                save_piv_results(store_path, results)
+                return PivResults(store_path)
+            return results
+
+        store.flush()
+
+        u_median = store.nanmedian("u")
+        v_median = store.nanmedian("v")
+
+        if store_path is not None:
+            write_piv_header(store_path, shape, store.pairs, xtable, ytable, u_median, v_median)
+            return PivResults(store_path)
+
+        return {
+            "shape": shape,
+            "x": xtable.flatten().tolist(),
+            "y": ytable.flatten().tolist(),
+            "u_median": u_median.tolist(),
+            "v_median": v_median.tolist(),
+            "u": store.frames("u").tolist(),
+            "v": store.frames("v").tolist(),
+            "gradient": store.frames("gradient").tolist(),
+        }
+
+    finally:
+        # The results were copied out of the shared memory, which is freed
+        pbar.close()
+        if stream is not None:
+            stream.close()
+        if store is not None:
+            store.close()
+        release_blocks(blocks)
+
+
+def run_analyze_ensemble(
+    images_location: Path,
+    mask: Optional[np.ndarray] = None,
+    bbox: Optional[list] = None,
+    interrogation_area_1: int = 128,
+    interrogation_area_2: Optional[int] = None,
+    mask_auto: bool = True,
+    multipass: bool = True,
+    standard_filter: bool = True,
+    standard_threshold: int = 4,
+    median_test_filter: bool = True,
+    epsilon: float = 0.02,
+    threshold: int = 2,
+    step: Optional[int] = None,
+    filter_grayscale: bool = True,
+    filter_clahe: bool = True,
+    clip_limit_clahe: int = 5,
+    filter_sub_background: bool = False,
+    save_background: bool = True,
+    workdir: Optional[Path] = None,
+    peak_finder: str = "argmax",
+    inpaint_method: str = "rbf",
+    passes: int = 2,
+    workers: Optional[int] = None,
+    threads_per_worker: Optional[int] = None,
+    cores: Optional[int] = None,
+    background_method: str = "mean",
+    background_percentile: float = DEFAULT_PERCENTILE,
+    background_every: int = 1,
+) -> dict:
+    """
+    Compute the time-averaged field of a video with ensemble correlation.
+
+    The correlation planes of every window are summed over all the pairs and the peaks are searched once on the
+    sums. With passes=2 every pair is correlated again after deforming its second image with the ensemble field of
+    the first pass. The result has the schema of run_analyze_all, with the ensemble field as u_median/v_median and
+    as the single frame of u/v/gradient. workers, threads_per_worker, cores and the background options, except
+    the window, are used as in run_analyze_all.
+    """
+    if peak_finder not in PEAK_FINDERS:
+        raise ValueError(f"Unknown peak finder: {peak_finder}")
+    if passes not in (1, 2):
+        raise ValueError("passes must be 1 or 2.")
+    legacy_peaks = peak_finder == "legacy"
+
+    images, mask, bbox, background = load_analysis_inputs(
+        images_location, mask, bbox, filter_sub_background, save_background, workdir,
+        BackgroundOptions(background_method, background_percentile, background_every),
+    )
+    if filter_sub_background:
+        filter_grayscale = True
 
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = executor.map(run_single_pair, arg_list)
-        for f, result in enumerate(futures):
-            img1 = Path(images[chunk_pairs[f][0]]).name
-            img2 = Path(images[chunk_pairs[f][1]]).name
-            try:
-                if not isinstance(result, dict) or "u" not in result or len(result["u"]) != expected_size:
-                    failed_pairs.append((img1, img2))
-                    continue
+    total_pairs = len(images) - 1
+    if total_pairs < 1:
+        raise ImageReadError(f"At least two JPG images are needed in {images_location}")
 
-                dict_cumul["u"] = np.hstack((dict_cumul["u"], result["u"]))
-                dict_cumul["v"] = np.hstack((dict_cumul["v"], result["v"]))
-                dict_cumul["typevector"] = np.hstack((dict_cumul["typevector"], result.get("typevector", np.full((expected_size, 1), np.nan))))
-                dict_cumul["gradient"] = np.hstack((dict_cumul["gradient"], result.get("gradient", np.full((expected_size, 1), np.nan))))
+    print(f"Processing {len(images)} frames with ensemble correlation...")
 
-                successful_pairs.append((img1, img2))
-                pbar.update(1)
-                elapsed = time.time() - start_time
-                eta = (elapsed / (f + 1)) * (len(chunk_pairs) - (f + 1))
-                pbar.set_postfix(ETA=f"{eta:.1f}s")
+    budget = resolve_budget(workers, threads_per_worker, cores)
+    frame_ranges = split_frame_range(total_pairs, budget.workers * CHUNKS_PER_WORKER)
 
-            except Exception:
-                failed_pairs.append((img1, img2))
+    first_image = impp.preprocess_image(
+        images[0], filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background, background
+    )
+    plan = ensemble_plan(first_image.shape, bbox, interrogation_area_1, interrogation_area_2, step, multipass)
+
+    def arg_list(deformation):
+        return [
+            (
+                images, bbox, interrogation_area_1, interrogation_area_2, multipass, step,
+                filter_grayscale, filter_clahe, clip_limit_clahe, filter_sub_background, background,
+                start, end, deformation
+            )
+            for start, end in frame_ranges
+        ]
+
+    ensemble = sum_ensemble(arg_list(None), budget, "Ensemble pass 1")
+    xtable, ytable, utable, vtable, typevector = first_pass_field(
+        ensemble["correlation"], plan, mask_auto, standard_filter, standard_threshold, median_test_filter,
+        epsilon, threshold, legacy_peaks, inpaint_method
+    )
 
-    pbar.close()
+    if passes == 1:
+        # Back to image coordinates, as second_pass_field does for the second pass grid
+        xtable = xtable + plan.bbox[0] - plan.first_pass.half_ia
+        ytable = ytable + plan.bbox[1] - plan.first_pass.half_ia
+    else:
+        X, Y, U, V, utable, vtable = deformation_field(plan, xtable, ytable, utable, vtable)
+        ensemble = sum_ensemble(arg_list((X, Y, U, V)), budget, "Ensemble pass 2")
+        xtable, ytable, utable, vtable, typevector, _ = second_pass_field(
+            ensemble["correlation"], plan, utable, vtable, mask_auto, standard_filter, standard_threshold,
+            median_test_filter, epsilon, threshold, legacy_peaks
+        )
 
-    u_median = np.nanmedian(dict_cumul["u"], axis=1)
-    v_median = np.nanmedian(dict_cumul["v"], axis=1)
+    gradient = ensemble["gradient"] / ensemble["pairs"]
+
+    x_indices = np.clip(xtable.astype(int), 0, mask.shape[1] - 1)
+    y_indices = np.clip(ytable.astype(int), 0, mask.shape[0] - 1)
+    in_mask = mask[y_indices, x_indices] > 0
+
+    utable = utable.astype(float)
+    vtable = vtable.astype(float)
+    utable[~in_mask] = np.nan
+    vtable[~in_mask] = np.nan
 
     return {
-        "shape": shape,
+        "shape": xtable.shape,
         "x": xtable.flatten().tolist(),
         "y": ytable.flatten().tolist(),
-        "u_median": u_median.tolist(),
-        "v_median": v_median.tolist(),
-        "u": dict_cumul["u"].T.tolist(),
-        "v": dict_cumul["v"].T.tolist(),
-        "gradient": dict_cumul["gradient"].T.tolist(),
+        "u_median": utable.flatten().tolist(),
+        "v_median": vtable.flatten().tolist(),
+        "u": [utable.flatten().tolist()],
+        "v": [vtable.flatten().tolist()],
+        "gradient": [gradient.flatten().tolist()],
     }
@@ -0,0 +1,412 @@
+"""
+File Name: piv_results.py
+Project Name: RIVeR-LAC
+Description: Preallocated storage for the per-pair PIV results of a video.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+Every field is a single (vectors, pairs) float32 array in column-major order, so the result of one pair is a
+contiguous column that can be written in place, in any order, without growing or copying the others.
+
+The same layout is used on disk by the binary results format, a folder with:
+	header.json             format, version, grid shape, fields and indices of the valid pairs
+	x.npy, y.npy            vector positions, float64
+	u_median.npy, ...       per-vector medians, float64
+	u.npy, v.npy, ...       per-pair fields, (vectors, pairs) float32 in Fortran order, one contiguous block per pair
+	u_std.npy, ...          per-vector statistics of results without per-pair fields, float64, see piv_statistics
+PivResults reads it lazily through memory maps and behaves like the dict of piv_results.json.
+"""
+
+import json
+from collections.abc import Mapping
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from river.core.piv_statistics import STATISTICS, STATISTICS_FIELDS
+from river.core.shared_arrays import create_shared_array, release_blocks
+
+# Per-pair fields produced by piv_loop
+RESULT_FIELDS = ("u", "v", "typevector", "gradient")
+
+# Per-pair fields of the results schema, one list per pair in piv_results.json
+FRAME_FIELDS = ("u", "v", "gradient")
+
+# Per-vector fields of the results schema
+GRID_FIELDS = ("x", "y", "u_median", "v_median")
+
+# Per-vector statistics of results computed without keeping the per-pair fields
+STATISTIC_FIELDS = tuple(f"{field}_{name}" for field in STATISTICS_FIELDS for name in STATISTICS)
+
+RESULTS_HEADER = "header.json"
+RESULTS_FORMAT = "river-piv-results"
+RESULTS_VERSION = 1
+
+
+@dataclass(frozen=True)
+class StoreHandle:
+	"""Picklable reference to the arrays of a memory-mapped or shared PivResultStore, see PivResultStore.attach."""
+
+	num_vectors: int
+	num_pairs: int
+	path: Optional[Path]
+	arrays: dict
+
+
+class PivResultStore:
+	"""
+	Fixed-capacity store of per-pair PIV results, written by pair index.
+
+	Columns that were never written (pairs still running or failed) are NaN and are skipped by the accessors.
+	"""
+
+	def __init__(
+		self,
+		num_vectors: int,
+		num_pairs: int,
+		path: Optional[Path] = None,
+		fields: tuple = RESULT_FIELDS,
+		dtype: type = np.float32,
+		shared: bool = False,
+	):
+		"""
+		Parameters:
+		num_vectors : int
+			Number of vectors of the PIV grid.
+		num_pairs : int
+			Number of image pairs of the run.
+		path : Path, optional
+			Folder where each field is kept as a memory-mapped <field>.npy file. Defaults to memory.
+		fields : tuple, optional
+			Names of the per-pair fields. Default is RESULT_FIELDS.
+		dtype : type, optional
+			Data type of the stored values. Default is float32.
+		shared : bool, optional
+			Keep the in-memory fields in shared memory blocks, so that worker processes can write into them. The
+			blocks are freed by close. Default is False.
+		"""
+		self.num_vectors = num_vectors
+		self.num_pairs = num_pairs
+		self.path = None if path is None else Path(path)
+		self.filled = np.zeros(num_pairs, dtype=bool)
+		self.arrays = {}
+		self.shared_arrays = {}
+		self.blocks = []
+		self.owner = True
+
+		shape = (num_vectors, num_pairs)
+		if self.path is not None:
+			self.path.mkdir(parents=True, exist_ok=True)
+
+		for field in fields:
+			if self.path is None and shared:
+				block, array, self.shared_arrays[field] = create_shared_array(shape, dtype, order="F")
+				self.blocks.append(block)
+			elif self.path is None:
+				array = np.empty(shape, dtype=dtype, order="F")
+			else:
+				array = np.lib.format.open_memmap(
+					self.path.joinpath(f"{field}.npy"), mode="w+", dtype=dtype, shape=shape, fortran_order=True
+				)
+			array.fill(np.nan)
+			self.arrays[field] = array
+
+	def __getitem__(self, field: str) -> np.ndarray:
+		return self.arrays[field]
+
+	def handle(self) -> StoreHandle:
+		"""
+		Reference to the fields of the store, for another process to write into them through attach.
+
+		Returns:
+		StoreHandle
+			The picklable reference.
+		"""
+		if self.path is None and not self.shared_arrays:
+			raise ValueError("Only memory-mapped or shared stores can be attached from another process.")
+		return StoreHandle(self.num_vectors, self.num_pairs, self.path, dict(self.shared_arrays))
+
+	@classmethod
+	def attach(cls, handle: StoreHandle, fields: tuple = RESULT_FIELDS) -> "PivResultStore":
+		"""
+		Open the fields of a store created in another process, without clearing them.
+
+		Writes go straight to the shared memory or to the memory-mapped files. The filled pairs are tracked by each
+		process separately, so the creator of the store marks the pairs written by the others.
+
+		Parameters:
+		handle : StoreHandle
+			Reference returned by handle.
+		fields : tuple, optional
+			Names of the per-pair fields. Default is RESULT_FIELDS.
+
+		Returns:
+		PivResultStore
+			A store on the same fields, to be closed before the process ends.
+		"""
+		store = cls.__new__(cls)
+		store.num_vectors = handle.num_vectors
+		store.num_pairs = handle.num_pairs
+		store.path = handle.path
+		store.filled = np.zeros(handle.num_pairs, dtype=bool)
+		store.arrays = {}
+		store.shared_arrays = dict(handle.arrays)
+		store.blocks = []
+		store.owner = False
+
+		for field in fields:
+			if handle.path is None:
+				block, store.arrays[field] = handle.arrays[field].attach()
+				store.blocks.append(block)
+			else:
+				store.arrays[field] = np.load(handle.path.joinpath(f"{field}.npy"), mmap_mode="r+")
+
+		return store
+
+	def close(self):
+		"""Release the shared memory of the store, which is freed if it was created here. The fields are dropped."""
+		self.flush()
+		self.arrays = {}
+		release_blocks(self.blocks, unlink=self.owner)
+		self.blocks = []
+
+	@property
+	def pairs(self) -> np.ndarray:
+		"""Indices of the pairs that have been written, in pair order."""
+		return np.flatnonzero(self.filled)
+
+	def write(self, start: int, result: dict):
+		"""
+		Write the results of the consecutive pairs start, start + 1, ...
+
+		Parameters:
+		start : int
+			Index of the first pair of the result.
+		result : dict
+			Arrays of shape (num_vectors, k) for every field of the store, as returned by piv_loop. Missing fields
+			are left as NaN.
+		"""
+		count = None
+		for field, array in self.arrays.items():
+			if field not in result:
+				continue
+			values = np.asarray(result[field])
+			count = values.shape[1]
+			array[:, start: start + count] = values
+
+		if count is not None:
+			self.filled[start: start + count] = True
+
+	def frames(self, field: str) -> np.ndarray:
+		"""
+		Return the written pairs of a field as a (pairs, num_vectors) array, one row per pair.
+
+		Parameters:
+		field : str
+			Name of the field.
+
+		Returns:
+		np.ndarray
+			Transposed view of the written columns. It shares memory with the store when every pair is written.
+		"""
+		array = self.arrays[field]
+		if self.filled.all():
+			return array.T
+		return array[:, self.filled].T
+
+	def nanmedian(self, field: str, block_size: int = 4096) -> np.ndarray:
+		"""
+		Compute the median over the written pairs of every vector, ignoring NaN values.
+
+		The vectors are processed in blocks so that the temporary copy made by np.nanmedian stays bounded, which
+		keeps memory-mapped stores out of memory.
+
+		Parameters:
+		field : str
+			Name of the field.
+		block_size : int, optional
+			Number of vectors per block. Default is 4096.
+
+		Returns:
+		np.ndarray
+			Median of each vector, in float64. NaN for vectors without a valid value.
+		"""
+		array = self.arrays[field]
+		pairs = self.pairs
+		median = np.full(self.num_vectors, np.nan)
+
+		for start in range(0, self.num_vectors, block_size):
+			block = np.asarray(array[start: start + block_size], dtype=np.float64)[:, pairs]
+			valid = ~np.isnan(block).all(axis=1)
+			if valid.any():
+				median[start: start + block_size][valid] = np.nanmedian(block[valid], axis=1)
+
+		return median
+
+	def flush(self):
+		"""Write memory-mapped fields to disk."""
+		for array in self.arrays.values():
+			if isinstance(array, np.memmap):
+				array.flush()
+
+
+def write_piv_header(
+	path: Path,
+	shape: tuple,
+	frames: np.ndarray,
+	xtable: np.ndarray,
+	ytable: np.ndarray,
+	u_median: np.ndarray,
+	v_median: np.ndarray,
+	fields: tuple = FRAME_FIELDS,
+	statistics: Optional[Mapping] = None,
+):
+	"""
+	Complete a folder of per-pair .npy files, such as the one of a memory-mapped PivResultStore, as binary results.
+
+	Parameters:
+	path : Path
+		The results folder, which already holds <field>.npy for every per-pair field.
+	shape : tuple
+		Shape of the PIV grid.
+	frames : np.ndarray
+		Indices of the valid pairs in the per-pair arrays.
+	xtable, ytable : np.ndarray
+		Vector positions.
+	u_median, v_median : np.ndarray
+		Per-vector medians.
+	fields : tuple, optional
+		Per-pair fields to expose. Default is FRAME_FIELDS.
+	statistics : Mapping, optional
+		Other per-vector fields, such as the STATISTIC_FIELDS of results without per-pair fields.
+	"""
+	path = Path(path)
+	statistics = statistics or {}
+	vector_fields = dict(zip(GRID_FIELDS, (xtable, ytable, u_median, v_median)), **statistics)
+	for name, values in vector_fields.items():
+		np.save(path.joinpath(f"{name}.npy"), np.asarray(values, dtype=np.float64).reshape(-1))
+
+	header = {
+		"format": RESULTS_FORMAT,
+		"version": RESULTS_VERSION,
+		"shape": [int(size) for size in shape],
+		"fields": list(fields),
+		"statistics": list(statistics),
+		"frames": [int(frame) for frame in frames],
+	}
+	path.joinpath(RESULTS_HEADER).write_text(json.dumps(header))
+
+
+def save_piv_results(path: Path, results: Mapping):
+	"""
+	Write results with the piv_results.json schema in the binary results format.
+
+	Parameters:
+	path : Path
+		The results folder. It is created if needed.
+	results : Mapping
+		Results as returned by run_analyze_all or run_analyze_ensemble.
+	"""
+	path = Path(path)
+	path.mkdir(parents=True, exist_ok=True)
+
+	# Results computed without keeping the per-pair fields only have per-vector statistics
+	fields = tuple(field for field in FRAME_FIELDS if field in results)
+	num_frames = 0
+	for field in fields:
+		frames = np.asarray(results[field], dtype=np.float32)
+		num_frames = frames.shape[0]
+		# (frames, vectors) in C order is (vectors, frames) in Fortran order
+		np.save(path.joinpath(f"{field}.npy"), np.asfortranarray(frames.reshape(num_frames, -1).T))
+
+	write_piv_header(
+		path,
+		results["shape"],
+		np.arange(num_frames),
+		results["x"],
+		results["y"],
+		results["u_median"],
+		results["v_median"],
+		fields,
+		{field: results[field] for field in STATISTIC_FIELDS if field in results},
+	)
+
+
+class PivResults(Mapping):
+	"""
+	Read-only view of binary PIV results with the keys of piv_results.json.
+
+	"shape" is a list, the per-vector fields are 1D arrays and the per-pair fields are (pairs, vectors) float32
+	arrays mapped from disk, so indexing one pair only reads that pair.
+	"""
+
+	def __init__(self, path: Path):
+		"""
+		Parameters:
+		path : Path
+			The results folder written by write_piv_header or save_piv_results.
+		"""
+		self.path = Path(path)
+		self.header = json.loads(self.path.joinpath(RESULTS_HEADER).read_text())
+		if self.header.get("format") != RESULTS_FORMAT:
+			raise ValueError(f"{self.path} does not contain PIV results")
+		self._vector_keys = GRID_FIELDS + tuple(self.header.get("statistics", []))
+		self._keys = ("shape",) + self._vector_keys + tuple(self.header["fields"])
+		self._cache = {}
+
+	def __getitem__(self, key: str):
+		if key == "shape":
+			return self.header["shape"]
+		if key not in self._keys:
+			raise KeyError(key)
+		if key not in self._cache:
+			self._cache[key] = self._load(key)
+		return self._cache[key]
+
+	def __iter__(self):
+		return iter(self._keys)
+
+	def __len__(self) -> int:
+		return len(self._keys)
+
+	def _load(self, key: str) -> np.ndarray:
+		array = np.load(self.path.joinpath(f"{key}.npy"), mmap_mode="r")
+		if key in self._vector_keys:
+			return array
+
+		frames = np.asarray(self.header["frames"], dtype=np.intp)
+		stack = array.T
+		if frames.size == stack.shape[0] and np.array_equal(frames, np.arange(frames.size)):
+			return stack
+		# Pairs that failed are left out, which reads the valid ones
+		return stack[frames]
+
+	def to_dict(self) -> dict:
+		"""Return the results as the lists of piv_results.json, e.g. to export them as JSON."""
+		results = {"shape": list(self["shape"])}
+		for key in self._keys[1:]:
+			results[key] = np.asarray(self[key], dtype=np.float64).tolist()
+		return results
+
+
+def load_piv_results(path: Path) -> Union[dict, PivResults]:
+	"""
+	Load PIV results from a piv_results.json file or from a binary results folder.
+
+	Parameters:
+	path : Path
+		The JSON file or the results folder.
+
+	Returns:
+	dict or PivResults
+		The results, indexed with the keys of the results schema.
+	"""
+	path = Path(path)
+	if path.is_dir():
+		return PivResults(path)
+	return json.loads(path.read_text())
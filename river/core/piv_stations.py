@@ -0,0 +1,175 @@
+"""
+File Name: piv_stations.py
+Project Name: RIVeR-LAC
+Description: Station-only PIV, correlating interrogation windows only around the cross-section stations.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+update_current_x_section only samples the velocity field along the cross-sections. For discharge monitoring the
+PIV grid is restricted to a band around the section lines: the bbox is cropped to the band and, in both passes,
+only the windows within a few grid steps of a station are correlated. The other vectors of the grid are NaN, so
+the results keep the usual schema.
+"""
+
+from typing import Optional
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import river.core.homography as hg
+from river.core.piv_fftmulti import PivPass, PivPlan, create_piv_plan
+
+# Largest distance in pixels between two consecutive points sampled along a section line
+STATION_SPACING = 8
+
+# Grid steps kept around every station, enough for the 3x3 median test and the smoothing at the band edges
+STATION_NEIGHBOURHOOD = 2
+
+
+def section_stations(
+		x_sections: dict, transformation_matrix: np.ndarray, spacing: float = STATION_SPACING
+) -> np.ndarray:
+	"""
+	Sample the lines of the cross-sections in pixel coordinates.
+
+	The stations of update_current_x_section lie on the segment between the left and right points of each section,
+	so the segments are sampled densely instead of depending on the bathymetry and the number of stations.
+
+	Parameters:
+	x_sections : dict
+		Cross-sections data, with "east_l", "north_l", "east_r" and "north_r" for every section.
+	transformation_matrix : np.ndarray
+		Transformation matrix from pixel to real-world coordinates.
+	spacing : float, optional
+		Largest distance in pixels between two consecutive points. Default is STATION_SPACING.
+
+	Returns:
+	np.ndarray
+		Pixel coordinates (x, y) of the points, shape (N, 2).
+	"""
+	stations = []
+	for section in x_sections.values():
+		if not isinstance(section, dict) or "east_l" not in section:
+			continue
+
+		x_ends, y_ends = hg.real_world_to_pixel(
+			[section["east_l"], section["east_r"]], [section["north_l"], section["north_r"]], transformation_matrix
+		)
+		length = np.hypot(x_ends[1] - x_ends[0], y_ends[1] - y_ends[0])
+
+		# The homography maps straight lines to straight lines, so the pixel segment is sampled directly
+		fraction = np.linspace(0, 1, int(np.ceil(length / spacing)) + 1)
+		stations.append(
+			np.column_stack(
+				(x_ends[0] + fraction * (x_ends[1] - x_ends[0]), y_ends[0] + fraction * (y_ends[1] - y_ends[0]))
+			)
+		)
+
+	if len(stations) == 0:
+		raise ValueError("No cross-section found in the section definitions.")
+
+	return np.concatenate(stations)
+
+
+def station_bbox(stations: np.ndarray, bbox: list, margin: float) -> list:
+	"""
+	Crop a bounding box to the stations and a margin around them.
+
+	Parameters:
+	stations : np.ndarray
+		Pixel coordinates (x, y) of the stations, shape (N, 2).
+	bbox : list
+		The bounding box [x, y, width, height] of the full analysis.
+	margin : float
+		Distance in pixels kept around the stations.
+
+	Returns:
+	list
+		The cropped bounding box [x, y, width, height].
+	"""
+	x0 = max(bbox[0], np.floor(stations[:, 0].min() - margin))
+	y0 = max(bbox[1], np.floor(stations[:, 1].min() - margin))
+	x1 = min(bbox[0] + bbox[2], np.ceil(stations[:, 0].max() + margin))
+	y1 = min(bbox[1] + bbox[3], np.ceil(stations[:, 1].max() + margin))
+
+	if x1 <= x0 or y1 <= y0:
+		raise ValueError("The cross-sections are outside of the bounding box.")
+
+	return [int(x0), int(y0), int(x1 - x0), int(y1 - y0)]
+
+
+def station_windows(
+		piv_pass: PivPass, bbox: list, stations: np.ndarray, neighbourhood: int = STATION_NEIGHBOURHOOD
+) -> np.ndarray:
+	"""
+	Select the windows of a pass whose center is within a few grid steps of a station.
+
+	Parameters:
+	piv_pass : PivPass
+		Geometry of the pass.
+	bbox : list
+		The bounding box of the plan.
+	stations : np.ndarray
+		Pixel coordinates (x, y) of the stations, shape (N, 2).
+	neighbourhood : int, optional
+		Number of grid steps kept around every station. Default is STATION_NEIGHBOURHOOD.
+
+	Returns:
+	np.ndarray
+		Boolean (numelementsy, numelementsx) selection of the windows.
+	"""
+	_, _, _, xtable, ytable = piv_pass.grid
+
+	# Window centers in image coordinates, as returned by second_pass_field
+	centers = np.column_stack(
+		(
+			(xtable + bbox[0] - piv_pass.half_ia).reshape(-1),
+			(ytable + bbox[1] - piv_pass.half_ia).reshape(-1),
+		)
+	)
+
+	# Chebyshev distance, so the selection is a square of 2 * neighbourhood + 1 windows around each station
+	distance, _ = cKDTree(stations).query(centers, p=np.inf)
+
+	return (distance <= (neighbourhood + 0.5) * piv_pass.step).reshape(xtable.shape)
+
+
+def create_station_plan(
+		image_shape: tuple,
+		bbox: list,
+		stations: np.ndarray,
+		interrogation_area_1: int,
+		interrogation_area_2: Optional[int] = None,
+		step: Optional[int] = None,
+		multipass: bool = True,
+		neighbourhood: int = STATION_NEIGHBOURHOOD,
+) -> PivPlan:
+	"""
+	Build a plan that only correlates the windows around the stations.
+
+	Parameters:
+	image_shape : tuple
+		Shape of the full images that will be analyzed.
+	bbox : list
+		The bounding box, usually cropped by station_bbox.
+	stations : np.ndarray
+		Pixel coordinates (x, y) of the stations, shape (N, 2).
+	interrogation_area_1, interrogation_area_2, step, multipass :
+		See create_piv_plan.
+	neighbourhood : int, optional
+		Number of grid steps kept around every station in each pass. Default is STATION_NEIGHBOURHOOD.
+
+	Returns:
+	PivPlan
+		The plan, with the active windows of both passes.
+	"""
+	mask_piv = np.ones(image_shape[:2], dtype=np.uint8)
+	plan = create_piv_plan(image_shape, bbox, mask_piv, interrogation_area_1, interrogation_area_2, step, multipass)
+
+	plan.first_pass.active = station_windows(plan.first_pass, plan.bbox, stations, neighbourhood)
+	plan.second_pass.active = station_windows(plan.second_pass, plan.bbox, stations, neighbourhood)
+
+	return plan
@@ -0,0 +1,254 @@
+"""
+File Name: piv_statistics.py
+Project Name: RIVeR-LAC
+Description: Constant-memory per-vector statistics of the PIV results, updated pair by pair.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+The medians and percentiles of a run are usually computed on the full (vectors, pairs) stack of every field, which
+grows with the length of the video. StreamingStatistics keeps, for every vector of the grid:
+	count, mean and sum of squared deviations, updated with Welford's method
+	a digest of at most DIGEST_CENTROIDS weighted centroids, as in t-digest, for the median and the percentiles
+Both are updated with blocks of pairs and can be merged, so every worker accumulates its own frame ranges and the
+results are combined in range order, which keeps the run reproducible.
+
+The centroids are narrower towards the tails, following the arcsine scale of t-digest, so the 5th and 95th
+percentiles are resolved as well as the median. While every centroid still holds a single value, a quantile equals
+the one of np.percentile; beyond that it stays within a fraction of a percent of the spread of the values.
+"""
+
+from typing import Optional
+
+import numpy as np
+
+# Largest number of centroids of the digest of each vector
+DIGEST_CENTROIDS = 64
+
+# Number of pairs buffered before they are added to the digests, which amortizes their sorting
+BUFFER_PAIRS = 32
+
+# Result fields summarized when the per-pair fields are not kept
+STATISTICS_FIELDS = ("u", "v")
+
+# Per-vector statistics of a field, keyed "<field>_<statistic>" in the results
+STATISTICS = ("mean", "std", "5th_percentile", "95th_percentile")
+
+# Quantile of each percentile statistic
+PERCENTILES = {"5th_percentile": 0.05, "95th_percentile": 0.95}
+
+
+def arcsine_scale(quantile: np.ndarray) -> np.ndarray:
+	"""Map quantiles to [0, 1] with the t-digest scale, which stretches the tails."""
+	return np.arcsin(2 * np.clip(quantile, 0, 1) - 1) / np.pi + 0.5
+
+
+class StreamingStatistics:
+	"""
+	Running count, mean, variance and quantile digest of every vector of a field. NaN values are ignored.
+	"""
+
+	def __init__(self, num_vectors: int, centroids: int = DIGEST_CENTROIDS):
+		"""
+		Parameters:
+		num_vectors : int
+			Number of vectors of the PIV grid.
+		centroids : int, optional
+			Largest number of centroids per vector. Default is DIGEST_CENTROIDS.
+		"""
+		self.num_vectors = num_vectors
+		self.centroids = centroids
+		self.count = np.zeros(num_vectors, dtype=np.int64)
+		self.mean = np.zeros(num_vectors)
+		self.squares = np.zeros(num_vectors)
+		# Centroids sorted by value, the unused ones have a weight of 0 and a NaN mean
+		self.means = np.full((num_vectors, centroids), np.nan)
+		self.weights = np.zeros((num_vectors, centroids))
+		self.buffer = []
+		self.buffered = 0
+
+	def update(self, values: np.ndarray):
+		"""
+		Add a block of pairs.
+
+		Parameters:
+		values : np.ndarray
+			Values of shape (num_vectors,) for one pair, or (num_vectors, k) for k pairs.
+		"""
+		values = np.asarray(values, dtype=np.float64).reshape(self.num_vectors, -1)
+		self.buffer.append(values)
+		self.buffered += values.shape[1]
+		if self.buffered >= BUFFER_PAIRS:
+			self.flush()
+
+	def flush(self):
+		"""Add the buffered pairs to the statistics."""
+		if self.buffered == 0:
+			return
+		values = np.concatenate(self.buffer, axis=1)
+		self.buffer = []
+		self.buffered = 0
+
+		valid = ~np.isnan(values)
+		count = valid.sum(axis=1)
+
+		# Mean and squared deviations of the block, combined with the running ones by Chan's formula
+		with np.errstate(invalid="ignore", divide="ignore"):
+			mean = np.where(count > 0, np.where(valid, values, 0).sum(axis=1) / count, 0)
+		squares = np.where(valid, (values - mean[:, None]) ** 2, 0).sum(axis=1)
+		self._combine(count, mean, squares)
+
+		self._compress(
+			np.concatenate((self.means, np.where(valid, values, np.nan)), axis=1),
+			np.concatenate((self.weights, valid.astype(np.float64)), axis=1),
+		)
+
+	def merge(self, other: "StreamingStatistics"):
+		"""
+		Add the pairs accumulated by another instance over the same grid.
+
+		Parameters:
+		other : StreamingStatistics
+			The statistics to add.
+		"""
+		self.flush()
+		other.flush()
+		self._combine(other.count, other.mean, other.squares)
+		self._compress(
+			np.concatenate((self.means, other.means), axis=1), np.concatenate((self.weights, other.weights), axis=1)
+		)
+
+	def _combine(self, count: np.ndarray, mean: np.ndarray, squares: np.ndarray):
+		total = self.count + count
+		with np.errstate(invalid="ignore", divide="ignore"):
+			delta = mean - self.mean
+			self.mean = np.where(total > 0, self.mean + delta * count / total, 0)
+			self.squares = np.where(total > 0, self.squares + squares + delta ** 2 * self.count * count / total, 0)
+		self.count = total
+
+	def _compress(self, means: np.ndarray, weights: np.ndarray):
+		"""Merge candidate centroids into at most self.centroids per vector, by intervals of the arcsine scale."""
+		rows = np.arange(self.num_vectors)[:, None]
+		order = np.argsort(np.where(weights > 0, means, np.inf), axis=1, kind="stable")
+		means = means[rows, order]
+		weights = weights[rows, order]
+
+		total = weights.sum(axis=1, keepdims=True)
+		with np.errstate(invalid="ignore", divide="ignore"):
+			middle = (np.cumsum(weights, axis=1) - weights / 2) / total
+		group = np.minimum((arcsine_scale(np.nan_to_num(middle)) * self.centroids).astype(np.intp), self.centroids - 1)
+
+		index = (rows * self.centroids + group).ravel()
+		size = self.num_vectors * self.centroids
+		self.weights = np.bincount(index, weights.ravel(), minlength=size).reshape(self.num_vectors, self.centroids)
+		sums = np.bincount(index, np.where(weights > 0, means * weights, 0).ravel(), minlength=size)
+		with np.errstate(invalid="ignore", divide="ignore"):
+			self.means = np.where(self.weights > 0, sums.reshape(self.weights.shape) / self.weights, np.nan)
+
+	@property
+	def std(self) -> np.ndarray:
+		"""Population standard deviation of every vector, as np.std. NaN without values."""
+		self.flush()
+		with np.errstate(invalid="ignore", divide="ignore"):
+			return np.where(self.count > 0, np.sqrt(self.squares / self.count), np.nan)
+
+	def quantile(self, quantile: float) -> np.ndarray:
+		"""
+		Estimate a quantile of every vector by interpolating between the centroids.
+
+		Parameters:
+		quantile : float
+			The quantile, between 0 and 1.
+
+		Returns:
+		np.ndarray
+			The estimate of every vector, NaN for vectors without values.
+		"""
+		self.flush()
+		rows = np.arange(self.num_vectors)[:, None]
+		# Used centroids first, still in value order
+		order = np.argsort(self.weights <= 0, axis=1, kind="stable")
+		means = self.means[rows, order]
+		weights = self.weights[rows, order]
+		used = (weights > 0).sum(axis=1)
+
+		# Each centroid stands for the values around the middle of its cumulative weight. The half-value offset
+		# matches the linear interpolation of np.percentile while every centroid holds a single value.
+		centers = np.where(weights > 0, np.cumsum(weights, axis=1) - weights / 2 - 0.5, np.inf)
+		target = quantile * (weights.sum(axis=1) - 1)
+		upper = (centers < target[:, None]).sum(axis=1)
+		lower = np.clip(upper - 1, 0, np.maximum(used - 1, 0))
+		upper = np.clip(upper, 0, np.maximum(used - 1, 0))
+
+		rows = rows[:, 0]
+		low, high = means[rows, lower], means[rows, upper]
+		with np.errstate(invalid="ignore", divide="ignore"):
+			span = centers[rows, upper] - centers[rows, lower]
+			fraction = np.where(span > 0, (target - centers[rows, lower]) / span, 0)
+
+		return np.where(used > 0, low + np.clip(fraction, 0, 1) * (high - low), np.nan)
+
+	def median(self) -> np.ndarray:
+		"""Estimate the median of every vector, NaN for vectors without values."""
+		return self.quantile(0.5)
+
+	def results(self, field: str) -> dict:
+		"""
+		Return the statistics with the keys of the results schema.
+
+		Parameters:
+		field : str
+			Name of the field, e.g. "u".
+
+		Returns:
+		dict
+			"<field>_median" and "<field>_<statistic>" for every statistic of STATISTICS, as float64 arrays.
+		"""
+		self.flush()
+		with np.errstate(invalid="ignore"):
+			mean = np.where(self.count > 0, self.mean, np.nan)
+		results = {f"{field}_median": self.median(), f"{field}_mean": mean, f"{field}_std": self.std}
+		for name, quantile in PERCENTILES.items():
+			results[f"{field}_{name}"] = self.quantile(quantile)
+		return results
+
+
+def merge_statistics(statistics: list) -> Optional[dict]:
+	"""
+	Merge the per-field statistics of consecutive frame ranges, in the given order.
+
+	Parameters:
+	statistics : list
+		Dicts of StreamingStatistics keyed by field, one per range.
+
+	Returns:
+	dict or None
+		The merged statistics of every field, None for an empty list.
+	"""
+	if len(statistics) == 0:
+		return None
+
+	merged = statistics[0]
+	for partial in statistics[1:]:
+		for field, values in partial.items():
+			merged[field].merge(values)
+	return merged
+
+
+def create_statistics(num_vectors: int, fields: tuple = STATISTICS_FIELDS) -> dict:
+	"""
+	Create empty statistics for the fields of a PIV grid.
+
+	Parameters:
+	num_vectors : int
+		Number of vectors of the PIV grid.
+	fields : tuple, optional
+		Result fields to summarize. Default is STATISTICS_FIELDS.
+
+	Returns:
+	dict
+		A StreamingStatistics per field.
+	"""
+	return {field: StreamingStatistics(num_vectors) for field in fields}
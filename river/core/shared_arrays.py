@@ -0,0 +1,108 @@
+"""
+File Name: shared_arrays.py
+Project Name: RIVeR-LAC
+Description: NumPy arrays in shared memory blocks, passed to worker processes by name instead of by value.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+Arguments of ProcessPoolExecutor tasks are pickled for every task and results are pickled back. A full-resolution
+mask or background, or the per-pair results of a long video, are large enough for this copying to show. The arrays
+are instead placed once in multiprocessing.shared_memory blocks: only a SharedArray reference, a name, a shape and
+a dtype, crosses the process boundary and every worker maps the same memory.
+"""
+
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Tuple
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class SharedArray:
+	"""Picklable reference to an array held in a shared memory block."""
+
+	name: str
+	shape: tuple
+	dtype: str
+	order: str = "C"
+
+	def attach(self, writeable: bool = True) -> Tuple[SharedMemory, np.ndarray]:
+		"""
+		Map the array in the current process.
+
+		Parameters:
+		writeable : bool, optional
+			Whether the returned view may be written. Default is True.
+
+		Returns:
+		Tuple[SharedMemory, np.ndarray]
+			The block, which must be kept open while the array is used, and the array.
+		"""
+		block = SharedMemory(name=self.name)
+		array = np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf, order=self.order)
+		array.flags.writeable = writeable
+		return block, array
+
+
+def create_shared_array(shape: tuple, dtype: type, order: str = "C") -> Tuple[SharedMemory, np.ndarray, SharedArray]:
+	"""
+	Allocate an uninitialized array in a new shared memory block.
+
+	Parameters:
+	shape : tuple
+		Shape of the array.
+	dtype : type
+		Data type of the array.
+	order : str, optional
+		"C" or "F" memory layout. Default is "C".
+
+	Returns:
+	Tuple[SharedMemory, np.ndarray, SharedArray]
+		The block, owned by the caller who must close and unlink it, the array and its reference for other processes.
+	"""
+	dtype = np.dtype(dtype)
+	shape = tuple(int(size) for size in shape)
+	# Zero-sized blocks are not allowed
+	block = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+	array = np.ndarray(shape, dtype=dtype, buffer=block.buf, order=order)
+	return block, array, SharedArray(block.name, shape, dtype.str, order)
+
+
+def share_array(array: np.ndarray) -> Tuple[SharedMemory, SharedArray]:
+	"""
+	Copy an array into a new shared memory block.
+
+	Parameters:
+	array : np.ndarray
+		The array to share.
+
+	Returns:
+	Tuple[SharedMemory, SharedArray]
+		The block, owned by the caller who must close and unlink it, and the reference to the copy.
+	"""
+	array = np.ascontiguousarray(array)
+	block, copy, reference = create_shared_array(array.shape, array.dtype)
+	copy[...] = array
+	return block, reference
+
+
+def release_blocks(blocks: list, unlink: bool = True):
+	"""
+	Close shared memory blocks, and free them when they are owned by this process.
+
+	Every array mapped on a block must have been dropped before, as an exported buffer prevents closing it.
+
+	Parameters:
+	blocks : list
+		The SharedMemory blocks.
+	unlink : bool, optional
+		Whether to free the memory, which only the creator of the blocks should do. Default is True.
+	"""
+	for block in blocks:
+		block.close()
+		if unlink:
+			block.unlink()
@@ -0,0 +1,312 @@
+"""
+File Name: stiv.py
+Project Name: RIVeR-LAC
+Description: Space-time image velocimetry (STIV) along the stations of a cross-section.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+Every station of the section gets a search line parallel to the flow, i.e. normal to the section in real-world
+coordinates. The frames are read once, in order, and only the pixels under the lines are kept, stacked over time
+into one space-time image (STI) per station. The slope of the streaks of an STI is the velocity along its line,
+estimated with a structure tensor on all the stations at once.
+
+The velocities are returned with the schema of run_analyze_all, on a 2-row grid made of the ends of the search
+lines, so update_current_x_section reads them as PIV results.
+"""
+
+from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from tqdm import tqdm
+
+import river.core.homography as hg
+from river.core.compute_section import divide_segment_to_dict
+from river.core.exceptions import ImageReadError
+
+# Structure tensors whose coherence is below this value give no velocity
+MIN_COHERENCE = 0.2
+
+
+def stiv_lines(
+		x_section: dict,
+		transformation_matrix: np.ndarray,
+		num_stations: Optional[int] = None,
+		line_length: Optional[float] = None,
+) -> dict:
+	"""
+	Build the search lines of the stations of a cross-section.
+
+	Parameters:
+	x_section : dict
+		One cross-section, with "east_l", "north_l", "east_r", "north_r" and optionally "num_stations".
+	transformation_matrix : np.ndarray
+		Transformation matrix from pixel to real-world coordinates.
+	num_stations : int, optional
+		Number of stations. Defaults to the one of the section, or 15.
+	line_length : float, optional
+		Length of the search lines in real-world units. Defaults to twice the distance between stations.
+
+	Returns:
+	dict
+		"east", "north": station coordinates; "direction": unit real-world vector of the lines, the streamwise axis
+		of update_current_x_section; "offsets": real-world position of every sample along the lines, centered on
+		the station; "map_x", "map_y": float32 pixel coordinates of the samples, shape (stations, samples).
+	"""
+	if num_stations is None:
+		num_stations = x_section.get("num_stations", 15)
+
+	stations = divide_segment_to_dict(
+		x_section["east_l"], x_section["north_l"], x_section["east_r"], x_section["north_r"], num_stations
+	)
+	crosswise = np.array([x_section["east_r"] - x_section["east_l"], x_section["north_r"] - x_section["north_l"]])
+	section_length = np.linalg.norm(crosswise)
+	crosswise = crosswise / section_length
+
+	# Streamwise axis of compute_transformation_matrix: the section axis rotated by +90 degrees
+	direction = np.array([-crosswise[1], crosswise[0]])
+
+	if line_length is None:
+		line_length = 2 * section_length / (num_stations - 1)
+
+	# One sample per pixel along the longest line, so no line is undersampled
+	ends_x, ends_y = hg.real_world_to_pixel(
+		stations["east"][:, None] + np.array([-0.5, 0.5]) * line_length * direction[0],
+		stations["north"][:, None] + np.array([-0.5, 0.5]) * line_length * direction[1],
+		transformation_matrix,
+	)
+	num_samples = int(np.ceil(np.max(np.hypot(np.diff(ends_x), np.diff(ends_y))))) + 1
+
+	offsets = np.linspace(-0.5, 0.5, num_samples) * line_length
+	map_x, map_y = hg.real_world_to_pixel(
+		stations["east"][:, None] + offsets * direction[0],
+		stations["north"][:, None] + offsets * direction[1],
+		transformation_matrix,
+	)
+
+	return {
+		"east": stations["east"],
+		"north": stations["north"],
+		"direction": direction,
+		"offsets": offsets,
+		"map_x": map_x.astype(np.float32),
+		"map_y": map_y.astype(np.float32),
+	}
+
+
+def read_space_time_images(images: list, map_x: np.ndarray, map_y: np.ndarray) -> np.ndarray:
+	"""
+	Read the frames in order and stack the pixels sampled under the search lines.
+
+	Only the (stations, samples) slice of each frame is kept, so memory grows with the number of frames times the
+	number of samples, not with the frame size.
+
+	Parameters:
+	images : list
+		Paths of the frames, in time order.
+	map_x, map_y : np.ndarray
+		Pixel coordinates of the samples, shape (stations, samples), as returned by stiv_lines.
+
+	Returns:
+	np.ndarray
+		The space-time images, float32 of shape (stations, frames, samples).
+	"""
+	sti = np.empty((map_x.shape[0], len(images), map_x.shape[1]), dtype=np.float32)
+
+	for index, image_path in enumerate(tqdm(images, desc="Reading frames")):
+		frame = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+		if frame is None:
+			raise ImageReadError(f"Could not read image: {image_path}")
+		# Bilinear sampling of every line at once
+		sti[:, index, :] = cv2.remap(
+			frame, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE
+		)
+
+	return sti
+
+
+def structure_tensor_velocity(sti: np.ndarray, window: int, sigma: float = 1.0) -> tuple:
+	"""
+	Estimate the slope of the streaks of space-time images with a structure tensor.
+
+	Along a streak the intensity is constant, so the temporal and spatial gradients satisfy It = -v Is, with v the
+	velocity in samples per frame. The tensor sums the gradient products over each time window of every STI; its
+	dominant orientation gives v and its coherence the reliability of the estimate. The temporal mean of every
+	sample is removed first, so that static patterns do not pull the estimate to zero.
+
+	Parameters:
+	sti : np.ndarray
+		Space-time images of shape (stations, frames, samples), with frames a multiple of window.
+	window : int
+		Number of frames per estimate.
+	sigma : float, optional
+		Standard deviation of the Gaussian derivative filters, in pixels. Default is 1.0.
+
+	Returns:
+	tuple
+		velocity (samples per frame), coherence in [0, 1] and texture (mean gradient magnitude), each of shape
+		(stations, windows).
+	"""
+	num_stations, num_frames, num_samples = sti.shape
+	num_windows = num_frames // window
+	sti = sti - sti.mean(axis=1, keepdims=True)
+
+	# Gaussian derivatives along time (axis 1) and along the lines (axis 2)
+	grad_t = gaussian_filter1d(gaussian_filter1d(sti, sigma, axis=1, order=1), sigma, axis=2)
+	grad_s = gaussian_filter1d(gaussian_filter1d(sti, sigma, axis=2, order=1), sigma, axis=1)
+
+	def window_sum(values):
+		return values.reshape(num_stations, num_windows, window * num_samples).sum(axis=2, dtype=np.float64)
+
+	j_ss = window_sum(grad_s * grad_s)
+	j_tt = window_sum(grad_t * grad_t)
+	j_st = window_sum(grad_s * grad_t)
+	texture = window_sum(np.abs(grad_s) + np.abs(grad_t)) / (window * num_samples)
+
+	# Dominant gradient orientation in the (s, t) plane, normal to the streaks
+	phi = 0.5 * np.arctan2(2 * j_st, j_ss - j_tt)
+	velocity = -np.tan(phi)
+
+	with np.errstate(divide="ignore", invalid="ignore"):
+		coherence = np.sqrt((j_ss - j_tt) ** 2 + 4 * j_st ** 2) / (j_ss + j_tt)
+
+	return velocity, np.nan_to_num(coherence), texture
+
+
+def streak_velocity(sti: np.ndarray, window: Optional[int] = None, min_samples: int = 16) -> tuple:
+	"""
+	Estimate the streak velocity of space-time images, from coarse to fine resolution along the lines.
+
+	The gradients only see displacements of about one sample per frame: faster streaks alias. The STIs are averaged
+	over blocks of 2, 4, ... samples down to min_samples samples per line. The coarsest level gives a first
+	velocity, and every finer level is used while that velocity stays below one of its samples per frame, which
+	keeps the precision of the full resolution for slow flows and the range of the coarse levels for fast ones.
+
+	Parameters:
+	sti : np.ndarray
+		Space-time images of shape (stations, frames, samples).
+	window : int, optional
+		Number of frames per estimate. Defaults to all the frames, i.e. one estimate per station.
+	min_samples : int, optional
+		Number of samples per line of the coarsest level. Default is 16.
+
+	Returns:
+	tuple
+		velocity in samples of the full resolution per frame, coherence and texture, each of shape
+		(stations, windows). Coherence and texture are the ones of the level that gave the velocity.
+	"""
+	num_stations, num_frames, num_samples = sti.shape
+	if window is None or window > num_frames:
+		window = num_frames
+	sti = sti[:, : (num_frames // window) * window].astype(np.float32)
+
+	levels = []
+	factor = 1
+	while num_samples // factor >= min_samples or factor == 1:
+		length = (num_samples // factor) * factor
+		coarse = sti[:, :, :length].reshape(num_stations, sti.shape[1], -1, factor).mean(axis=3)
+		velocity, coherence, texture = structure_tensor_velocity(coarse, window)
+		levels.append((factor, velocity * factor, coherence, texture))
+		factor *= 2
+
+	# From the coarsest level to the finest one that still resolves the current estimate
+	_, velocity, coherence, texture = levels[-1]
+	velocity = velocity.copy()
+	coherence = coherence.copy()
+	texture = texture.copy()
+	for factor, level_velocity, level_coherence, level_texture in reversed(levels[:-1]):
+		finer = np.abs(velocity) <= factor
+		velocity[finer] = level_velocity[finer]
+		coherence[finer] = level_coherence[finer]
+		texture[finer] = level_texture[finer]
+
+	return velocity, coherence, texture
+
+
+def column_nanmedian(values: np.ndarray) -> np.ndarray:
+	"""Median of every column ignoring NaN values, NaN for columns without a valid value."""
+	median = np.full(values.shape[1], np.nan)
+	valid = ~np.isnan(values).all(axis=0)
+	median[valid] = np.nanmedian(values[:, valid], axis=0)
+	return median
+
+
+def run_stiv(
+		images_location: Path,
+		x_sections: dict,
+		transformation_matrix: np.ndarray,
+		id_section: int = 0,
+		num_stations: Optional[int] = None,
+		line_length: Optional[float] = None,
+		window: Optional[int] = None,
+		min_coherence: float = MIN_COHERENCE,
+) -> dict:
+	"""
+	Measure the streamwise velocity of the stations of a cross-section with STIV.
+
+	Parameters:
+	images_location : Path
+		Folder with the JPG frames.
+	x_sections : dict
+		Cross-sections data.
+	transformation_matrix : np.ndarray
+		Transformation matrix from pixel to real-world coordinates.
+	id_section : int, optional
+		Index of the cross-section. Default is 0.
+	num_stations, line_length :
+		See stiv_lines.
+	window : int, optional
+		Number of frames per velocity estimate. Each estimate is one "pair" of the results. Defaults to a single
+		estimate over all the frames.
+	min_coherence : float, optional
+		Estimates with a lower structure tensor coherence are NaN. Default is MIN_COHERENCE.
+
+	Returns:
+	dict
+		Results with the schema of run_analyze_all. The grid has shape (2, stations): the upstream and downstream
+		ends of the search lines, both with the displacement of their station. u and v are pixel displacements
+		between consecutive frames, gradient is the STI texture.
+	"""
+	images = sorted([str(f) for f in Path(images_location).glob("*.jpg")])
+	if len(images) < 2:
+		raise ImageReadError(f"At least two JPG images are needed in {images_location}")
+
+	transformation_matrix = np.asarray(transformation_matrix, dtype=np.float64)
+	x_section = list(x_sections.values())[id_section]
+	lines = stiv_lines(x_section, transformation_matrix, num_stations, line_length)
+
+	sti = read_space_time_images(images, lines["map_x"], lines["map_y"])
+	velocity, coherence, texture = streak_velocity(sti, window)
+	velocity[coherence < min_coherence] = np.nan
+
+	# Real-world displacement per frame along the lines, then its pixel components at both ends of every line
+	spacing = lines["offsets"][1] - lines["offsets"][0]
+	displacement = (velocity * spacing).T[:, None, :]
+	direction = lines["direction"]
+
+	ends = [0, -1]
+	x = lines["map_x"][:, ends].T.astype(np.float64)
+	y = lines["map_y"][:, ends].T.astype(np.float64)
+	east, north = hg.pixel_to_real_world(x, y, transformation_matrix)
+	x_displaced, y_displaced = hg.real_world_to_pixel(
+		east + displacement * direction[0], north + displacement * direction[1], transformation_matrix
+	)
+	u = (x_displaced - x).reshape(len(velocity.T), -1)
+	v = (y_displaced - y).reshape(len(velocity.T), -1)
+	gradient = np.repeat(texture.T[:, None, :], 2, axis=1).reshape(len(velocity.T), -1)
+
+	return {
+		"shape": list(x.shape),
+		"x": x.flatten().tolist(),
+		"y": y.flatten().tolist(),
+		"u_median": column_nanmedian(u).tolist(),
+		"v_median": column_nanmedian(v).tolist(),
+		"u": u.tolist(),
+		"v": v.tolist(),
+		"gradient": gradient.tolist(),
+	}
@@ -0,0 +1,295 @@
+"""
+File Name: video_index.py
+Project Name: RIVeR-LAC
+Description: Random access to the frames of a video through a persistent index of its timestamps and keyframes.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+Phone and drone videos are long-GOP H.264/H.265: only the keyframes can be decoded on their own and every other
+frame needs the frames before it, back to the previous keyframe. A seek of the FFmpeg backend of OpenCV lands on the
+keyframe before the target minus SEEK_DELTA frames and decodes forward from there, so reading scattered frames costs
+up to a whole GOP each, and the frame count it reports is only an estimate from the container.
+
+A VideoIndex is built by a single scan of the packets, in the raw mode of OpenCV that demuxes without decoding. It
+records the presentation timestamp of every frame and which frames are keyframes, and it is saved next to the
+video as a sidecar JSON file, reused while the size and modification time of the video are unchanged. A
+VideoFrameReader then serves any frame or pair: it keeps decoding forward from its current position when that is
+cheaper than a seek, and seeks otherwise, so it never decodes more than the index says is needed.
+"""
+
+import bisect
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from river.core.exceptions import ImageReadError
+from river.core.video_stream import convert_frame
+
+# Version of the sidecar format, older indexes are rebuilt
+INDEX_VERSION = 1
+
+# Suffix of the sidecar index, appended to the name of the video
+INDEX_SUFFIX = ".index.json"
+
+# Number of frames before its target a seek of the FFmpeg backend of OpenCV starts from
+SEEK_DELTA = 16
+
+# Number of decoded frames kept by a VideoFrameReader
+READER_CACHE_SIZE = 8
+
+
+@dataclass
+class VideoIndex:
+	"""Presentation timestamps and keyframes of the frames of a video, and the signature of the indexed file."""
+
+	frame_count: int
+	fps: float
+	timestamps: list
+	keyframes: list
+	size: int
+	mtime_ns: int
+	version: int = INDEX_VERSION
+
+	def keyframe_before(self, frame: int) -> int:
+		"""The last keyframe at or before a frame, 0 when the keyframes are unknown."""
+		position = bisect.bisect_right(self.keyframes, frame) - 1
+		return self.keyframes[position] if position >= 0 else 0
+
+	def seek_cost(self, frame: int) -> int:
+		"""Number of frames decoded to read a frame after a seek."""
+		return frame - self.keyframe_before(max(frame - SEEK_DELTA, 0)) + 1
+
+	def matches(self, video_path: Path) -> bool:
+		"""Whether the index describes the current content of a video."""
+		stat = Path(video_path).stat()
+		return self.version == INDEX_VERSION and self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+
+def index_path(video_path: Path) -> Path:
+	"""Path of the sidecar index of a video."""
+	video_path = Path(video_path)
+	return video_path.with_name(video_path.name + INDEX_SUFFIX)
+
+
+def scan_video(video_path: Path) -> VideoIndex:
+	"""
+	Build the index of a video by reading its packets once.
+
+	Backends without a raw mode decode every frame instead, and record frame 0 as the only keyframe.
+
+	Parameters:
+	video_path : Path
+		Path of the video.
+
+	Returns:
+	VideoIndex
+		The index of the video.
+	"""
+	stat = Path(video_path).stat()
+	capture = cv2.VideoCapture(str(video_path))
+	if not capture.isOpened():
+		raise ImageReadError(f"Could not open video: {video_path}")
+
+	try:
+		fps = capture.get(cv2.CAP_PROP_FPS)
+		raw = capture.set(cv2.CAP_PROP_FORMAT, -1)
+
+		timestamps = []
+		keys = []
+		while capture.grab():
+			timestamps.append(capture.get(cv2.CAP_PROP_POS_MSEC))
+			keys.append(raw and capture.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME) > 0)
+	finally:
+		capture.release()
+
+	# Packets come in decoding order, which differs from the presentation order of the frames with B-frames
+	order = np.argsort(timestamps, kind="stable")
+	keyframes = [int(frame) for frame in np.flatnonzero(np.asarray(keys, dtype=bool)[order])]
+	if not raw:
+		keyframes = [0]
+
+	return VideoIndex(
+		frame_count=len(timestamps),
+		fps=fps,
+		timestamps=[float(timestamps[packet]) for packet in order],
+		keyframes=keyframes,
+		size=stat.st_size,
+		mtime_ns=stat.st_mtime_ns,
+	)
+
+
+def save_video_index(index: VideoIndex, video_path: Path) -> Optional[Path]:
+	"""
+	Save the index next to the video. The file is replaced atomically and write errors are ignored, e.g. on a
+	read-only folder, as the index is only a speed-up.
+
+	Parameters:
+	index : VideoIndex
+		The index.
+	video_path : Path
+		Path of the video.
+
+	Returns:
+	Path or None
+		The sidecar file, or None when it could not be written.
+	"""
+	path = index_path(video_path)
+	try:
+		handle, temporary = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+	except OSError:
+		return None
+
+	try:
+		with os.fdopen(handle, "w") as file:
+			json.dump(asdict(index), file)
+		os.replace(temporary, path)
+	except OSError:
+		Path(temporary).unlink(missing_ok=True)
+		return None
+
+	return path
+
+
+def load_video_index(video_path: Path) -> VideoIndex:
+	"""
+	Read the sidecar index of a video, or build and save it when it is missing or outdated.
+
+	Parameters:
+	video_path : Path
+		Path of the video.
+
+	Returns:
+	VideoIndex
+		The index of the video.
+	"""
+	try:
+		index = VideoIndex(**json.loads(index_path(video_path).read_text()))
+		if index.matches(video_path):
+			return index
+	except (OSError, ValueError, TypeError):
+		pass
+
+	index = scan_video(video_path)
+	save_video_index(index, video_path)
+	return index
+
+
+class VideoFrameReader:
+	"""
+	Random access to the frames of a video, numbered as video_to_frames numbers them.
+
+	Frames are decoded forward from the current position of the decoder when that is cheaper than a seek, which
+	makes consecutive and nearby reads as fast as a sequential pass. The last decoded frames are cached, so the two
+	frames of overlapping pairs are decoded once.
+	"""
+
+	def __init__(
+		self,
+		video_path: Path,
+		resize_factor: float = 1.0,
+		grayscale: bool = True,
+		cache_size: int = READER_CACHE_SIZE,
+	):
+		"""
+		Parameters:
+		video_path : Path
+			Path of the video.
+		resize_factor : float, optional
+			Factor to resize the frames (<= 1.0). Default is 1.0.
+		grayscale : bool, optional
+			Convert the frames to grayscale. Default is True.
+		cache_size : int, optional
+			Number of decoded frames kept. Default is READER_CACHE_SIZE.
+		"""
+		if resize_factor > 1.0 or resize_factor <= 0:
+			raise ValueError("resize_factor must be between 0 and 1.0")
+
+		self.video_path = Path(video_path)
+		self.index = load_video_index(self.video_path)
+		self.resize_factor = resize_factor
+		self.grayscale = grayscale
+		self.cache_size = cache_size
+		self._cache = OrderedDict()
+		self._capture = cv2.VideoCapture(str(self.video_path))
+		if not self._capture.isOpened():
+			raise ImageReadError(f"Could not open video: {video_path}")
+		# Number of the next frame the decoder returns
+		self._position = 0
+
+	def __len__(self) -> int:
+		"""Number of frames of the video, as counted by the index."""
+		return self.index.frame_count
+
+	def read(self, frame: int) -> np.ndarray:
+		"""
+		Read a frame.
+
+		Parameters:
+		frame : int
+			Number of the frame.
+
+		Returns:
+		np.ndarray
+			The resized and converted frame.
+		"""
+		if frame in self._cache:
+			self._cache.move_to_end(frame)
+			return self._cache[frame]
+		if not 0 <= frame < len(self):
+			raise ImageReadError(f"Frame {frame} is out of range, {self.video_path} has {len(self)} frames.")
+
+		forward = frame - self._position + 1
+		if forward <= 0 or forward > self.index.seek_cost(frame):
+			self._capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+		else:
+			for _ in range(frame - self._position):
+				if not self._capture.grab():
+					break
+
+		ret, image = self._capture.read()
+		if not ret:
+			raise ImageReadError(f"Could not read frame {frame} of {self.video_path}")
+		self._position = frame + 1
+
+		image = convert_frame(image, self.resize_factor, self.grayscale)
+		self._cache[frame] = image
+		if len(self._cache) > self.cache_size:
+			self._cache.popitem(last=False)
+		return image
+
+	def read_pair(self, frame: int, step: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+		"""
+		Read the two frames of a PIV pair.
+
+		Parameters:
+		frame : int
+			Number of the first frame.
+		step : int, optional
+			Distance to the second frame. Default is 1.
+
+		Returns:
+		Tuple[np.ndarray, np.ndarray]
+			The first and second frames.
+		"""
+		return self.read(frame), self.read(frame + step)
+
+	def close(self):
+		"""Release the decoder."""
+		self._capture.release()
+		self._cache.clear()
+
+	def __enter__(self) -> "VideoFrameReader":
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
@@ -0,0 +1,211 @@
+"""
+File Name: video_stream.py
+Project Name: RIVeR-LAC
+Description: Stream the frames of a video straight into the PIV pipeline, without extracting them.
+
+Author: Antoine Patalano
+Email: antoine.patalano@unc.edu.ar / contact@orus.cam
+Company: UNC / ORUS
+www.orus.cam
+
+video_to_frames writes every selected frame as a JPEG that the PIV pipeline decodes again, which costs two lossy
+codec passes and the disk traffic of the whole clip. A VideoFrameStream decodes the video once, sequentially, in a
+background thread and hands the selected frames to the consumer through a bounded queue, so decoding overlaps the
+PIV of the previous frames and the memory used does not depend on the length of the video.
+
+The frames are selected, numbered and resized as video_to_frames does: frame numbers are absolute, only those that
+are a multiple of every are kept and resizing uses INTER_AREA.
+"""
+
+import queue
+import threading
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from river.core.exceptions import ImageReadError
+
+# File extensions read as videos by the PIV pipeline
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".m4v", ".mts", ".mpg", ".mpeg", ".wmv")
+
+# Number of decoded frames buffered between the decoder thread and the consumer
+STREAM_QUEUE_SIZE = 32
+
+
+def is_video(path: Path) -> bool:
+	"""Whether a path is a video file that can be analyzed directly."""
+	path = Path(path)
+	return path.is_file() and path.suffix.lower() in VIDEO_EXTENSIONS
+
+
+def frame_name(frame_number: int) -> str:
+	"""Name of the JPEG that video_to_frames writes for a frame."""
+	return f"{frame_number:010d}.jpg"
+
+
+def selected_frames(video_path: Path, start: int = 0, end: Optional[int] = None, every: int = 1) -> range:
+	"""
+	Numbers of the frames of a video selected by start, end and every, as video_to_frames selects them.
+
+	Parameters:
+	video_path : Path
+		Path of the video.
+	start : int, optional
+		First frame. Default is 0.
+	end : int, optional
+		Frame after the last one. Defaults to the frame count reported by the container.
+	every : int, optional
+		Frame spacing. Default is 1.
+
+	Returns:
+	range
+		The frame numbers. The count reported by some containers is approximate, so a stream may end earlier.
+	"""
+	capture = cv2.VideoCapture(str(video_path))
+	if not capture.isOpened():
+		raise ImageReadError(f"Could not open video: {video_path}")
+	frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+	capture.release()
+
+	end = frame_count if end is None else min(end, frame_count)
+	first = start + (-start) % every
+	return range(first, max(first, end), every)
+
+
+def convert_frame(frame: np.ndarray, resize_factor: float = 1.0, grayscale: bool = True) -> np.ndarray:
+	"""
+	Resize a decoded BGR frame as video_to_frames does and convert it to grayscale.
+
+	Parameters:
+	frame : np.ndarray
+		The decoded frame.
+	resize_factor : float, optional
+		Factor to resize the frame (<= 1.0). Default is 1.0.
+	grayscale : bool, optional
+		Convert to grayscale. Default is True.
+
+	Returns:
+	np.ndarray
+		The converted frame.
+	"""
+	if 0 < resize_factor < 1.0:
+		height, width = frame.shape[:2]
+		frame = cv2.resize(
+			frame, (int(width * resize_factor), int(height * resize_factor)), interpolation=cv2.INTER_AREA
+		)
+	if grayscale and frame.ndim == 3:
+		frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+	return frame
+
+
+class VideoFrameStream:
+	"""
+	Sequential decoder of the selected frames of a video, running in a background thread.
+
+	Iterating yields (frame_number, frame) in order. The decoder stays at most queue_size frames ahead of the
+	consumer. Use it as a context manager, or call close, to stop the decoder when the frames are not all consumed.
+	"""
+
+	def __init__(
+		self,
+		video_path: Path,
+		start: int = 0,
+		end: Optional[int] = None,
+		every: int = 1,
+		resize_factor: float = 1.0,
+		grayscale: bool = True,
+		queue_size: int = STREAM_QUEUE_SIZE,
+	):
+		"""
+		Parameters:
+		video_path : Path
+			Path of the video.
+		start, end, every :
+			Selection of the frames, see selected_frames.
+		resize_factor : float, optional
+			Factor to resize the frames (<= 1.0). Default is 1.0.
+		grayscale : bool, optional
+			Convert the frames to grayscale. Default is True.
+		queue_size : int, optional
+			Largest number of decoded frames waiting for the consumer. Default is STREAM_QUEUE_SIZE.
+		"""
+		if resize_factor > 1.0 or resize_factor <= 0:
+			raise ValueError("resize_factor must be between 0 and 1.0")
+
+		self.video_path = Path(video_path)
+		self.frame_numbers = selected_frames(video_path, start, end, every)
+		self.every = every
+		self.resize_factor = resize_factor
+		self.grayscale = grayscale
+		self._queue = queue.Queue(maxsize=queue_size)
+		self._stop = threading.Event()
+		self._thread = None
+
+	def __len__(self) -> int:
+		"""Number of selected frames, according to the frame count of the container."""
+		return len(self.frame_numbers)
+
+	def _put(self, item) -> bool:
+		# Wait for room in the queue, unless the consumer has stopped the stream
+		while not self._stop.is_set():
+			try:
+				self._queue.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def _decode(self):
+		capture = cv2.VideoCapture(str(self.video_path))
+		try:
+			if len(self.frame_numbers) == 0:
+				return
+			frame = self.frame_numbers.start
+			if frame > 0:
+				capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+
+			while frame < self.frame_numbers.stop and not self._stop.is_set():
+				# Frames that are not selected are only grabbed, which skips their conversion
+				if not capture.grab():
+					break
+				if (frame - self.frame_numbers.start) % self.every == 0:
+					ret, image = capture.retrieve()
+					if not ret:
+						break
+					if not self._put((frame, convert_frame(image, self.resize_factor, self.grayscale))):
+						return
+				frame += 1
+		except Exception as error:
+			self._put(error)
+		finally:
+			capture.release()
+			self._put(None)
+
+	def __iter__(self) -> Iterator[Tuple[int, np.ndarray]]:
+		if self._thread is not None:
+			raise RuntimeError("A VideoFrameStream can only be iterated once.")
+		self._thread = threading.Thread(target=self._decode, name="video-decoder", daemon=True)
+		self._thread.start()
+
+		while True:
+			item = self._queue.get()
+			if item is None:
+				return
+			if isinstance(item, Exception):
+				raise item
+			yield item
+
+	def close(self):
+		"""Stop the decoder thread."""
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+
+	def __enter__(self) -> "VideoFrameStream":
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
@@ -1,11 +1,24 @@
 import multiprocessing
 import os
+import queue
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
 import cv2
-import numpy as np
+
+from river.core.concurrency import available_cores
+from river.core.frame_stack import is_frame_stack, write_frame_stack
+from river.core.video_stream import VideoFrameStream, convert_frame, frame_name
+
+# Extraction modes: one sequential decoder feeding JPEG writers, one decoder per chunk of frames, or a frame stack
+EXTRACTION_MODES = ("stream", "chunks", "stack")
+
+# Number of decoded frames waiting for a writer, per writer
+WRITE_QUEUE_FRAMES = 4
+
+# Set JPEG compression parameters for faster writing
+ENCODE_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), 95]
 
 
 def extract_frames(
@@ -31,9 +44,6 @@ def extract_frames(
 	Returns:
 	    int: Count of the saved images.
 	"""
-	# Set JPEG compression parameters for faster writing
-	encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), 95]
-
 	capture = cv2.VideoCapture(str(video_path))  # open the video using OpenCV
 	# Set optimal buffer size
 	capture.set(cv2.CAP_PROP_BUFFERSIZE, 3)
@@ -43,23 +53,6 @@ def extract_frames(
 
 	capture.set(1, start)  # set the starting frame of the capture
 
-	# Read first frame to get dimensions
-	ret, first_frame = capture.read()
-	if not ret or first_frame is None:
-		capture.release()
-		return 0
-
-	height, width = first_frame.shape[:2]
-
-	# Calculate new dimensions based on resize_factor
-	if resize_factor < 1.0 and resize_factor > 0:
-		new_width = int(width * resize_factor)
-		new_height = int(height * resize_factor)
-		frame_buffer = np.empty((new_height, new_width, 3), dtype=np.uint8)
-	else:
-		new_width, new_height = width, height
-		frame_buffer = np.empty((height, width, 3), dtype=np.uint8)
-
 	frame = start  # keep track of which frame we are up to, starting from start
 	while_safety = 0  # a safety counter to ensure we don't enter an infinite while loop
 	saved_count = 0  # a count of how many frames we have saved
@@ -77,15 +70,14 @@ def extract_frames(
 				continue
 
 			# Resize the frame if resize_factor is less than 1
-			if resize_factor < 1.0 and resize_factor > 0:
-				temp_frame = cv2.resize(temp_frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
+			temp_frame = convert_frame(temp_frame, resize_factor, grayscale=False)
 
 			while_safety = 0  # reset the safety count
 			save_path = str(frames_dir / f"{frame:010d}.jpg")  # create the save path
 
 			if not os.path.exists(save_path) or overwrite:
 				# Use the encoding parameters for optimized JPEG writing
-				cv2.imwrite(save_path, temp_frame, encode_params)
+				cv2.imwrite(save_path, temp_frame, ENCODE_PARAMS)
 				saved_count += 1
 
 		frame += 1
@@ -94,6 +86,100 @@ def extract_frames(
 	return saved_count
 
 
+def write_frames(frames: queue.Queue, frames_dir: Path, overwrite: bool) -> int:
+	"""Encode and save the frames of a queue as JPEGs until it yields None.
+
+	Args:
+	    frames (queue.Queue): The (frame number, frame) to save, then None.
+	    frames_dir (Path): The directory to save the frames.
+	    overwrite (bool): To overwrite frames that already exist.
+
+	Returns:
+	    int: Count of the saved images.
+	"""
+	saved_count = 0
+	while (item := frames.get()) is not None:
+		frame, image = item
+		save_path = str(frames_dir / frame_name(frame))
+		if not os.path.exists(save_path) or overwrite:
+			cv2.imwrite(save_path, image, ENCODE_PARAMS)
+			saved_count += 1
+	return saved_count
+
+
+def queue_frame(frames: queue.Queue, item: tuple, writers: list) -> bool:
+	"""Wait for room in the queue of the writers and add a frame, unless a writer stopped on an error.
+
+	Args:
+	    frames (queue.Queue): The queue of the writers.
+	    item (tuple): The frame number and frame.
+	    writers (list): The futures of the writers, which are only done early when they fail.
+
+	Returns:
+	    bool: Whether the frame was queued.
+	"""
+	while not any(writer.done() for writer in writers):
+		try:
+			frames.put(item, timeout=0.1)
+			return True
+		except queue.Full:
+			continue
+	return False
+
+
+def stream_frames(
+	video_path: Path,
+	frames_dir: Path,
+	every: int,
+	start: int,
+	end: Optional[int] = None,
+	overwrite: bool = False,
+	resize_factor: float = 1.0,
+	workers: Optional[int] = None,
+) -> int:
+	"""Extract frames from a video with a single sequential decoder feeding a pool of JPEG writers.
+
+	The frames are decoded once, in order, and only the selected ones are retrieved and resized. They reach the
+	writers through a bounded queue, so the decoder never runs more than a few frames ahead of the encoding.
+
+	Args:
+	    video_path (Path): Path of the video.
+	    frames_dir (Path): The directory to save the frames.
+	    every (int): Frame spacing.
+	    start (int): Start frame.
+	    end (Optional[int], optional): End frame. Defaults to None.
+	    overwrite (bool, optional): To overwrite frames that already exist. Defaults to False.
+	    resize_factor (float, optional): Factor to resize the frames (<=1.0). Defaults to 1.0.
+	    workers (Optional[int], optional): Number of writer threads. Defaults to the available cores minus the one
+	        of the decoder.
+
+	Returns:
+	    int: Count of the saved images.
+	"""
+	if workers is None:
+		workers = max(1, available_cores() - 1)
+
+	frames = queue.Queue(maxsize=WRITE_QUEUE_FRAMES * workers)
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		writers = [executor.submit(write_frames, frames, frames_dir, overwrite) for _ in range(workers)]
+		failed = True
+		try:
+			with VideoFrameStream(video_path, start, end, every, resize_factor, grayscale=False) as stream:
+				failed = not all(queue_frame(frames, item, writers) for item in stream)
+		finally:
+			if failed:
+				# Drop the frames still waiting, which leaves room for the end markers
+				while True:
+					try:
+						frames.get_nowait()
+					except queue.Empty:
+						break
+			for _ in writers:
+				frames.put(None)
+
+	return sum(writer.result() for writer in writers)
+
+
 def video_to_frames(
 	video_path: Path,
 	frames_dir: Path,
@@ -102,6 +188,9 @@ def video_to_frames(
 	overwrite: bool = False,
 	every: int = 1,
 	resize_factor: float = 1.0,
+	mode: str = "stream",
+	workers: Optional[int] = None,
+	bbox: Optional[list] = None,
 ) -> str:
 	"""Extracts the frames from a video using multiprocessing
 
@@ -114,23 +203,54 @@ def video_to_frames(
 		every (int, optional): Extract every this many frames. Defaults to 1.
 		chunk_size (int, optional): How many frames to split into chunks (one chunk per cpu core process). Defaults to 100.
 		resize_factor (float, optional): Factor to resize the frames (<=1.0). Defaults to 1.0.
+		mode (str, optional): "stream" decodes the video once and encodes the frames in parallel, "chunks" decodes
+			chunks of the video in parallel, each with its own decoder. "stack" writes frames_dir as a single
+			lossless frame stack of grayscale frames cropped to bbox, see frame_stack. Defaults to "stream".
+		workers (Optional[int], optional): Number of JPEG writers of the "stream" mode. Defaults to the available
+			cores minus one.
+		bbox (Optional[list], optional): Bounding box [x, y, width, height] of the "stack" mode, in pixels of the
+			resized frames. Defaults to the whole frame.
 
 	Raises:
 		VideoHasNoFrames: When opencv can't split into frames.
-		ValueError: When resize_factor is greater than 1.0 or less than or equal to 0.
+		ValueError: When resize_factor is greater than 1.0 or less than or equal to 0, or the mode is unknown.
 
 	Returns:
-		str: Path to the directory where the frames were saved, or None if fails
+		str: Path to the first saved frame, or to the frame stack, or None if fails
 	"""
 	# Validate resize_factor
 	if resize_factor > 1.0 or resize_factor <= 0:
 		raise ValueError("resize_factor must be between 0 and 1.0")
 
+	if mode not in EXTRACTION_MODES:
+		raise ValueError(f"mode must be one of {', '.join(EXTRACTION_MODES)}")
+
 	# Add path validation
 	video_path = str(video_path)
 	if not os.path.exists(video_path):
 		raise FileNotFoundError(f"Video file not found: {video_path}")
 
+	if mode == "stack":
+		# As existing frames are kept, so is an existing stack
+		if overwrite or not is_frame_stack(frames_dir):
+			write_frame_stack(
+				video_path, frames_dir, bbox, start_frame_number, end_frame_number, every, resize_factor
+			)
+		return frames_dir
+
+	if mode == "stream":
+		stream_frames(
+			video_path=video_path,
+			frames_dir=frames_dir,
+			every=every,
+			start=start_frame_number,
+			end=end_frame_number,
+			overwrite=overwrite,
+			resize_factor=resize_factor,
+			workers=workers,
+		)
+		return sorted(frames_dir.glob("*"))[0]
+
 	capture = cv2.VideoCapture(video_path)  # load the video
 	total_video_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
 